@@ -1,79 +1,268 @@
+import httplib
 import json
 import os
+import Queue
 import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import urllib
+import urllib2
+import urlparse
 import zipfile
 import StringIO
+from cache import ResponseCache, DEFAULT_TTL_SECONDS, DEFAULT_MAX_BYTES
+import instrument
+from multiprocessing.pool import ThreadPool
+from scheduler import HostRateLimiter
 
 API_HOST = 'http://api.brain-map.org/'
 API_QUERY_BASE_URL = API_HOST + 'api/v2/data/query.json'
 GRID_URL_FORMAT = API_HOST + "grid_data/download/%d"
 
-# Make a query to the api, downloading all rows and packaging them into an array.
-def query(query_string, rows_per_query=2000):
-    start_row = 0
-    total_rows = -1
-    
-    rows = []
-    done = False
+# Send all requests to another server, such as a mirror or the mock server
+# in benchmark.py.  'host' is a URL ending in '/'.
+def set_api_host(host):
+    global API_HOST, API_QUERY_BASE_URL, GRID_URL_FORMAT
+    API_HOST = host
+    API_QUERY_BASE_URL = API_HOST + 'api/v2/data/query.json'
+    GRID_URL_FORMAT = API_HOST + "grid_data/download/%d"
+
+# Downloads and zip members are copied in blocks of this many bytes, so
+# memory use does not depend on the size of the files.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Number of data sets whose structure unionizes are requested together.
+UNIONIZE_BATCH_SIZE = 50
+
+# Queries fetch pages concurrently using this many threads.
+QUERY_THREADS = 4
+
+# With adaptive paging, page sizes are chosen so that each page takes about
+# this long to fetch, within the given bounds.
+TARGET_PAGE_SECONDS = 2.0
+MIN_ROWS_PER_QUERY = 500
+MAX_ROWS_PER_QUERY = 25000
+
+# The on-disk query response cache, if one has been configured.
+response_cache = None
+
+# Cache query responses on disk.  See cache.py.  Note that cached pages are
+# only reused by queries with the same page sizes, so adaptive paging defeats
+# the cache.
+def configure_cache(directory, ttl_seconds=DEFAULT_TTL_SECONDS, max_bytes=DEFAULT_MAX_BYTES, offline=False):
+    global response_cache
+    response_cache = ResponseCache(directory, ttl_seconds, max_bytes, offline)
+    return response_cache
+
+# How downloaded volumes are stored: as 'raw' files, or as 'chunked',
+# compressed .cvol files (see chunked_volume.py).
+VOLUME_STORAGE_TYPES = ['raw', 'chunked']
+volume_storage = 'raw'
+volume_codec = 'zlib'
+
+# Choose how downloaded volumes are stored.
+def configure_volume_storage(storage='raw', codec='zlib'):
+    global volume_storage, volume_codec
+    assert storage in VOLUME_STORAGE_TYPES, "storage must be one of %s" % ', '.join(VOLUME_STORAGE_TYPES)
+    volume_storage = storage
+    volume_codec = codec
+
+# The name of the data file of a downloaded volume, given its name without
+# an extension.
+def volume_data_file_name(base_file_name):
+    return base_file_name + ('.cvol' if volume_storage == 'chunked' else '.raw')
+
+# The limit on the rate of HTTP requests to each host, if one has been
+# configured.
+rate_limiter = None
+
+# Limit the rate at which HTTP requests to each host start, counting every
+# query page and download from every thread.  None for no limit.  Answers
+# from the query cache are not requests and are not limited.
+def configure_rate_limit(requests_per_second):
+    global rate_limiter
+    rate_limiter = HostRateLimiter(requests_per_second) if requests_per_second else None
+
+# A pool of persistent HTTP connections to a single host.  Connections are
+# kept alive between requests and shared by threads; a connection that the
+# server has closed is replaced and the request is retried once.
+class ConnectionPool(object):
+
+    def __init__(self, netloc):
+        self.netloc = netloc
+        self.idle = Queue.LifoQueue()
+
+    def request(self, method, path, body=None, headers={}):
+        for attempt in xrange(2):
+            try:
+                connection = self.idle.get_nowait()
+                reused = True
+            except Queue.Empty:
+                connection = httplib.HTTPConnection(self.netloc)
+                reused = False
+
+            try:
+                with instrument.timer('http.request', path=path, reused=reused):
+                    connection.request(method, path, body, headers)
+                    response = connection.getresponse()
+                    data = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+
+                # A kept-alive connection may have been closed by the server.
+                if reused:
+                    continue
+                raise IOError("%s %s failed: %s" % (method, path, e))
+
+            instrument.count('http.requests')
+            instrument.count('http.reused_connections', reused)
+            instrument.count('http.bytes_received', len(data))
+
+            if response.will_close:
+                connection.close()
+            else:
+                self.idle.put(connection)
+
+            if response.status != 200:
+                raise IOError("%s %s failed: HTTP %d %s" % (method, path, response.status, response.reason))
+
+            return data
+
+        raise IOError("%s %s failed: connection closed" % (method, path))
+
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+
+# Send a form-encoded POST over a pooled connection and return the response body.
+def post(url, fields):
+    parsed = urlparse.urlparse(url)
+
+    if rate_limiter:
+        rate_limiter.wait(parsed.netloc)
+
+    with connection_pools_lock:
+        pool = connection_pools.get(parsed.netloc)
+        if pool is None:
+            pool = connection_pools[parsed.netloc] = ConnectionPool(parsed.netloc)
+
+    return pool.request('POST', parsed.path, urllib.urlencode(fields),
+                        { 'Content-Type': 'application/x-www-form-urlencoded' })
+
+# Fetch one page of query results.  Returns the rows and the total number of
+# rows matching the query.
+def query_page(query_string, start_row, num_rows):
+    if response_cache:
+        response_json = response_cache.get(query_string, start_row, num_rows)
+
+        if response_json is not None:
+            instrument.count('query.cache_hits')
+            return response_json['msg'], int(response_json['total_rows'])
+        elif response_cache.offline:
+            raise IOError("Query is not cached and the cache is offline: %s" % query_string)
+
+    data = { 'criteria': query_string,
+             'start_row': start_row,
+             'num_rows': num_rows }
+
+    with instrument.timer('query.page', start_row=start_row, num_rows=num_rows):
+        response = post(API_QUERY_BASE_URL, data)
+
+    # Convert the response to JSON
+    with instrument.timer('query.parse'):
+        response_json = json.loads(response)
 
-    # Read rows until we have all of the results.  We will know how many rows
-    # that is by checking the response of the first query.
-    while not done:
+    if not response_json['success']:
+        raise IOError(response_json['msg'])
 
-        # Append start_row and num_row arguments to the query.
-        data = { 'criteria': query_string,
-                 'start_row': start_row,
-                 'num_rows': rows_per_query }
+    instrument.count('query.pages')
+    instrument.count('query.rows', len(response_json['msg']))
 
-        print data
+    if response_cache:
+        response_cache.put(query_string, start_row, num_rows, response_json)
 
-        # Convert the response to JSON
-        response = urllib.urlopen(API_QUERY_BASE_URL, urllib.urlencode(data)).read()
-        response_json = json.loads(response)
+    return response_json['msg'], int(response_json['total_rows'])
 
-        if not response_json['success']:
-            raise IOError(response_json['msg'])
+# Fetch num_rows rows starting at start_row, in as many requests as the
+# server needs to return them all.
+def query_rows(query_string, start_row, num_rows):
+    rows = []
+    while len(rows) < num_rows:
+        page, total_rows = query_page(query_string, start_row + len(rows), num_rows - len(rows))
+        if not page:
+            break
+        rows += page
+    return rows
 
-        # Appen the response rows.
-        rows += response_json['msg']
-        
-        # Initialize total_rows if it hasn't been.
-        if total_rows < 0:
-            total_rows = int(response_json['total_rows'])
-            
-        start_row += len(response_json['msg'])
-        
-        if start_row >= total_rows:
-            done = True
+# Make a query to the api, yielding rows as they arrive.  The first page
+# tells us how many rows there are in total; the remaining pages are then
+# fetched concurrently, a few at a time, and yielded in order.  With
+# adaptive=True the page size for the remaining pages is chosen from how
+# long the first page took.
+def query_iter(query_string, rows_per_query=2000, num_threads=QUERY_THREADS, adaptive=False):
+    start_time = time.time()
+    rows, total_rows = query_page(query_string, 0, rows_per_query)
+    elapsed = time.time() - start_time
+
+    for row in rows:
+        yield row
+
+    start_row = len(rows)
+    if start_row >= total_rows or not rows:
+        return
+
+    # The server returned fewer rows than asked for, so that is its limit.
+    page_limit = len(rows) if len(rows) < rows_per_query else None
+    rows_per_query = min(rows_per_query, len(rows))
+
+    # Adaptive pages never exceed the server's limit, since short pages would
+    # have to be finished by sequential follow-up requests.
+    if adaptive:
+        rows_per_second = len(rows) / max(elapsed, 1e-3)
+        rows_per_query = int(min(max(rows_per_second * TARGET_PAGE_SECONDS, MIN_ROWS_PER_QUERY), MAX_ROWS_PER_QUERY))
+        if page_limit is not None:
+            rows_per_query = min(rows_per_query, page_limit)
+
+    page_starts = range(start_row, total_rows, rows_per_query)
+    fetch = lambda page_start: query_rows(query_string, page_start, min(rows_per_query, total_rows - page_start))
+
+    # Only a few pages are fetched ahead of the consumer, so memory use does
+    # not depend on the size of the result.
+    pool = ThreadPool(min(num_threads, len(page_starts)))
+    try:
+        for i in xrange(0, len(page_starts), num_threads):
+            for page in pool.map(fetch, page_starts[i:i+num_threads]):
+                for row in page:
+                    yield row
+    finally:
+        pool.close()
 
-    return rows
+# Make a query to the api, downloading all rows and packaging them into an array.
+def query(query_string, rows_per_query=2000, num_threads=QUERY_THREADS, adaptive=False):
+    return list(query_iter(query_string, rows_per_query, num_threads, adaptive))
         
 # Download a zip file containing the grid data for a section data set.
-# Return the results as an array.
-def download_grid_file(section_data_set_id, file_prefix=''):
+# Return the names of the saved mhd and raw files.  If a manifest is given,
+# the files are only downloaded if the manifest does not list them as
+# complete and from the given version of the data set.
+def download_grid_file(section_data_set_id, file_prefix='', manifest=None, version=None):
     # Decide what to call the mhd/raw when we save them.
     energy_mhd_file_name = '%s%d_energy.mhd' % (file_prefix, section_data_set_id)
-    energy_raw_file_name = '%s%d_energy.raw' % (file_prefix, section_data_set_id)
+    energy_raw_file_name = volume_data_file_name('%s%d_energy' % (file_prefix, section_data_set_id))
 
-    if os.path.exists(energy_raw_file_name) and os.path.exists(energy_raw_file_name):
-        return os.path.basename(energy_mhd_file_name), os.path.basename(energy_raw_file_name)
+    current = current_volume_data_file(energy_mhd_file_name, energy_raw_file_name, manifest, version, 'energy', section_data_set_id)
+    if current:
+        return os.path.basename(energy_mhd_file_name), os.path.basename(current)
 
     url = GRID_URL_FORMAT % (section_data_set_id)
-    print url
-    zf = zipfile.ZipFile(read_url(url))
-    
-    header = zf.read('energy.mhd')
-    raw = zf.read('energy.raw')
-
-    # Update the mhd to use the new raw file name.
-    header = header.replace('energy.raw', os.path.basename(energy_raw_file_name))
+    instrument.event('download.grid_file', data_set_id=section_data_set_id, url=url)
 
-    with open(energy_mhd_file_name, 'w') as f:
-        f.write(header)
+    download_volume(url, ["energy"], energy_mhd_file_name, energy_raw_file_name)
 
-    with open(energy_raw_file_name, 'wb') as f:
-        f.write(raw)
+    if manifest:
+        manifest.record('energy', section_data_set_id, [energy_raw_file_name, energy_mhd_file_name], version)
 
     return os.path.basename(energy_mhd_file_name), os.path.basename(energy_raw_file_name)
 
@@ -93,14 +282,16 @@ def download_structures(graph_id):
     return results
 
 # Download the annotated volume file for a gien reference space.
-def download_annotation_volume(reference_space_id, file_prefix):
+def download_annotation_volume(reference_space_id, file_prefix, manifest=None):
 
     # Decide what to call the mhd/raw when we save them.
     annot_mhd_file_name = '%s%d_annotation.mhd' % (file_prefix, reference_space_id)
-    annot_raw_file_name = '%s%d_annotation.raw' % (file_prefix, reference_space_id)
+    annot_raw_file_name = volume_data_file_name('%s%d_annotation' % (file_prefix, reference_space_id))
 
-    if os.path.exists(annot_raw_file_name) and os.path.exists(annot_mhd_file_name):
-        return os.path.basename(annot_mhd_file_name), os.path.basename(annot_raw_file_name)
+    # Without a manifest, files on disk are assumed to be complete.
+    current = None if manifest else current_volume_data_file(annot_mhd_file_name, annot_raw_file_name)
+    if current:
+        return os.path.basename(annot_mhd_file_name), os.path.basename(current)
     
     # Each reference space has a well known file called 'gridAnnotation.zip'. 
     # Query the API for the link to that file.
@@ -108,47 +299,35 @@ def download_annotation_volume(reference_space_id, file_prefix):
     refspace = results[0]
     reffile = refspace['well_known_files'][0]
 
+    # The download link identifies the file, so it serves as the version.
+    version = reffile["download_link"]
+    current = current_volume_data_file(annot_mhd_file_name, annot_raw_file_name, manifest, version, 'annotation', reference_space_id) if manifest else None
+    if current:
+        return os.path.basename(annot_mhd_file_name), os.path.basename(current)
+
     # Download the zip file.
-    url = API_HOST + reffile["download_link"]    
-    zf = zipfile.ZipFile(read_url(url))
+    url = API_HOST + reffile["download_link"]
 
     # Unzip it and pull out the header and raw file.  Due to inconsistent naming conventions, this could
     # either be just gridAnnotation.{mhd|raw} or gridAnnotation/gridAnnotation.{mdh|raw}
-    header = None
-    raw = None
-    for annot_prefix in ["gridAnnotation","gridAnnotation/gridAnnotation"]:
-        try:
-            header = zf.read('%s.mhd' % annot_prefix)
-            raw = zf.read('%s.raw' % annot_prefix)
-            break
-        except:
-            pass
-    
-    assert header, "Failed to unzip grid annotation header file"
-    assert raw, "Failed to unzip grid annotation raw file"
-
-
-    # Update the mhd to use the new raw file name.
-    header = header.replace('gridAnnotation.raw', os.path.basename(annot_raw_file_name))
-
-    # Save them.
-    with open(annot_mhd_file_name, 'w') as f:
-        f.write(header)
+    download_volume(url, ["gridAnnotation","gridAnnotation/gridAnnotation"], annot_mhd_file_name, annot_raw_file_name)
 
-    with open(annot_raw_file_name, 'wb') as f:
-        f.write(raw)
+    if manifest:
+        manifest.record('annotation', reference_space_id, [annot_raw_file_name, annot_mhd_file_name], version)
 
     return os.path.basename(annot_mhd_file_name), os.path.basename(annot_raw_file_name)
 
 # Download the annotated volume file for a gien reference space.
-def download_atlas_volume(reference_space_id, file_prefix):
+def download_atlas_volume(reference_space_id, file_prefix, manifest=None):
 
     # Decide what to call the mhd/raw when we save them.
     atlas_mhd_file_name = '%s%d_atlas.mhd' % (file_prefix, reference_space_id)
-    atlas_raw_file_name = '%s%d_atlas.raw' % (file_prefix, reference_space_id)
+    atlas_raw_file_name = volume_data_file_name('%s%d_atlas' % (file_prefix, reference_space_id))
 
-    if os.path.exists(atlas_raw_file_name) and os.path.exists(atlas_mhd_file_name):
-        return os.path.basename(atlas_mhd_file_name), os.path.basename(atlas_raw_file_name)
+    # Without a manifest, files on disk are assumed to be complete.
+    current = None if manifest else current_volume_data_file(atlas_mhd_file_name, atlas_raw_file_name)
+    if current:
+        return os.path.basename(atlas_mhd_file_name), os.path.basename(current)
     
     # Each reference space has a well known file called 'atlasVolume.zip'. 
     # Query the API for the link to that file.
@@ -156,35 +335,21 @@ def download_atlas_volume(reference_space_id, file_prefix):
     refspace = results[0]
     reffile = refspace['well_known_files'][0]
 
+    # The download link identifies the file, so it serves as the version.
+    version = reffile["download_link"]
+    current = current_volume_data_file(atlas_mhd_file_name, atlas_raw_file_name, manifest, version, 'atlas', reference_space_id) if manifest else None
+    if current:
+        return os.path.basename(atlas_mhd_file_name), os.path.basename(current)
+
     # Download the zip file.
-    url = API_HOST + reffile["download_link"]    
-    zf = zipfile.ZipFile(read_url(url))
+    url = API_HOST + reffile["download_link"]
 
     # Unzip it and pull out the header and raw file.  Due to inconsistent naming conventions, this could
     # either be just atlasVolume.{mhd|raw} or atlasVolume/atlasVolume.{mdh|raw}
-    header = None
-    raw = None
-    for atlas_prefix in ["atlasVolume","atlasVolume/atlasVolume"]:
-        try:
-            header = zf.read('%s.mhd' % atlas_prefix)
-            raw = zf.read('%s.raw' % atlas_prefix)
-            break
-        except:
-            pass
-    
-    assert header, "Failed to unzip atlas volume header file"
-    assert raw, "Failed to unzip atlas volume raw file"
+    download_volume(url, ["atlasVolume","atlasVolume/atlasVolume"], atlas_mhd_file_name, atlas_raw_file_name)
 
-
-    # Update the mhd to use the new raw file name.
-    header = header.replace('atlasVolume.raw', os.path.basename(atlas_raw_file_name))
-
-    # Save them.
-    with open(atlas_mhd_file_name, 'w') as f:
-        f.write(header)
-
-    with open(atlas_raw_file_name, 'wb') as f:
-        f.write(raw)   
+    if manifest:
+        manifest.record('atlas', reference_space_id, [atlas_raw_file_name, atlas_mhd_file_name], version)
 
     return os.path.basename(atlas_mhd_file_name), os.path.basename(atlas_raw_file_name)
 
@@ -204,8 +369,242 @@ def download_gene_classifications(gene_ids):
 # the developmental stage of a single data set.
 def download_unionizes(data_set_id, graph_id):
     return query("model::StructureUnionize,rma::criteria,[section_data_set_id$eq%d],structure[graph_id$eq%d]" % (data_set_id, graph_id) )
+
+# Count the structure unionizes of a data set without downloading them.
+def count_unionizes(data_set_id, graph_id):
+    rows, total_rows = query_page("model::StructureUnionize,rma::criteria,[section_data_set_id$eq%d],structure[graph_id$eq%d]" % (data_set_id, graph_id), 0, 1)
+    return total_rows
+
+# Download the structure unionizes of many data sets, using one query per
+# batch of data set IDs instead of one per data set.  Results are ordered by
+# ID so that concurrently fetched pages are consistent.  Returns a
+# dictionary mapping each data set ID to its list of unionizes.
+def download_unionizes_batch(data_set_ids, graph_id, batch_size=UNIONIZE_BATCH_SIZE):
+    unionizes = { data_set_id: [] for data_set_id in data_set_ids }
+    data_set_ids = sorted(unionizes)
+
+    for i in xrange(0, len(data_set_ids), batch_size):
+        id_str = ','.join(str(data_set_id) for data_set_id in data_set_ids[i:i+batch_size])
+        results = query_iter(("model::StructureUnionize,rma::criteria,[section_data_set_id$in%s],structure[graph_id$eq%d]" +
+                              ",rma::options[order$eq'structure_unionizes.id']") % (id_str, graph_id))
+
+        for u in results:
+            unionizes[u['section_data_set_id']].append(u)
+
+    return unionizes
     
+# Download a url into an anonymous temporary file, which is returned
+# positioned at the start.  The file is deleted when it is closed.
 def read_url(url):
+    if rate_limiter:
+        rate_limiter.wait(urlparse.urlparse(url).netloc)
+
     usock = urllib.urlopen(url)
-    data = StringIO.StringIO(usock.read())
+    data = tempfile.TemporaryFile()
+
+    try:
+        shutil.copyfileobj(usock, data, COPY_CHUNK_SIZE)
+    except:
+        data.close()
+        raise
+    finally:
+        usock.close()
+
+    data.seek(0)
     return data
+
+# Download a url, resuming from a partially downloaded file if one exists.
+# The partial file is returned open for reading once it is complete; the
+# caller is responsible for removing it.  An IOError is raised if the
+# transfer ends before the advertised length, leaving the partial file in
+# place for the next attempt.
+def read_url_resumable(url, partial_file_name):
+    offset = os.path.getsize(partial_file_name) if os.path.exists(partial_file_name) else 0
+
+    request = urllib2.Request(url)
+    if offset > 0:
+        request.add_header('Range', 'bytes=%d-' % offset)
+
+    if rate_limiter:
+        rate_limiter.wait(urlparse.urlparse(url).netloc)
+
+    start_time = time.time()
+    try:
+        usock = urllib2.urlopen(request)
+    except urllib2.HTTPError as e:
+        # The partial file is no longer a prefix of the resource.  Start over.
+        if e.code == 416 and offset > 0:
+            os.remove(partial_file_name)
+            return read_url_resumable(url, partial_file_name)
+        raise
+
+    try:
+        # The server may ignore the range and send the whole file.
+        if offset > 0 and usock.getcode() != 206:
+            offset = 0
+
+        content_length = usock.info().getheader('Content-Length')
+
+        with open(partial_file_name, 'ab' if offset > 0 else 'wb') as f:
+            shutil.copyfileobj(usock, f, COPY_CHUNK_SIZE)
+            received = f.tell() - offset
+    finally:
+        usock.close()
+
+    instrument.record('http.download', time.time() - start_time, { 'url': url, 'offset': offset })
+    instrument.count('http.download_bytes', received)
+
+    if content_length is not None and received != int(content_length):
+        raise IOError("Truncated download of %s: received %d of %s bytes" % (url, received, content_length))
+
+    return open(partial_file_name, 'rb')
+
+# Download a zip file containing a MetaImage volume and extract it.  The zip
+# file is kept next to the raw file while it downloads, so an interrupted
+# transfer can be resumed.
+def download_volume(url, prefixes, mhd_file_name, raw_file_name):
+    partial_file_name = re.sub(r'\.(raw|cvol)$', '', raw_file_name) + '.zip.part'
+
+    try:
+        with read_url_resumable(url, partial_file_name) as data:
+            with zipfile.ZipFile(data) as zf:
+                with instrument.timer('zip.extract', file_name=raw_file_name):
+                    extract_volume(zf, prefixes, mhd_file_name, raw_file_name)
+    except zipfile.BadZipfile:
+        # The archive was complete but corrupt, so don't resume from it.
+        os.remove(partial_file_name)
+        raise
+
+    os.remove(partial_file_name)
+
+# The data file names a volume may have in either storage form, the
+# configured one first.
+def volume_data_file_names(data_file_name):
+    base = re.sub(r'\.(raw|cvol)$', '', data_file_name)
+    return [ data_file_name ] + [ name for name in [ base + '.raw', base + '.cvol' ] if name != data_file_name ]
+
+# Find the data file of a complete, downloaded volume, in either storage
+# form, so that converting a volume (see chunked_volume.py) or changing
+# --storage does not cause a re-download.  With a manifest, both files must
+# be recorded with the given version and match their recorded sizes, or be
+# adopted into the manifest as the 'artifact' of 'source_id' (see
+# manifest.py).  Without one, both files need only exist.  Returns None if
+# there is no such volume.
+def current_volume_data_file(mhd_file_name, raw_file_name, manifest=None, version=None, artifact=None, source_id=None):
+    data_file_names = volume_data_file_names(raw_file_name)
+
+    if manifest:
+        for data_file_name in data_file_names:
+            if manifest.is_current([data_file_name, mhd_file_name], version):
+                return data_file_name
+
+        if manifest.adopting and artifact is not None:
+            for data_file_name in data_file_names:
+                if volume_is_complete(mhd_file_name, data_file_name) and \
+                   manifest.adopt(artifact, source_id, [data_file_name, mhd_file_name], version):
+                    return data_file_name
+    else:
+        for data_file_name in data_file_names:
+            if os.path.exists(data_file_name) and os.path.exists(mhd_file_name):
+                return data_file_name
+
+    return None
+
+# Bytes per voxel of each MetaImage element type.
+ELEMENT_SIZES = {
+    'MET_CHAR': 1, 'MET_UCHAR': 1,
+    'MET_SHORT': 2, 'MET_USHORT': 2,
+    'MET_INT': 4, 'MET_UINT': 4, 'MET_LONG': 4, 'MET_ULONG': 4,
+    'MET_LONG_LONG': 8, 'MET_ULONG_LONG': 8,
+    'MET_FLOAT': 4, 'MET_DOUBLE': 8
+}
+
+# Does a volume on disk, which may predate the manifest, look whole?  Both
+# files must exist, the header must refer to the data file, and a raw file
+# must be as large as the header says.  Chunked files are only ever renamed
+# into place once complete.
+def volume_is_complete(mhd_file_name, raw_file_name):
+    if not os.path.exists(mhd_file_name) or not os.path.exists(raw_file_name):
+        return False
+
+    with open(mhd_file_name) as f:
+        fields = dict(line.split('=', 1) for line in f if '=' in line)
+    fields = dict((k.strip(), v.strip()) for k, v in fields.iteritems())
+
+    if fields.get('ElementDataFile') != os.path.basename(raw_file_name):
+        return False
+
+    if not raw_file_name.endswith('.raw'):
+        return True
+
+    try:
+        num_voxels = reduce(lambda a, b: a * b, [ int(d) for d in fields['DimSize'].split() ], 1)
+        expected = int(fields.get('HeaderSize', 0)) + num_voxels * int(fields.get('ElementNumberOfChannels', 1)) * ELEMENT_SIZES[fields['ElementType']]
+    except (KeyError, ValueError):
+        return False
+
+    return os.path.getsize(raw_file_name) == expected
+
+# Extract a MetaImage header/raw pair from a zip file.  The raw file member is
+# looked for under each of the prefixes in turn (e.g. 'energy' for
+# 'energy.mhd' and 'energy.raw').  The header is updated to refer to the new
+# raw file name.  The raw file is written before the header, so a header on
+# disk implies that its raw file is complete.
+def extract_volume(zf, prefixes, mhd_file_name, raw_file_name):
+    names = set(zf.namelist())
+    prefix = next((p for p in prefixes if ('%s.mhd' % p) in names and ('%s.raw' % p) in names), None)
+    assert prefix, "Failed to find %s in zip file" % ' or '.join('%s.{mhd|raw}' % p for p in prefixes)
+
+    header = zf.read('%s.mhd' % prefix)
+
+    # Update the mhd to use the new raw file name.
+    header = header.replace(os.path.basename(prefix) + '.raw', os.path.basename(raw_file_name))
+
+    if raw_file_name.endswith('.cvol'):
+        # Imported here so that only chunked storage needs numpy.
+        import numpy as np
+        import chunked_volume
+        import metaimage
+
+        fields = metaimage.parse_header(header)
+        assert int(fields.get('HeaderSize', 0)) == 0 and int(fields.get('ElementNumberOfChannels', 1)) == 1, \
+            "%s can not be stored chunked" % prefix
+
+        byte_order = '>' if fields.get('ElementByteOrderMSB', fields.get('BinaryDataByteOrderMSB')) == 'True' else '<'
+        dtype = np.dtype(metaimage.ELEMENT_TYPES[fields['ElementType']]).newbyteorder(byte_order)
+        shape = tuple(reversed([ int(d) for d in fields['DimSize'].split() ]))
+
+        with zf.open('%s.raw' % prefix) as raw:
+            chunked_volume.write_stream(raw_file_name, raw, shape, dtype, codec=volume_codec)
+
+        chunked_volume.write_header(mhd_file_name, header, os.path.basename(raw_file_name))
+        return
+
+    with zf.open('%s.raw' % prefix) as raw:
+        write_file_atomically(raw_file_name, raw)
+
+    write_file_atomically(mhd_file_name, StringIO.StringIO(header))
+
+# Copy a file object to a temporary file next to its destination, then rename
+# it into place, so the destination is never seen partially written.
+def write_file_atomically(file_name, source):
+    directory = os.path.dirname(os.path.abspath(file_name))
+    temp = tempfile.NamedTemporaryFile(dir=directory, prefix='.' + os.path.basename(file_name), suffix='.part', delete=False)
+
+    try:
+        with instrument.timer('file.write', file_name=file_name):
+            with temp:
+                shutil.copyfileobj(source, temp, COPY_CHUNK_SIZE)
+                instrument.count('file.bytes_written', temp.tell())
+            rename_into_place(temp.name, file_name)
+    except:
+        if os.path.exists(temp.name):
+            os.remove(temp.name)
+        raise
+
+# Rename a file over another.  os.rename is atomic on POSIX systems, but on
+# Windows it fails if the destination exists.
+def rename_into_place(source_file_name, file_name):
+    if os.name == 'nt' and os.path.exists(file_name):
+        os.remove(file_name)
+    os.rename(source_file_name, file_name)
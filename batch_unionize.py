@@ -0,0 +1,108 @@
+import argparse
+import csv
+import os
+import metaimage
+import ontology
+import sparse_energy
+import unionize
+
+# This script computes structure unionizes for every probe of a single
+# developmental stage.  All of the probes in a stage share one annotation
+# volume, so the annotation is indexed once (and cached next to the
+# annotation volume, see unionize.cached_label_index) and every energy
+# volume listed in 'meta/data_sets.csv' for that stage is streamed through
+# the index.  The results are written to one combined CSV.
+#
+# With --sparse, each probe is unionized from its sparse energy volume (see
+# sparse_energy.py, built on first use), so the work done per probe is
+# proportional to its expressing voxels.
+#
+# Run this script from within the directory where you downloaded the data
+# set, e.g.:
+#
+#    $ python batch_unionize.py E13.5
+
+DATA_SETS_CSV = 'meta/data_sets.csv'
+ONTOLOGY_FILE_NAME = 'meta/structures.csv'
+ENERGY_DIRECTORY = 'energy/'
+ANNOTATION_DIRECTORY = 'annotation/'
+OUTPUT_DIRECTORY = 'batch_unionizes/'
+
+OUTPUT_HEADERS = ['section_data_set_id', 'structure_id'] + unionize.UNIONIZE_FIELDS
+
+# Read the rows of data_sets.csv that belong to one stage.  A stage can be
+# given either as a reference space database ID or as an age name such as
+# 'P14', which is matched against the reference space name.
+def read_stage_data_sets(file_name, stage):
+    with open(file_name, 'rb') as f:
+        rows = list(csv.DictReader(f))
+
+    if stage.isdigit():
+        return [ r for r in rows if int(r['reference_space_database_id']) == int(stage) ]
+    else:
+        return [ r for r in rows if stage in r['reference_space_name'].split() or r['reference_space_name'] == stage ]
+
+# Unionize a list of data sets that share an annotation volume and write the
+# results to a single CSV.  Returns the number of rows written.
+def batch_unionize(data_sets, o, output_file_name,
+                   energy_directory=ENERGY_DIRECTORY, annotation_directory=ANNOTATION_DIRECTORY, sparse=False):
+    annotation_file_names = set(d['annotation_file_name'] for d in data_sets)
+    assert len(annotation_file_names) == 1, "data sets do not share an annotation volume"
+
+    annotation_file_name = annotation_directory + annotation_file_names.pop()
+    annotation = metaimage.MetaImage(annotation_file_name)
+    # The sparse path only needs each label's voxel count, not the per-voxel
+    # permutation.
+    if sparse:
+        labels, starts, num_voxels = unionize.cached_label_starts(annotation_file_name)
+    else:
+        labels, starts, order = unionize.cached_label_index(annotation_file_name)
+
+    num_rows = 0
+    with open(output_file_name, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(OUTPUT_HEADERS)
+
+        for data_set in data_sets:
+            energy_file_name = energy_directory + data_set['energy_file_name']
+            energy = metaimage.MetaImage(energy_file_name)
+            metaimage.check_same_grid(energy, annotation)
+
+            if sparse:
+                stats = sparse_energy.label_statistics(sparse_energy.load_sparse(energy_file_name, annotation_file_name),
+                                                       labels, starts, num_voxels)
+            else:
+                stats = unionize.label_statistics(energy.flat, labels, starts, order)
+
+            totals = unionize.rollup(o, labels, stats)
+
+            for structure_id in sorted(totals):
+                total = totals[structure_id]
+                writer.writerow([data_set['section_data_set_database_id'], structure_id] +
+                                [total[field] for field in unionize.UNIONIZE_FIELDS])
+                num_rows += 1
+
+            print data_set['section_data_set_database_id']
+
+    return num_rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Unionize every probe of a developmental stage.")
+    parser.add_argument('stage', help="reference space database ID or age name (e.g. P14)")
+    parser.add_argument('--output', help="output CSV (default: %s<reference space id>_unionizes.csv)" % OUTPUT_DIRECTORY)
+    parser.add_argument('--sparse', action='store_true', help="unionize from sparse energy volumes")
+    args = parser.parse_args()
+
+    data_sets = read_stage_data_sets(DATA_SETS_CSV, args.stage)
+    assert data_sets, "no data sets found for stage %s" % args.stage
+
+    output_file_name = args.output
+    if output_file_name is None:
+        if not os.path.exists(OUTPUT_DIRECTORY):
+            os.makedirs(OUTPUT_DIRECTORY)
+        output_file_name = '%s%s_unionizes.csv' % (OUTPUT_DIRECTORY, data_sets[0]['reference_space_database_id'])
+
+    o = ontology.load(ONTOLOGY_FILE_NAME, ontology.Ontology.DEVELOPING_MOUSE_ROOT_STRUCTURE_ID)
+
+    num_rows = batch_unionize(data_sets, o, output_file_name, sparse=args.sparse)
+    print "wrote %d rows for %d data sets to %s" % (num_rows, len(data_sets), output_file_name)
@@ -0,0 +1,371 @@
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+import zipfile
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from multiprocessing import Pipe, Process
+import numpy as np
+import api
+import batch_unionize
+import metaimage
+import ontology
+import unionize
+from scheduler import DownloadScheduler
+
+# Benchmarks for the download and analysis paths that run without the Allen
+# Brain Atlas API.  A scratch directory is filled with a synthetic data set
+# (structures.csv with a realistically deep ontology, an annotation volume
+# and energy volumes, all at a configurable scale), and a local mock server
+# stands in for the API: it answers paged query.json requests with at most
+# 'page_limit' rows per page, and serves zipped energy volumes from
+# grid_data/download/<id>, each after a configurable latency.
+#
+# Each benchmark runs in its own process so that its peak memory can be
+# measured.  Results are printed (or written with --output) as JSON, and
+# can be compared against an earlier run to catch regressions:
+#
+#    $ python benchmark.py --scale small --output baseline.json
+#    $ python benchmark.py --scale small --compare baseline.json
+#
+# The benchmarks are:
+#
+#    - ontology_csv: parse structures.csv (ontology.read_from_csv)
+#    - ontology_snapshot: load the ontology from its snapshot (ontology.load)
+#    - query: page through a large query with api.query
+#    - download: fetch and extract grid files with api.download_grid_file
+#      through a DownloadScheduler
+#    - unionize: unionize one probe, building the annotation's label index
+#    - batch_unionize: unionize every probe with the cached label index
+
+# Sizes of the synthetic data set.  Volume shapes are [z, y, x].
+SCALES = {
+    'small': { 'shape': [48, 40, 56], 'num_structures': 500, 'max_depth': 8,
+               'num_probes': 4, 'query_rows': 10000, 'num_grid_files': 8 },
+    'medium': { 'shape': [96, 80, 112], 'num_structures': 2500, 'max_depth': 11,
+                'num_probes': 16, 'query_rows': 50000, 'num_grid_files': 32 },
+    'large': { 'shape': [192, 160, 224], 'num_structures': 10000, 'max_depth': 14,
+               'num_probes': 32, 'query_rows': 200000, 'num_grid_files': 64 }
+}
+
+BENCHMARKS = ['ontology_csv', 'ontology_snapshot', 'query', 'download', 'unionize', 'batch_unionize']
+
+ROOT_STRUCTURE_ID = ontology.Ontology.DEVELOPING_MOUSE_ROOT_STRUCTURE_ID
+REFERENCE_SPACE_ID = 1
+FIRST_DATA_SET_ID = 100000000
+
+# The API's maximum page size.
+PAGE_LIMIT = 2000
+
+# Fraction of tissue voxels with no expression.
+ZERO_FRACTION = 0.8
+
+# Write a structures.csv describing a random tree.  Each new structure's
+# parent is picked from recently added structures, which gives long,
+# branching lineages like those of the developing mouse ontology rather
+# than a shallow, bushy tree.  Returns the IDs of the structures.
+def synthetic_structures(file_name, num_structures, max_depth, seed=0):
+    rng = random.Random(seed)
+
+    ids = [ ROOT_STRUCTURE_ID ]
+    paths = { ROOT_STRUCTURE_ID: '/%d/' % ROOT_STRUCTURE_ID }
+    depths = { ROOT_STRUCTURE_ID: 0 }
+    rows = [ [ROOT_STRUCTURE_ID, 'root', 'root', 0, 0, 'FFFFFF', paths[ROOT_STRUCTURE_ID]] ]
+
+    for i in xrange(1, num_structures):
+        candidates = [ sid for sid in ids[-25:] if depths[sid] < max_depth ] or [ ROOT_STRUCTURE_ID ]
+        parent = rng.choice(candidates)
+        sid = ROOT_STRUCTURE_ID + i
+
+        ids.append(sid)
+        depths[sid] = depths[parent] + 1
+        paths[sid] = '%s%d/' % (paths[parent], sid)
+        rows.append([sid, 'structure %d' % sid, 's%d' % sid, i, depths[sid], '%06X' % rng.randrange(0x1000000), paths[sid]])
+
+    with open(file_name, 'wb') as f:
+        f.write('database_id,name,acronym,order,level,color,structure_database_id_path\n')
+        for row in rows:
+            f.write(','.join(str(v) for v in row) + '\n')
+
+    return ids
+
+# Make an annotation volume: an ellipsoid of tissue divided into blocky
+# regions, each labeled with a random structure.
+def synthetic_annotation(shape, structure_ids, seed=0):
+    rng = np.random.RandomState(seed)
+
+    coarse_shape = [ max(n // 4, 1) for n in shape ]
+    coarse = rng.choice(np.array(structure_ids, dtype=np.uint32), size=coarse_shape)
+    labels = coarse.repeat(4, axis=0).repeat(4, axis=1).repeat(4, axis=2)
+    labels = np.pad(labels, [ (0, n - m) for n, m in zip(shape, labels.shape) ], mode='edge')[:shape[0], :shape[1], :shape[2]]
+
+    z, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    outside = sum(((c - n / 2.0) / (n / 2.0)) ** 2 for c, n in zip((z, y, x), shape)) > 1
+    labels[outside] = 0
+
+    return labels.astype(np.uint32)
+
+# Make an energy volume: mostly zero inside the tissue, -1 (no data)
+# outside it.
+def synthetic_energy(annotation, seed=0):
+    rng = np.random.RandomState(seed)
+    energy = rng.lognormal(0, 1, size=annotation.shape).astype(np.float32)
+    energy[rng.random_sample(annotation.shape) < ZERO_FRACTION] = 0
+    energy[annotation == 0] = -1
+    return energy
+
+# Fill a directory with a synthetic data set laid out like a download.
+def generate(directory, scale):
+    config = SCALES[scale]
+    for subdirectory in ['meta', 'energy', 'annotation', 'grid']:
+        if not os.path.exists(os.path.join(directory, subdirectory)):
+            os.makedirs(os.path.join(directory, subdirectory))
+
+    structure_ids = synthetic_structures(os.path.join(directory, 'meta/structures.csv'),
+                                         config['num_structures'], config['max_depth'])
+
+    annotation = synthetic_annotation(config['shape'], structure_ids)
+    annotation_file_name = '%d_annotation.mhd' % REFERENCE_SPACE_ID
+    metaimage.write_metaimage(os.path.join(directory, 'annotation', annotation_file_name), annotation, (200.0, 200.0, 200.0))
+
+    with open(os.path.join(directory, 'meta/data_sets.csv'), 'wb') as f:
+        f.write('section_data_set_database_id,gene_acronym,energy_file_name,reference_space_database_id,'
+                'reference_space_name,annotation_file_name\n')
+        for i in xrange(config['num_probes']):
+            data_set_id = FIRST_DATA_SET_ID + i
+            energy_file_name = '%d_energy.mhd' % data_set_id
+            metaimage.write_metaimage(os.path.join(directory, 'energy', energy_file_name),
+                                      synthetic_energy(annotation, seed=i), (200.0, 200.0, 200.0))
+            f.write('%d,G%d,%s,%d,P14,%s\n' % (data_set_id, i, energy_file_name, REFERENCE_SPACE_ID, annotation_file_name))
+
+    # The archive served for every grid file download.
+    energy_file_name = os.path.join(directory, 'energy', '%d_energy' % FIRST_DATA_SET_ID)
+    with zipfile.ZipFile(os.path.join(directory, 'grid', 'energy.zip'), 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.write(energy_file_name + '.mhd', 'energy.mhd')
+        zf.write(energy_file_name + '.raw', 'energy.raw')
+
+# A stand-in for the API server.  Query rows are made up on the fly; every
+# grid file download returns the same archive.
+class MockAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, body, content_type):
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        fields = urlparse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])))
+        start_row = int(fields['start_row'][0])
+        num_rows = min(int(fields['num_rows'][0]), self.server.page_limit)
+        end_row = min(start_row + num_rows, self.server.total_rows)
+
+        rows = [ { 'id': i, 'section_data_set_id': FIRST_DATA_SET_ID + i % 16, 'structure_id': ROOT_STRUCTURE_ID + i % 500,
+                   'expression_energy': (i % 97) / 7.0, 'sum_expressing_pixel_intensity': i % 1013, 'sum_pixels': i % 4099 }
+                 for i in xrange(start_row, end_row) ]
+
+        self.respond(json.dumps({ 'success': True, 'total_rows': self.server.total_rows, 'msg': rows }), 'application/json')
+
+    def do_GET(self):
+        if not re.match(r'/grid_data/download/\d+$', self.path):
+            self.send_error(404)
+            return
+        self.respond(self.server.grid_archive, 'application/zip')
+
+class MockAPIServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, grid_archive, total_rows, latency=0.0, page_limit=PAGE_LIMIT):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), MockAPIHandler)
+        self.grid_archive = grid_archive
+        self.total_rows = total_rows
+        self.latency = latency
+        self.page_limit = page_limit
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+# The benchmarks.  Each runs in a scratch directory holding a synthetic data
+# set, and returns the number of items it processed and the number of bytes
+# it read or downloaded.
+
+def bench_ontology_csv(config):
+    o = ontology.read_from_csv('meta/structures.csv', ROOT_STRUCTURE_ID)
+    return len(o.structures), os.path.getsize('meta/structures.csv')
+
+def bench_ontology_snapshot(config):
+    o = ontology.load('meta/structures.csv', ROOT_STRUCTURE_ID)
+    return len(o.structures), os.path.getsize(ontology.snapshot_file_name_for('meta/structures.csv'))
+
+def bench_query(config):
+    rows = api.query("model::StructureUnionize,rma::criteria,[section_data_set_id$eq%d]" % FIRST_DATA_SET_ID)
+    assert len(rows) == config['query_rows'], "expected %d rows, got %d" % (config['query_rows'], len(rows))
+    return len(rows), 0
+
+def bench_download(config):
+    if os.path.exists('downloads'):
+        shutil.rmtree('downloads')
+    os.makedirs('downloads')
+
+    scheduler = DownloadScheduler(num_workers=8, report_interval=3600)
+    data_set_ids = range(FIRST_DATA_SET_ID, FIRST_DATA_SET_ID + config['num_grid_files'])
+    for data_set_id in data_set_ids:
+        scheduler.submit(api.download_grid_file, (data_set_id, 'downloads/'))
+
+    failed = [ task for task in scheduler.run() if task.error is not None ]
+    assert not failed, "%d downloads failed" % len(failed)
+
+    return len(data_set_ids), len(data_set_ids) * os.path.getsize('grid/energy.zip')
+
+def bench_unionize(config):
+    annotation_file_name = 'annotation/%d_annotation.mhd' % REFERENCE_SPACE_ID
+    energy_file_name = 'energy/%d_energy.mhd' % FIRST_DATA_SET_ID
+
+    index_file_name = unionize.label_index_file_name(annotation_file_name)
+    if os.path.exists(index_file_name):
+        os.remove(index_file_name)
+
+    o = ontology.load('meta/structures.csv', ROOT_STRUCTURE_ID)
+    unionize.unionize_files(energy_file_name, annotation_file_name, o)
+
+    num_voxels = len(metaimage.MetaImage(energy_file_name))
+    return num_voxels, num_voxels * 4
+
+def bench_batch_unionize(config):
+    data_sets = batch_unionize.read_stage_data_sets('meta/data_sets.csv', 'P14')
+    o = ontology.load('meta/structures.csv', ROOT_STRUCTURE_ID)
+    unionize.cached_label_index('annotation/%d_annotation.mhd' % REFERENCE_SPACE_ID)
+
+    batch_unionize.batch_unionize(data_sets, o, 'batch_unionizes.csv', 'energy/', 'annotation/')
+
+    num_voxels = len(metaimage.MetaImage('energy/' + data_sets[0]['energy_file_name']))
+    return num_voxels * len(data_sets), num_voxels * len(data_sets) * 4
+
+# Peak resident memory of this process in megabytes.  ru_maxrss is in
+# kilobytes on Linux and bytes on Mac OS X.
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+# Run one benchmark in this (child) process and send the results back.
+def run_child(name, directory, config, api_host, connection):
+    try:
+        os.chdir(directory)
+        api.set_api_host(api_host)
+        sys.stdout = open(os.devnull, 'w')
+
+        baseline_mb = peak_rss_mb()
+        start_time = time.time()
+        items, num_bytes = globals()['bench_' + name](config)
+        seconds = time.time() - start_time
+
+        connection.send({ 'seconds': seconds, 'items': items, 'bytes': num_bytes,
+                          'peak_rss_mb': peak_rss_mb(), 'baseline_rss_mb': baseline_mb })
+    except Exception as e:
+        connection.send({ 'error': '%s: %s' % (type(e).__name__, e) })
+
+# Run a benchmark 'repeat' times in fresh processes.  Reports the fastest
+# time and the largest peak memory.
+def run_benchmark(name, directory, config, api_host, repeat=1):
+    runs = []
+    for i in xrange(repeat):
+        parent_connection, child_connection = Pipe()
+        process = Process(target=run_child, args=(name, directory, config, api_host, child_connection))
+        process.start()
+        result = parent_connection.recv()
+        process.join()
+
+        if 'error' in result:
+            return result
+        runs.append(result)
+
+    best = min(runs, key=lambda r: r['seconds'])
+    seconds = max(best['seconds'], 1e-9)
+    return { 'seconds': best['seconds'],
+             'items': best['items'],
+             'items_per_second': best['items'] / seconds,
+             'megabytes_per_second': best['bytes'] / seconds / (1024.0 * 1024.0),
+             'peak_rss_mb': max(r['peak_rss_mb'] for r in runs),
+             'peak_rss_increase_mb': max(r['peak_rss_mb'] - r['baseline_rss_mb'] for r in runs) }
+
+# Compare results with a baseline.  Returns a list of benchmarks that are
+# slower, or use more memory, by more than 'tolerance' (a fraction).
+def regressions(results, baseline, tolerance):
+    found = []
+    for name, result in sorted(results.iteritems()):
+        previous = baseline.get(name)
+        if not previous or 'error' in previous or 'error' in result:
+            continue
+
+        for key in ['seconds', 'peak_rss_mb']:
+            if result[key] > previous[key] * (1 + tolerance):
+                found.append("%s: %s went from %.3f to %.3f" % (name, key, previous[key], result[key]))
+    return found
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the download and unionize paths against synthetic data.")
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small', help="size of the synthetic data set")
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help="benchmarks to run")
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds the mock API server waits before each response")
+    parser.add_argument('--page-limit', type=int, default=PAGE_LIMIT, help="maximum rows per query page from the mock API server")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each benchmark; the fastest is reported")
+    parser.add_argument('--directory', help="directory for the synthetic data set (default: a temporary directory)")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="baseline results to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown or memory growth before a regression is reported")
+    args = parser.parse_args()
+
+    config = SCALES[args.scale]
+    directory = args.directory or tempfile.mkdtemp(prefix='benchmark_')
+    if not os.path.exists(os.path.join(directory, 'meta/structures.csv')):
+        generate(directory, args.scale)
+
+    # Build the snapshot up front, so ontology_snapshot measures a warm load.
+    ontology.load(os.path.join(directory, 'meta/structures.csv'), ROOT_STRUCTURE_ID)
+
+    with open(os.path.join(directory, 'grid/energy.zip'), 'rb') as f:
+        server = MockAPIServer(f.read(), config['query_rows'], args.latency, args.page_limit)
+    server.start()
+
+    results = {}
+    try:
+        for name in args.benchmarks:
+            results[name] = run_benchmark(name, directory, config, server.url, args.repeat)
+    finally:
+        server.shutdown()
+        if not args.directory:
+            shutil.rmtree(directory)
+
+    report = { 'scale': args.scale, 'config': config, 'latency': args.latency, 'results': results }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print json.dumps(report, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            found = regressions(results, json.load(f)['results'], args.tolerance)
+        for regression in found:
+            print "regression: %s" % regression
+        sys.exit(1 if found else 0)
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# An on-disk cache of RMA query responses.  Each page of results is stored
+# as a JSON file named after a hash of the query criteria and the paging
+# arguments.  Criteria are normalized first, so whitespace differences
+# between otherwise identical queries don't cause misses.
+#
+# Entries older than the TTL are refetched.  When the cache grows beyond its
+# size limit, the least recently used entries are removed.  In offline mode,
+# entries never expire and a query that is not in the cache fails instead of
+# going to the server.
+#
+# Enable it for everything built on api.py with api.configure_cache.
+
+DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# Remove whitespace outside of quoted values from RMA criteria.
+def normalize_criteria(criteria):
+    parts = criteria.split("'")
+
+    # Every other part is inside quotes.
+    for i in xrange(0, len(parts), 2):
+        parts[i] = ''.join(parts[i].split())
+
+    return "'".join(parts)
+
+class ResponseCache(object):
+
+    def __init__(self, directory, ttl_seconds=DEFAULT_TTL_SECONDS, max_bytes=DEFAULT_MAX_BYTES, offline=False):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.total_bytes = sum(size for file_name, size, last_used in self.entries())
+
+    def file_name(self, criteria, start_row, num_rows):
+        key = '%s|%d|%d' % (normalize_criteria(criteria), start_row, num_rows)
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + '.json')
+
+    # List the (file name, size, last use time) of every entry.
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                file_name = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(file_name)
+                except OSError:
+                    continue
+                entries.append((file_name, stat.st_size, stat.st_mtime))
+        return entries
+
+    # Look up a page of results.  Returns the cached response, or None if
+    # there is no entry or it has expired.
+    def get(self, criteria, start_row, num_rows):
+        file_name = self.file_name(criteria, start_row, num_rows)
+
+        try:
+            with open(file_name, 'rb') as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if not self.offline and time.time() - entry['fetched_at'] > self.ttl_seconds:
+            return None
+
+        # The modification time records when the entry was last used.
+        try:
+            os.utime(file_name, None)
+        except OSError:
+            pass
+
+        return entry['response']
+
+    # Store a page of results, then evict old entries if the cache is too big.
+    def put(self, criteria, start_row, num_rows, response):
+        file_name = self.file_name(criteria, start_row, num_rows)
+        entry = json.dumps({ 'criteria': criteria,
+                             'start_row': start_row,
+                             'num_rows': num_rows,
+                             'fetched_at': time.time(),
+                             'response': response })
+
+        with self.lock:
+            old_size = os.path.getsize(file_name) if os.path.exists(file_name) else 0
+
+            # Write to a temporary file and rename it, so other processes
+            # sharing the cache never read a partial entry.
+            fd, temp_file_name = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(entry)
+            if os.name == 'nt' and os.path.exists(file_name):
+                os.remove(file_name)
+            os.rename(temp_file_name, file_name)
+
+            self.total_bytes += len(entry) - old_size
+
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    # Remove least recently used entries until the cache is within its size
+    # limit.  Must be called with the lock held.
+    def evict(self):
+        entries = self.entries()
+        entries.sort(key=lambda e: e[2])
+
+        self.total_bytes = sum(size for file_name, size, last_used in entries)
+
+        for file_name, size, last_used in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+
+            try:
+                os.remove(file_name)
+                self.total_bytes -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            for file_name, size, last_used in self.entries():
+                os.remove(file_name)
+            self.total_bytes = 0
@@ -0,0 +1,317 @@
+import argparse
+import collections
+import json
+import os
+import re
+import struct
+import tempfile
+import threading
+import zlib
+import numpy as np
+import metaimage
+from manifest import Manifest
+
+# A compressed storage format for volumes.  A volume is split into chunks
+# (32x32x32 voxels by default) and each chunk is compressed on its own, so a
+# reader only decompresses the chunks that a read touches.  Energy volumes
+# are mostly empty and annotation volumes are highly repetitive, so this
+# takes a fraction of the space of a raw file.
+#
+# A .cvol file holds:
+#
+#    - an 8 byte magic string and a 4 byte format version
+#    - a 4 byte length followed by a JSON header giving the data type,
+#      shape [z, y, x], chunk shape and codec
+#    - the offset of each chunk's data (relative to the end of this index),
+#      as 8 byte integers, plus one for the end of the last chunk
+#    - the compressed chunks, ordered by z, then y, then x.  An empty chunk
+#      is all zeros.
+#
+# zlib is always available.  zstd and lz4 are used if the zstandard or lz4
+# packages are installed.
+#
+# A MetaImage header whose ElementDataFile is a .cvol file is read
+# transparently by metaimage.MetaImage, so volumes can be converted in place
+# (or downloaded this way, see api.configure_volume_storage).  Run this
+# file as a script to convert the volumes in some directories:
+#
+#    $ python chunked_volume.py energy/ annotation/ atlas/ --codec zlib
+#
+# Converted volumes that are listed in the download manifest (see
+# manifest.py) are listed again under their new files, so download_data.py
+# still considers them up to date.
+
+# The manifest kept by download_data.py.
+MANIFEST_FILE = 'meta/manifest.sqlite'
+
+CHUNKED_SUFFIX = '.cvol'
+CHUNKED_MAGIC = 'CHUNKVOL'
+CHUNKED_VERSION = 1
+
+DEFAULT_CHUNK_SHAPE = (32, 32, 32)
+
+# Number of decompressed chunks each reader keeps.
+CHUNK_CACHE_SIZE = 64
+
+# Compression functions for each codec, and their default levels.
+CODECS = {
+    'zlib': (lambda data, level: zlib.compress(data, level), zlib.decompress)
+}
+DEFAULT_LEVELS = { 'zlib': 6, 'zstd': 3, 'lz4': 0 }
+
+try:
+    import zstandard
+    CODECS['zstd'] = (lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+                      lambda data: zstandard.ZstdDecompressor().decompress(data))
+except ImportError:
+    pass
+
+try:
+    import lz4.frame
+    CODECS['lz4'] = (lambda data, level: lz4.frame.compress(data, compression_level=level), lz4.frame.decompress)
+except ImportError:
+    pass
+
+# Write a volume as a .cvol file.  'read_slab(z_start, z_end)' returns the
+# planes [z_start, z_end) of the volume as an array, so the volume can be
+# streamed in one row of chunks at a time.  The file is written to a
+# temporary name and renamed into place.
+def write_chunked(file_name, read_slab, shape, dtype, chunk_shape=DEFAULT_CHUNK_SHAPE, codec='zlib', level=None):
+    if codec not in CODECS:
+        raise ValueError("codec %s is not available (have %s)" % (codec, ', '.join(sorted(CODECS))))
+
+    compress = CODECS[codec][0]
+    level = DEFAULT_LEVELS[codec] if level is None else level
+    dtype = np.dtype(dtype)
+
+    grid = [ -(-n // c) for n, c in zip(shape, chunk_shape) ]
+    num_chunks = grid[0] * grid[1] * grid[2]
+
+    header = json.dumps({ 'dtype': dtype.str, 'shape': list(shape), 'chunk_shape': list(chunk_shape), 'codec': codec })
+
+    directory = os.path.dirname(os.path.abspath(file_name))
+    fd, temp_file_name = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(file_name), suffix='.part')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(CHUNKED_MAGIC)
+            f.write(struct.pack('<II', CHUNKED_VERSION, len(header)))
+            f.write(header)
+
+            # Reserve the index, and fill it in once the chunk sizes are known.
+            index_position = f.tell()
+            f.write('\0' * 8 * (num_chunks + 1))
+            data_position = f.tell()
+
+            offsets = [ 0 ]
+            for z in xrange(0, shape[0], chunk_shape[0]):
+                slab = np.asarray(read_slab(z, min(z + chunk_shape[0], shape[0])), dtype=dtype)
+
+                for y in xrange(0, shape[1], chunk_shape[1]):
+                    for x in xrange(0, shape[2], chunk_shape[2]):
+                        chunk = slab[:, y:y + chunk_shape[1], x:x + chunk_shape[2]]
+                        if chunk.any():
+                            f.write(compress(np.ascontiguousarray(chunk).tostring(), level))
+                        offsets.append(f.tell() - data_position)
+
+            f.seek(index_position)
+            f.write(np.array(offsets, dtype='<u8').tostring())
+
+        if os.name == 'nt' and os.path.exists(file_name):
+            os.remove(file_name)
+        os.rename(temp_file_name, file_name)
+    except:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+        raise
+
+# Write an in-memory or memory-mapped array as a .cvol file.
+def write_array(file_name, data, chunk_shape=DEFAULT_CHUNK_SHAPE, codec='zlib', level=None):
+    write_chunked(file_name, lambda z_start, z_end: data[z_start:z_end], data.shape, data.dtype, chunk_shape, codec, level)
+
+# Write a raw volume read from a stream (e.g. a zip file member) as a .cvol
+# file, without holding more than one row of chunks in memory.
+def write_stream(file_name, stream, shape, dtype, chunk_shape=DEFAULT_CHUNK_SHAPE, codec='zlib', level=None):
+    dtype = np.dtype(dtype)
+    plane_bytes = shape[1] * shape[2] * dtype.itemsize
+
+    def read_slab(z_start, z_end):
+        num_bytes = (z_end - z_start) * plane_bytes
+        data = stream.read(num_bytes)
+        if len(data) != num_bytes:
+            raise IOError("volume data ended after %d of %d bytes" % (z_start * plane_bytes + len(data), shape[0] * plane_bytes))
+        return np.frombuffer(data, dtype=dtype).reshape(z_end - z_start, shape[1], shape[2])
+
+    write_chunked(file_name, read_slab, shape, dtype, chunk_shape, codec, level)
+
+# Read access to a .cvol file.  Chunks are decompressed when a read first
+# touches them, and the most recently used are kept.
+class ChunkedVolume(object):
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+        with open(file_name, 'rb') as f:
+            magic = f.read(len(CHUNKED_MAGIC))
+            version, header_length = struct.unpack('<II', f.read(8))
+            if magic != CHUNKED_MAGIC or version != CHUNKED_VERSION:
+                raise ValueError("%s is not a version %d chunked volume" % (file_name, CHUNKED_VERSION))
+
+            header = json.loads(f.read(header_length))
+            self.dtype = np.dtype(str(header['dtype']))
+            self.shape = tuple(header['shape'])
+            self.chunk_shape = tuple(header['chunk_shape'])
+            self.codec = header['codec']
+
+            self.grid = tuple(-(-n // c) for n, c in zip(self.shape, self.chunk_shape))
+            num_chunks = self.grid[0] * self.grid[1] * self.grid[2]
+            self.offsets = np.frombuffer(f.read(8 * (num_chunks + 1)), dtype='<u8').astype(np.int64)
+            self.data_position = f.tell()
+
+        if self.codec not in CODECS:
+            raise ValueError("%s: codec %s is not available; install its package to read this file" % (file_name, self.codec))
+        self.decompress = CODECS[self.codec][1]
+
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.file = open(file_name, 'rb')
+
+    def __len__(self):
+        return int(np.prod(self.shape))
+
+    # Decompress the chunk at chunk coordinates (i, j, k).
+    def chunk(self, i, j, k):
+        key = (i, j, k)
+        with self.lock:
+            if key in self.cache:
+                value = self.cache.pop(key)
+                self.cache[key] = value
+                return value
+
+            number = (i * self.grid[1] + j) * self.grid[2] + k
+            start, end = self.offsets[number], self.offsets[number + 1]
+            chunk_shape = tuple(min(c, n - c * index) for c, n, index in zip(self.chunk_shape, self.shape, key))
+
+            if end == start:
+                value = np.zeros(chunk_shape, dtype=self.dtype)
+            else:
+                self.file.seek(self.data_position + start)
+                value = np.frombuffer(self.decompress(self.file.read(end - start)), dtype=self.dtype).reshape(chunk_shape)
+
+            self.cache[key] = value
+            while len(self.cache) > CHUNK_CACHE_SIZE:
+                self.cache.popitem(last=False)
+            return value
+
+    # Read a block of the volume, decompressing only the chunks it overlaps.
+    # Arguments are slices (or indices) along z, y and x, as for
+    # MetaImage.read_block.
+    def read_block(self, z=slice(None), y=slice(None), x=slice(None)):
+        # The voxels selected along each axis, and the range they span.
+        selections = [ np.arange(n)[key] for key, n in zip((z, y, x), self.shape) ]
+        bounds = [ (int(s.min()), int(s.max()) + 1) if s.size else (0, 0) for s in selections ]
+
+        block = np.empty([ end - start for start, end in bounds ], dtype=self.dtype)
+        ranges = [ xrange(start // c, -(-end // c)) for (start, end), c in zip(bounds, self.chunk_shape) ]
+
+        for i in ranges[0]:
+            for j in ranges[1]:
+                for k in ranges[2]:
+                    chunk = self.chunk(i, j, k)
+                    origin = (i * self.chunk_shape[0], j * self.chunk_shape[1], k * self.chunk_shape[2])
+
+                    # The overlap of the chunk and the block, in volume coordinates.
+                    lower = [ max(o, start) for o, (start, end) in zip(origin, bounds) ]
+                    upper = [ min(o + n, end) for o, n, (start, end) in zip(origin, chunk.shape, bounds) ]
+
+                    block[tuple(slice(l - start, u - start) for l, u, (start, end) in zip(lower, upper, bounds))] = \
+                        chunk[tuple(slice(l - o, u - o) for l, u, o in zip(lower, upper, origin))]
+
+        # Pick out the selected voxels of the range where they are not simply
+        # all of it (indices, steps and reversed slices).
+        for axis in reversed(xrange(3)):
+            selection, (start, end) = selections[axis], bounds[axis]
+            if selection.ndim == 0:
+                block = np.take(block, int(selection) - start, axis=axis)
+            elif len(selection) != end - start or (len(selection) > 1 and selection[1] < selection[0]):
+                block = np.take(block, selection - start, axis=axis)
+        return block
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        return self.read_block(*key)
+
+    # Decompress the whole volume.
+    def read_all(self):
+        return self.read_block()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Convert a MetaImage volume with a raw data file to a .cvol file, and point
+# its header at the new file.  The raw file is removed unless 'keep_raw'.
+# Returns the size of the .cvol file.
+def compress_metaimage(mhd_file_name, chunk_shape=DEFAULT_CHUNK_SHAPE, codec='zlib', level=None, keep_raw=False):
+    image = metaimage.MetaImage(mhd_file_name)
+    assert not image.chunked, "%s is already compressed" % mhd_file_name
+    assert len(image.shape) == 3, "%s: only single channel 3D volumes are supported" % mhd_file_name
+
+    chunked_file_name = re.sub(r'\.mhd$', '', mhd_file_name) + CHUNKED_SUFFIX
+    write_array(chunked_file_name, image.data, chunk_shape, codec, level)
+
+    with open(mhd_file_name, 'r') as f:
+        header = f.read()
+    write_header(mhd_file_name, header, os.path.basename(chunked_file_name))
+
+    if not keep_raw and image.raw_file_name != mhd_file_name:
+        os.remove(image.raw_file_name)
+
+    return os.path.getsize(chunked_file_name)
+
+# Rewrite the text of a MetaImage header to use a .cvol data file, and
+# write it atomically.
+def write_header(mhd_file_name, header, chunked_file_name):
+    header = re.sub(r'(?m)^\s*HeaderSize\s*=.*\n?', '', header)
+    header = re.sub(r'(?m)^(\s*ElementDataFile\s*=\s*).*$', lambda m: m.group(1) + chunked_file_name, header)
+
+    fd, temp_file_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(mhd_file_name)), suffix='.part')
+    with os.fdopen(fd, 'w') as f:
+        f.write(header)
+    if os.name == 'nt' and os.path.exists(mhd_file_name):
+        os.remove(mhd_file_name)
+    os.rename(temp_file_name, mhd_file_name)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert MetaImage volumes to chunked, compressed storage.")
+    parser.add_argument('directories', nargs='+', help="directories of .mhd volumes to convert")
+    parser.add_argument('--codec', choices=sorted(CODECS), default='zlib')
+    parser.add_argument('--level', type=int, default=None, help="compression level (default depends on the codec)")
+    parser.add_argument('--keep-raw', action='store_true', help="keep the raw files after converting")
+    parser.add_argument('--manifest', default=MANIFEST_FILE, help="download manifest to update, if it exists")
+    args = parser.parse_args()
+
+    manifest = Manifest(args.manifest) if os.path.exists(args.manifest) else None
+
+    for directory in args.directories:
+        for file_name in sorted(os.listdir(directory)):
+            mhd_file_name = os.path.normpath(os.path.join(directory, file_name))
+            if not file_name.endswith('.mhd') or metaimage.MetaImage(mhd_file_name).chunked:
+                continue
+
+            image = metaimage.MetaImage(mhd_file_name)
+            chunked_size = compress_metaimage(mhd_file_name, codec=args.codec, level=args.level, keep_raw=args.keep_raw)
+            print "%s: %d -> %d bytes" % (mhd_file_name, image.nbytes, chunked_size)
+
+            if manifest:
+                chunked_file_name = re.sub(r'\.mhd$', '', mhd_file_name) + CHUNKED_SUFFIX
+                manifest.replace([ image.raw_file_name, mhd_file_name ], [ chunked_file_name, mhd_file_name ])
+
+    if manifest:
+        manifest.close()
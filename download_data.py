@@ -1,7 +1,16 @@
 import api
+import argparse
 import csv
 import errno
+import instrument
 import os
+import sys
+import tempfile
+import threading
+import urlparse
+import StringIO
+from manifest import Manifest, record_version
+from scheduler import DependencyError, DownloadScheduler
 
 # This script will download the entirety of the VisWeek 2013 contest data. 
 # Files will be exported into three directories:
@@ -13,6 +22,43 @@ import os
 #    - STRUCTURE_UNIONIZES_OUTPUT_DIRECTORY: where the structure unionizes will go.
 #
 # For an explanation of terminology and the data set in general, see README.md.
+#
+# The downloads run as one pipeline of scheduler tasks, each started as soon
+# as the tasks it needs have finished: the data set and structure queries
+# run side by side; once the data sets arrive, the volumes of every
+# reference space, the gene classifications, the grid files and the
+# structure unionizes are all queued at once; and the rows of each reference
+# space are written to data_sets.csv as soon as its volumes, grid files and
+# the classifications are in.  The whole sync takes about as long as its
+# longest chain of dependent downloads.  Use --stages to sync only some
+# developmental stages; rows of the other stages already in data_sets.csv
+# are kept.  A data set whose files fail to download keeps its previous row
+# in data_sets.csv, and the failed data sets are listed at exit.
+#
+# Volume files and structure unionizes are downloaded concurrently.  Use
+# --workers to control how many downloads run at once and
+# --requests-per-second to limit the load on the API server.
+#
+# Every downloaded file is recorded in a manifest (MANIFEST_FILE), so re-runs
+# only fetch files that are missing, truncated or whose source changed.
+# Complete files from before the manifest existed are added to it on the
+# first sync rather than downloaded again.
+# Interrupted volume downloads are resumed.  Use --verify to also compare the
+# checksums of existing files.
+#
+# With --cache-ttl, API query responses are cached in QUERY_CACHE_DIRECTORY
+# and reused for that many seconds.  The cache is off by default, since a
+# cached data set listing would hide new or changed data sets from the
+# manifest's version checks.  With --offline, queries are answered only from
+# the cache.
+#
+# With --metrics, the time spent in each phase, in API queries, HTTP
+# transfers, unzipping and file writes is logged to a JSON lines file (see
+# instrument.py) and summarized at the end.
+#
+# With --storage chunked, volumes are saved as chunked, compressed .cvol
+# files instead of raw files (see chunked_volume.py).  metaimage.MetaImage
+# reads either.
 
 # Database ID of the developing mouse data set, as stored in the API.
 DEVELOPING_MOUSE_PRODUCT_ID = 3
@@ -35,6 +81,32 @@ STRUCTURE_UNIONIZES_OUTPUT_DIRECTORY = 'structure_unionizes/'
 
 DATA_SETS_CSV = META_OUTPUT_DIRECTORY + 'data_sets.csv'
 STRUCTURES_CSV = META_OUTPUT_DIRECTORY + 'structures.csv'
+MANIFEST_FILE = META_OUTPUT_DIRECTORY + 'manifest.sqlite'
+QUERY_CACHE_DIRECTORY = 'query_cache/'
+
+parser = argparse.ArgumentParser(description="Download the VisWeek 2013 contest data.")
+parser.add_argument('--workers', type=int, default=8, help="number of concurrent downloads")
+parser.add_argument('--requests-per-second', type=float, default=None, help="maximum rate of HTTP requests per host")
+parser.add_argument('--verify', action='store_true', help="verify the checksums of previously downloaded files")
+parser.add_argument('--cache-ttl', type=float, default=None, help="cache API query responses and reuse them for this many seconds (default: no cache)")
+parser.add_argument('--offline', action='store_true', help="answer API queries only from the query cache")
+parser.add_argument('--metrics', help="log timings and counters to this JSON lines file")
+parser.add_argument('--storage', choices=api.VOLUME_STORAGE_TYPES, default='raw', help="store volumes as raw files or chunked, compressed files")
+parser.add_argument('--stages', nargs='+', choices=REFERENCE_SPACE_AGE_NAMES, default=REFERENCE_SPACE_AGE_NAMES,
+                    help="developmental stages to download (default: all)")
+parser.add_argument('--codec', default='zlib', help="compression codec for chunked storage (zlib, or zstd/lz4 if installed)")
+args = parser.parse_args()
+
+api.configure_volume_storage(args.storage, args.codec)
+api.configure_rate_limit(args.requests_per_second)
+
+if args.metrics:
+    instrument.configure(args.metrics)
+
+if args.cache_ttl is not None or args.offline:
+    api.configure_cache(QUERY_CACHE_DIRECTORY, ttl_seconds=args.cache_ttl or 0, offline=args.offline)
+
+API_HOST_NAME = urlparse.urlparse(api.API_HOST).netloc
 
 # make the output directory if it doesn't exist already
 for directory in [ENERGY_OUTPUT_DIRECTORY, META_OUTPUT_DIRECTORY, ANNOTATION_OUTPUT_DIRECTORY, ATLAS_OUTPUT_DIRECTORY, STRUCTURE_UNIONIZES_OUTPUT_DIRECTORY]:
@@ -46,112 +118,300 @@ for directory in [ENERGY_OUTPUT_DIRECTORY, META_OUTPUT_DIRECTORY, ANNOTATION_OUT
         else:
             raise
 
-# Query the API for meta data on probes and structures in the developing mouse data set.
-data_sets = api.download_data_sets(DEVELOPING_MOUSE_PRODUCT_ID, REFERENCE_SPACE_AGE_NAMES, PLANE_OF_SECTION_ID)
-data_set_ids = set([d['id'] for d in data_sets])
+# A CSV file written a few rows at a time by the pipeline's tasks.  Rows go
+# to a temporary file next to the destination, and 'close' renames it into
+# place, so the file is never seen partially written.
+class StreamingCSVFile(object):
+
+    def __init__(self, file_name, headers):
+        self.file_name = file_name
+        self.temp = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(file_name)), prefix='.' + os.path.basename(file_name),
+                                                suffix='.part', delete=False)
+        self.writer = csv.writer(self.temp)
+        self.lock = threading.Lock()
+        self.closed = False
+        self.write_rows([ headers ])
+
+    def write_rows(self, rows):
+        with self.lock:
+            self.writer.writerows(rows)
+            self.temp.flush()
+
+    def close(self):
+        with self.lock:
+            self.temp.close()
+            api.rename_into_place(self.temp.name, self.file_name)
+            self.closed = True
+
+    # Throw the rows away if the file was not completed.
+    def discard(self):
+        with self.lock:
+            if not self.closed:
+                self.temp.close()
+                os.remove(self.temp.name)
+                self.closed = True
+
+DATA_SETS_HEADERS = ["section_data_set_database_id", 
+                     "gene_name", "gene_acronym", "gene_entrez id", "gene_database id", 
+                     "probe_name", "probe_database_id", 
+                     "energy_file_name", 
+                     'reference_space_database_id',
+                     'reference_space_name',
+                     'annotation_file_name',
+                     'atlas_file_name',
+                     'classifications']
+
+STRUCTURES_HEADERS = ['database_id', 'name', 'acronym', 'order', 'level', 'color', 'structure_database_id_path']
 
-data_sets.sort(key=lambda d: d['reference_space_id'])
-
-structures = api.download_structures(DEVELOPING_MOUSE_GRAPH_ID)
-
-structures.sort(key=lambda s: s['graph_order'])
-
-# Download the annotation volumes and atlas volumesfor the requested reference spaces
-reference_space_ids = set([d['reference_space_id'] for d in data_sets])
-
-for rsid in reference_space_ids:
-    mhd, raw = api.download_annotation_volume(rsid, ANNOTATION_OUTPUT_DIRECTORY)
-
-    for data_set in data_sets:
-        if data_set['reference_space_id'] == rsid:
-            data_set['annotation_file_name'] = mhd
-            
-    print mhd
+# The structure unionize query requests all of the structure-level statistics
+# for a probe.  There are a large number of unionizes (roughly speaking one
+# row per structure in the stage of the data set), so the results are stored
+# in one file per gene.  Unionizes are requested for batches of data sets at
+# a time and then split into the per-gene files.
+def unionize_file_name(data_set_id):
+    return "%s%d.csv" % (STRUCTURE_UNIONIZES_OUTPUT_DIRECTORY, data_set_id)
 
-    mhd, raw = api.download_atlas_volume(rsid, ATLAS_OUTPUT_DIRECTORY)
+def download_unionize_files(data_set_ids):
+    unionizes = api.download_unionizes_batch(data_set_ids, DEVELOPING_MOUSE_GRAPH_ID)
+    file_names = []
 
-    for data_set in data_sets:
-        if data_set['reference_space_id'] == rsid:
-            data_set['atlas_file_name'] = mhd
-            
-    print mhd
+    for data_set_id in data_set_ids:
+        file_name = unionize_file_name(data_set_id)
 
-# Download gene classification meta data 
-for ds in data_sets:
-    print ds['id'], ds['genes'][0]
+        # Save structure unionizes into a CSV.
+        f = StringIO.StringIO()
+        headers = ['section_data_set_id', 'structure_id', 'expression_energy', 'sum_expressing_pixel_intensity', 'sum_pixels']
 
-gene_ids = set([d['genes'][0]['id'] for d in data_sets])
-gene_classifications = api.download_gene_classifications(gene_ids)
+        writer = csv.writer(f)
+        writer.writerow(headers)
 
-# Download the expression energy files for each probe recieved.
-for data_set in data_sets:
-    mhd, raw = api.download_grid_file(data_set['id'], ENERGY_OUTPUT_DIRECTORY)
-    data_set['energy_file_name'] = mhd
-    print mhd
+        for u in unionizes[data_set_id]:
+            writer.writerow([u['section_data_set_id'], u['structure_id'], u['expression_energy'], u['sum_expressing_pixel_intensity'], u['sum_pixels']])
 
-# Save probe meta data into a CSV.
-with open(DATA_SETS_CSV, 'w') as f:
-    headers = ["section_data_set_database_id", 
-               "gene_name", "gene_acronym", "gene_entrez id", "gene_database id", 
-               "probe_name", "probe_database_id", 
-               "energy_file_name", 
-               'reference_space_database_id',
-               'reference_space_name',
-               'annotation_file_name',
-               'atlas_file_name',
-               'classifications']
+        f.seek(0)
+        api.write_file_atomically(file_name, f)
+        manifest.record('structure_unionizes', data_set_id, [file_name], data_set_versions[data_set_id])
+
+        file_names.append(file_name)
+
+    return file_names
+
+# Is the unionize file of a data set up to date?  A complete file from before
+# the manifest existed is adopted into it (see manifest.py).
+def unionize_file_is_current(data_set_id):
+    file_name = unionize_file_name(data_set_id)
+    version = data_set_versions[data_set_id]
+
+    if manifest.is_current([file_name], version):
+        return True
+
+    if not manifest.adopting or not os.path.exists(file_name):
+        return False
+
+    # The file is written row by row, so a complete one ends with a newline.
+    with open(file_name, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return False
+        f.seek(-1, os.SEEK_END)
+        complete = f.read(1) == '\n'
+
+    return complete and manifest.adopt('structure_unionizes', data_set_id, [file_name], version)
+
+# Report the size of a downloaded mhd/raw pair.
+def volume_size(directory):
+    return lambda (mhd, raw): os.path.getsize(directory + raw)
+
+# Read the rows of the existing data_sets.csv.  Returns the rows of stages
+# not being downloaded, which are kept as they are, and the other rows by
+# data set ID, which are kept for data sets whose downloads fail.
+def previous_data_set_rows(stages):
+    if not os.path.exists(DATA_SETS_CSV):
+        return [], {}
+
+    with open(DATA_SETS_CSV, 'rb') as f:
+        reader = csv.reader(f)
+        headers = next(reader, None)
+        if headers != DATA_SETS_HEADERS:
+            return [], {}
+
+        name_column = headers.index('reference_space_name')
+        other_stage_rows = []
+        rows_by_id = {}
+        for row in reader:
+            if len(row) != len(headers):
+                continue
+            if set(row[name_column].split()) & set(stages):
+                rows_by_id[int(row[0])] = row
+            else:
+                other_stage_rows.append(row)
+
+    return other_stage_rows, rows_by_id
 
-    writer = csv.writer(f)
-    writer.writerow(headers)
+# Save structure meta data into a CSV.
+def write_structures_csv(structures_task):
+    structures = sorted(structures_task.result, key=lambda s: s['graph_order'])
 
-    for data_set in data_sets:
+    f = StreamingCSVFile(STRUCTURES_CSV, STRUCTURES_HEADERS)
+    try:
+        f.write_rows([ [s['id'], s['name'], s['acronym'], s['graph_order'], s['st_level'], s['color_hex_triplet'], s['structure_id_path']]
+                       for s in structures ])
+        f.close()
+    finally:
+        f.discard()
+
+# Save the probe meta data of one reference space into data_sets.csv.  Data
+# sets whose files failed to download keep their previous row, if they had
+# one, and are listed in failed_data_set_ids.
+def write_data_set_rows(data_sets_csv, data_sets, annotation_task, atlas_task, grid_tasks, classifications_task, previous_rows):
+    shared_tasks = [ annotation_task, atlas_task, classifications_task ]
+    rows = []
+
+    for data_set, grid_task in zip(data_sets, grid_tasks):
+        failed = [ task for task in shared_tasks + [ grid_task ] if task.error is not None ]
+        if failed:
+            failed_data_set_ids.append(data_set['id'])
+            kept = data_set['id'] in previous_rows
+            if kept:
+                rows.append(previous_rows[data_set['id']])
+            print >> sys.stderr, "data set %d: failed %s; %s" % (data_set['id'], ', '.join(str(task) for task in failed),
+                                                               "kept its previous row" if kept else "left out")
+            continue
+
+        gene_classifications = classifications_task.result
         probe = data_set['probes'][0]
         gene = data_set['genes'][0]
         refspace = data_set['reference_space']
         classification_string = '/'.join(c for c in gene_classifications[gene['id']])
 
-        writer.writerow([data_set['id'], 
-                         gene['name'], gene['acronym'], gene['entrez_id'], gene['id'], 
-                         probe['name'], probe['id'], 
-                         data_set['energy_file_name'], 
-                         refspace['id'],
-                         refspace['name'],
-                         data_set['annotation_file_name'],
-                         data_set['atlas_file_name'],
-                         classification_string])
-
-# Save structure meta data into a CSV.
-with open(STRUCTURES_CSV, 'w') as f:
-    headers = ['database_id', 'name', 'acronym', 'order', 'level', 'color', 'structure_database_id_path']
-
-    writer = csv.writer(f)
-    writer.writerow(headers)
-
-    for s in structures:
-        writer.writerow([s['id'], s['name'], s['acronym'], s['graph_order'], s['st_level'], s['color_hex_triplet'], s['structure_id_path']])
-
-# The structure unionize query requests all of the structure-level statistics
-# for a probe.  There are a large number of unionizes (roughly speaking one
-# row per structure in the stage of the data set), so the results are stored
-# in one file per gene.  
-for data_set_id in data_set_ids:
-    
-    # Make the query.
-    unionizes = api.download_unionizes(data_set_id, DEVELOPING_MOUSE_GRAPH_ID)
-
-    file_name = "%s%d.csv" % (STRUCTURE_UNIONIZES_OUTPUT_DIRECTORY, data_set_id)
-
-    if os.path.exists(file_name):
-        continue
-
-    # Save structure unionizes into a CSV.
-    with open(file_name, 'w') as f:
-        headers = ['section_data_set_id', 'structure_id', 'expression_energy', 'sum_expressing_pixel_intensity', 'sum_pixels']
-        
-        writer = csv.writer(f)
-        writer.writerow(headers)
-
-        for u in unionizes:
-            writer.writerow([u['section_data_set_id'], u['structure_id'], u['expression_energy'], u['sum_expressing_pixel_intensity'], u['sum_pixels']])
-
+        rows.append([data_set['id'], 
+                     gene['name'], gene['acronym'], gene['entrez_id'], gene['id'], 
+                     probe['name'], probe['id'], 
+                     grid_task.result[0], 
+                     refspace['id'],
+                     refspace['name'],
+                     annotation_task.result[0],
+                     atlas_task.result[0],
+                     classification_string])
+
+    data_sets_csv.write_rows(rows)
+
+def download_gene_classifications(gene_ids):
+    with instrument.timer('phase.gene_classifications'):
+        return api.download_gene_classifications(gene_ids)
+
+def download_structures():
+    with instrument.timer('phase.structures'):
+        return api.download_structures(DEVELOPING_MOUSE_GRAPH_ID)
+
+# Query the API for meta data on the probes in the developing mouse data set,
+# then queue everything that depends on them.  The scheduler retries this
+# task if it fails with an IOError, so everything that reads or writes files
+# is done before the first download is queued; a retry would otherwise queue
+# every download a second time.
+def download_data_sets():
+    with instrument.timer('phase.data_sets'):
+        data_sets = api.download_data_sets(DEVELOPING_MOUSE_PRODUCT_ID, args.stages, PLANE_OF_SECTION_ID)
+
+    # Version tokens for the manifest.
+    data_set_versions.update((d['id'], record_version(d)) for d in data_sets)
+
+    stale_data_set_ids = sorted(data_set['id'] for data_set in data_sets if not unionize_file_is_current(data_set['id']))
+
+    # The file is added to csv_files as soon as it exists, so that it is
+    # thrown away at exit if this task fails.
+    other_stage_rows, previous_rows = previous_data_set_rows(args.stages)
+    data_sets_csv = StreamingCSVFile(DATA_SETS_CSV, DATA_SETS_HEADERS)
+    csv_files.append(data_sets_csv)
+    data_sets_csv.write_rows(other_stage_rows)
+
+    data_sets_by_rsid = {}
+    for data_set in sorted(data_sets, key=lambda d: d['id']):
+        data_sets_by_rsid.setdefault(data_set['reference_space_id'], []).append(data_set)
+    reference_space_ids = sorted(data_sets_by_rsid)
+
+    # The volumes are the largest downloads, so they go first.
+    annotation_tasks = {}
+    atlas_tasks = {}
+    for rsid in reference_space_ids:
+        annotation_tasks[rsid] = scheduler.submit(api.download_annotation_volume, (rsid, ANNOTATION_OUTPUT_DIRECTORY, manifest),
+                                                  API_HOST_NAME, volume_size(ANNOTATION_OUTPUT_DIRECTORY))
+        atlas_tasks[rsid] = scheduler.submit(api.download_atlas_volume, (rsid, ATLAS_OUTPUT_DIRECTORY, manifest),
+                                             API_HOST_NAME, volume_size(ATLAS_OUTPUT_DIRECTORY))
+
+    # Download gene classification meta data 
+    gene_ids = set([d['genes'][0]['id'] for d in data_sets])
+    classifications_task = scheduler.submit(download_gene_classifications, (gene_ids,), API_HOST_NAME)
+
+    # Download the expression energy files for each probe recieved.  The rows
+    # of each reference space are written once its downloads have finished,
+    # in order of reference space, whether or not some of them failed.
+    previous_rows_task = None
+    for rsid in reference_space_ids:
+        grid_tasks = [ scheduler.submit(api.download_grid_file, (data_set['id'], ENERGY_OUTPUT_DIRECTORY, manifest, data_set_versions[data_set['id']]),
+                                        API_HOST_NAME, volume_size(ENERGY_OUTPUT_DIRECTORY))
+                       for data_set in data_sets_by_rsid[rsid] ]
+
+        after = [ annotation_tasks[rsid], atlas_tasks[rsid], classifications_task ] + grid_tasks
+        if previous_rows_task is not None:
+            after.append(previous_rows_task)
+
+        previous_rows_task = scheduler.submit(write_data_set_rows, (data_sets_csv, data_sets_by_rsid[rsid], annotation_tasks[rsid], atlas_tasks[rsid],
+                                                                    grid_tasks, classifications_task, previous_rows),
+                                              'local', after=after, allow_failed=True)
+        rows_tasks.append(previous_rows_task)
+
+    # The file is only left incomplete if writing rows failed.
+    csv_tasks[DATA_SETS_CSV] = scheduler.submit(data_sets_csv.close, (), 'local', after=rows_tasks)
+
+    for i in xrange(0, len(stale_data_set_ids), api.UNIONIZE_BATCH_SIZE):
+        scheduler.submit(download_unionize_files, (stale_data_set_ids[i:i+api.UNIONIZE_BATCH_SIZE],), API_HOST_NAME,
+                         lambda file_names: sum(os.path.getsize(file_name) for file_name in file_names))
+
+    return data_sets
+
+manifest = Manifest(MANIFEST_FILE, verify_checksums=args.verify)
+
+scheduler = DownloadScheduler(num_workers=args.workers)
+
+data_set_versions = {}
+csv_files = []
+rows_tasks = []
+failed_data_set_ids = []
+
+# The task that finishes each CSV file.
+csv_tasks = {}
+
+# The data set and structure queries start the pipeline; everything else is
+# queued by download_data_sets once the data sets are known.
+csv_tasks[DATA_SETS_CSV] = scheduler.submit(download_data_sets, (), API_HOST_NAME)
+structures_task = scheduler.submit(download_structures, (), API_HOST_NAME)
+csv_tasks[STRUCTURES_CSV] = scheduler.submit(write_structures_csv, (structures_task,), 'local', after=[ structures_task ])
+
+with instrument.timer('phase.pipeline'):
+    tasks = scheduler.run()
+
+for f in csv_files:
+    f.discard()
+
+# Tasks that did not run because of an earlier failure are not reported.
+for task in tasks:
+    if task.error is not None and not isinstance(task.error, DependencyError):
+        print >> sys.stderr, "Failed %s: %s" % (task, task.error)
+
+# Files already on disk are adopted into the manifest until a sync of every
+# stage has checked all of them.
+if set(args.stages) == set(REFERENCE_SPACE_AGE_NAMES) and all(task.error is None for task in tasks):
+    manifest.finish_adopting()
+
+manifest.close()
+
+if args.metrics:
+    print instrument.format_summary(instrument.close())
+
+unwritten = sorted(file_name for file_name, task in csv_tasks.iteritems() if task.error is not None)
+if unwritten:
+    sys.exit("Failed to write %s" % ', '.join(unwritten))
 
+if failed_data_set_ids:
+    sys.exit("Failed to download the files of %d data sets: %s" % (len(failed_data_set_ids), ', '.join(str(i) for i in sorted(failed_data_set_ids))))
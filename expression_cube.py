@@ -0,0 +1,238 @@
+import argparse
+import json
+import os
+import numpy as np
+import batch_unionize
+import metaimage
+import ontology
+
+# An expression cube packs the energy volumes of every probe in one
+# developmental stage into a single voxel-major matrix: one row per annotated
+# voxel, one column per probe.  Reading the expression of all genes at a
+# voxel is then a single row, rather than one read per energy file.
+#
+# Rows are ordered by the pre-order index of the voxel's structure in the
+# ontology (see ontology.py), so the voxels of a structure and all of its
+# descendants are a contiguous block of rows.  Voxels that are not labeled
+# with a structure in the ontology are left out.
+#
+# A cube is stored as three files sharing a prefix:
+#
+#    - <prefix>.cube: the matrix, raw and row-major, for memory-mapping
+#    - <prefix>.json: the probe index, the matrix type and shape, and any
+#      quantization scales
+#    - <prefix>_voxels.npz: the volume offset of each row, and where each
+#      structure's rows start
+#
+# To save space the matrix can be stored as float16, or quantized to 8 bits
+# per value with a scale per probe.  Negative energies mark voxels without
+# data; they are stored as -1 (MISSING_VALUE) at every precision, as the
+# reserved code 255 (MISSING_CODE) when quantized, and always read back as
+# -1, so a cube gives the same results whatever its precision.
+#
+# Run this file as a script from within the directory where you downloaded
+# the data set to build the cube for a stage, e.g.:
+#
+#    $ python expression_cube.py P14 --precision float16
+
+CUBE_DIRECTORY = 'cubes/'
+
+PRECISIONS = ['float32', 'float16', 'uint8']
+
+# The energy of voxels without data, and its code in quantized cubes.
+# Quantized values use the codes below it.
+MISSING_VALUE = -1.0
+MISSING_CODE = 255
+
+# Number of probes read into memory at a time while building a cube.
+BUILD_BLOCK_PROBES = 64
+
+# Order the annotated voxels of an annotation volume by structure.  Returns
+# the volume offset of each row and, for each structure in the ontology's
+# pre-order, the first row of its voxels (with one extra element at the
+# end).
+def order_voxels(o, annotation):
+    labels = np.asarray(annotation.flat)
+
+    # Map each label to the pre-order index of its structure, or -1.
+    max_label = int(labels.max()) if len(labels) else 0
+    structure_index = np.full(max_label + 1, -1, dtype=np.int64)
+    for sid, structure in o.structures.iteritems():
+        if 0 <= sid <= max_label:
+            structure_index[sid] = structure.index
+
+    voxel_structures = structure_index[labels]
+    annotated = np.flatnonzero(voxel_structures >= 0)
+
+    order = np.argsort(voxel_structures[annotated], kind='mergesort')
+    voxel_offsets = annotated[order].astype(np.uint32)
+
+    counts = np.bincount(voxel_structures[voxel_offsets], minlength=len(o.ids))
+    structure_starts = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+    return voxel_offsets, structure_starts
+
+# Convert stored values to energies, given the quantization scales of their
+# columns (None if the cube is not quantized) and the code of missing values
+# (None for cubes quantized before missing values had a code).
+def dequantize_values(values, scales, missing_code=None, dtype=np.float32):
+    values = np.asarray(values, dtype=dtype)
+    if scales is None:
+        return values
+
+    missing = values == missing_code if missing_code is not None else None
+    values = values * np.asarray(scales, dtype=dtype)
+    if missing is not None:
+        values[missing] = MISSING_VALUE
+    return values
+
+# Build the cube for a list of data sets that share an annotation volume.
+def build_cube(data_sets, o, prefix, precision='float32',
+               energy_directory=batch_unionize.ENERGY_DIRECTORY, annotation_directory=batch_unionize.ANNOTATION_DIRECTORY):
+    assert precision in PRECISIONS, "precision must be one of %s" % ', '.join(PRECISIONS)
+
+    annotation_file_names = set(d['annotation_file_name'] for d in data_sets)
+    assert len(annotation_file_names) == 1, "data sets do not share an annotation volume"
+    annotation_file_name = annotation_directory + annotation_file_names.pop()
+    annotation = metaimage.MetaImage(annotation_file_name)
+
+    voxel_offsets, structure_starts = order_voxels(o, annotation)
+    num_rows = len(voxel_offsets)
+    num_probes = len(data_sets)
+
+    cube = np.memmap(prefix + '.cube', dtype=np.dtype(precision), mode='w+', shape=(num_rows, max(num_probes, 1)))
+    scales = []
+
+    for start in xrange(0, num_probes, BUILD_BLOCK_PROBES):
+        block_data_sets = data_sets[start:start + BUILD_BLOCK_PROBES]
+        block = np.empty((num_rows, len(block_data_sets)), dtype=np.float32)
+
+        for j, data_set in enumerate(block_data_sets):
+            energy = metaimage.MetaImage(energy_directory + data_set['energy_file_name'])
+            metaimage.check_same_grid(energy, annotation)
+            block[:, j] = energy.flat[voxel_offsets]
+
+        missing = block < 0
+        block[missing] = MISSING_VALUE
+
+        if precision == 'uint8':
+            np.maximum(block, 0, out=block)
+            block_scales = block.max(axis=0) / float(MISSING_CODE - 1)
+            block_scales[block_scales == 0] = 1.0
+            block = np.rint(block / block_scales)
+            block[missing] = MISSING_CODE
+            scales += [ float(s) for s in block_scales ]
+
+        cube[:, start:start + len(block_data_sets)] = block
+
+    cube.flush()
+    del cube
+
+    np.savez(prefix + '_voxels.npz', voxel_offsets=voxel_offsets, structure_starts=structure_starts,
+             structure_ids=np.frombuffer(o.ids, dtype=np.int32))
+
+    with open(prefix + '.json', 'w') as f:
+        json.dump({ 'precision': precision,
+                    'shape': [num_rows, max(num_probes, 1)],
+                    'volume_shape': list(annotation.shape),
+                    'annotation_file_name': annotation_file_name,
+                    'data_set_ids': [ int(d['section_data_set_database_id']) for d in data_sets ],
+                    'gene_acronyms': [ d['gene_acronym'] for d in data_sets ],
+                    'scales': scales if precision == 'uint8' else None,
+                    'missing_code': MISSING_CODE if precision == 'uint8' else None }, f, indent=1)
+
+    return num_rows, num_probes
+
+# Read access to an expression cube.  The matrix is memory-mapped, so only
+# the rows that are asked for are read from disk.
+class ExpressionCube(object):
+
+    def __init__(self, prefix, o):
+        with open(prefix + '.json', 'r') as f:
+            self.meta = json.load(f)
+
+        voxels = np.load(prefix + '_voxels.npz')
+        assert np.array_equal(voxels['structure_ids'], np.frombuffer(o.ids, dtype=np.int32)), \
+            "cube %s was built with a different ontology" % prefix
+
+        self.ontology = o
+        self.voxel_offsets = voxels['voxel_offsets']
+        self.structure_starts = voxels['structure_starts']
+        self.volume_shape = tuple(self.meta['volume_shape'])
+        self.data_set_ids = self.meta['data_set_ids']
+        self.gene_acronyms = self.meta['gene_acronyms']
+        self.columns = { data_set_id: i for i, data_set_id in enumerate(self.data_set_ids) }
+        self.scales = np.array(self.meta['scales'], dtype=np.float32) if self.meta['scales'] else None
+        self.missing_code = self.meta.get('missing_code')
+
+        self.matrix = np.memmap(prefix + '.cube', dtype=np.dtype(self.meta['precision']), mode='r',
+                                shape=tuple(self.meta['shape']))
+        self._rows = None
+
+    # Map volume offsets to rows.  Built on first use.
+    @property
+    def rows(self):
+        if self._rows is None:
+            self._rows = np.full(int(np.prod(self.volume_shape)), -1, dtype=np.int64)
+            self._rows[self.voxel_offsets] = np.arange(len(self.voxel_offsets))
+        return self._rows
+
+    # Convert stored values to float32 energies.
+    def dequantize(self, values, columns=slice(None)):
+        return dequantize_values(values, self.scales[columns] if self.scales is not None else None, self.missing_code)
+
+    # The expression of every probe at a voxel, or None if the voxel is not
+    # annotated.
+    def voxel_profile(self, x, y, z):
+        offset = np.ravel_multi_index((z, y, x), self.volume_shape)
+        row = self.rows[offset]
+        if row < 0:
+            return None
+        return self.dequantize(self.matrix[row])
+
+    # The rows belonging to a structure and its descendants.
+    def structure_rows(self, structure):
+        return slice(int(self.structure_starts[structure.index]), int(self.structure_starts[structure.subtree_end]))
+
+    # The expression of every probe (or the given data sets) in every voxel
+    # of a structure and its descendants, as a voxels x probes matrix.
+    # Reading all probes is one contiguous read.
+    def region_matrix(self, structure, data_set_ids=None):
+        rows = self.structure_rows(structure)
+        if data_set_ids is None:
+            return self.dequantize(self.matrix[rows])
+
+        columns = np.array([ self.columns[d] for d in data_set_ids ], dtype=np.int64)
+        return self.dequantize(self.matrix[rows][:, columns], columns)
+
+    # The mean expression of every probe (or the given data sets) over the
+    # voxels of a structure and its descendants that have data, or NaN for
+    # probes with no data there.
+    def region_means(self, structure, data_set_ids=None):
+        values = self.region_matrix(structure, data_set_ids)
+        valid = values >= 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(valid, values, 0).sum(axis=0, dtype=np.float64) / valid.sum(axis=0)
+
+    # The volume offsets of the voxels in a structure and its descendants, in
+    # the order of region_matrix's rows.
+    def region_voxels(self, structure):
+        return self.voxel_offsets[self.structure_rows(structure)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack the energy volumes of a developmental stage into an expression cube.")
+    parser.add_argument('stage', help="reference space database ID or age name (e.g. P14)")
+    parser.add_argument('--precision', choices=PRECISIONS, default='float32', help="storage type of the cube")
+    args = parser.parse_args()
+
+    data_sets = batch_unionize.read_stage_data_sets(batch_unionize.DATA_SETS_CSV, args.stage)
+    assert data_sets, "no data sets found for stage %s" % args.stage
+
+    if not os.path.exists(CUBE_DIRECTORY):
+        os.makedirs(CUBE_DIRECTORY)
+    prefix = '%s%s' % (CUBE_DIRECTORY, data_sets[0]['reference_space_database_id'])
+
+    o = ontology.load(batch_unionize.ONTOLOGY_FILE_NAME, ontology.Ontology.DEVELOPING_MOUSE_ROOT_STRUCTURE_ID)
+
+    num_rows, num_probes = build_cube(data_sets, o, prefix, args.precision)
+    print "wrote %d voxels x %d probes to %s.cube" % (num_rows, num_probes, prefix)
@@ -0,0 +1,161 @@
+import json
+import threading
+import time
+
+# Timers, counters and latency histograms for finding out where a sync
+# spends its time.  Instrumentation is off until 'configure' is called; when
+# it is off, 'timer' returns a shared do-nothing context manager and
+# 'count' and 'event' return immediately, so instrumented code pays almost
+# nothing.
+#
+#    instrument.configure('metrics.jsonl')
+#
+#    with instrument.timer('query.page', start_row=0):
+#        ...
+#    instrument.count('query.rows', len(rows))
+#
+#    print instrument.format_summary(instrument.close())
+#
+# When a log file is given, every timed operation and event is appended to
+# it as one JSON object per line, and 'close' appends a summary: the total
+# of every counter, and the count, total, minimum, maximum and a histogram
+# of the durations of every timer.
+
+# Upper bounds, in seconds, of the buckets of each timer's histogram.  The
+# last bucket holds everything longer.
+HISTOGRAM_BOUNDS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0]
+
+enabled = False
+
+lock = threading.Lock()
+log_file = None
+counters = {}
+timers = {}
+
+class Histogram(object):
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.buckets[next((i for i, bound in enumerate(HISTOGRAM_BOUNDS) if value <= bound), len(HISTOGRAM_BOUNDS))] += 1
+
+    def as_dict(self):
+        return { 'count': self.count, 'total': self.total, 'min': self.min, 'max': self.max,
+                 'mean': self.total / self.count if self.count else None,
+                 'histogram': dict(('<=%g' % bound if i < len(HISTOGRAM_BOUNDS) else '>%g' % HISTOGRAM_BOUNDS[-1], n)
+                                   for i, (bound, n) in enumerate(zip(HISTOGRAM_BOUNDS + [None], self.buckets)) if n) }
+
+# Times the block it wraps and records the duration under its name.
+class Timer(object):
+    __slots__ = ('name', 'fields', 'start')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.time() - self.start
+        if exc_type is not None:
+            self.fields['error'] = exc_type.__name__
+        record(self.name, seconds, self.fields)
+        return False
+
+class NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_TIMER = NullTimer()
+
+# Turn instrumentation on, discarding anything recorded before.  If
+# 'file_name' is given, records are appended to it as JSON lines.
+def configure(file_name=None):
+    global enabled, log_file
+    with lock:
+        counters.clear()
+        timers.clear()
+        log_file = open(file_name, 'a') if file_name else None
+        enabled = True
+
+def write(record):
+    if log_file is not None:
+        log_file.write(json.dumps(record) + '\n')
+
+# Time a block of code.  Keyword arguments are written to the log with the
+# duration.
+def timer(name, **fields):
+    if not enabled:
+        return NULL_TIMER
+    return Timer(name, fields)
+
+# Record a duration measured elsewhere.
+def record(name, seconds, fields={}):
+    if not enabled:
+        return
+    with lock:
+        if name not in timers:
+            timers[name] = Histogram()
+        timers[name].add(seconds)
+        write(dict(fields, type='timer', name=name, time=time.time(), seconds=seconds))
+
+# Add to a counter.
+def count(name, value=1):
+    if not enabled:
+        return
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+# Write a one-off record to the log.
+def event(name, **fields):
+    if not enabled:
+        return
+    with lock:
+        write(dict(fields, type='event', name=name, time=time.time()))
+
+# The totals of every counter and timer recorded so far.
+def summary():
+    with lock:
+        return { 'counters': dict(counters), 'timers': dict((name, h.as_dict()) for name, h in timers.iteritems()) }
+
+# Turn instrumentation off, write the summary to the log and close it.
+# Returns the summary.
+def close():
+    global enabled, log_file
+    result = summary()
+    with lock:
+        enabled = False
+        if log_file is not None:
+            write(dict(result, type='summary', time=time.time()))
+            log_file.close()
+            log_file = None
+    return result
+
+# Format a summary as a table, slowest timers first.
+def format_summary(result):
+    lines = [ '%-32s %8s %10s %10s %10s' % ('timer', 'count', 'total (s)', 'mean (s)', 'max (s)') ]
+    for name, t in sorted(result['timers'].iteritems(), key=lambda (name, t): -t['total']):
+        lines.append('%-32s %8d %10.3f %10.4f %10.4f' % (name, t['count'], t['total'], t['mean'], t['max']))
+
+    lines.append('')
+    lines.append('%-32s %8s' % ('counter', 'total'))
+    for name, value in sorted(result['counters'].iteritems()):
+        lines.append('%-32s %8d' % (name, value))
+
+    return '\n'.join(lines)
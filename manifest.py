@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# The manifest keeps track of every file that download_data.py has fetched:
+# which artifact it belongs to, the ID of the API object it came from, a
+# version token describing the source, its size, an MD5 checksum and when it
+# was fetched.  An artifact is up to date when all of its files are listed
+# with a matching version and are still on disk with the recorded size (and,
+# optionally, checksum).  Anything else -- missing, truncated or changed at
+# the source -- gets downloaded again.
+#
+# The manifest is a SQLite database, so recording one file does not rewrite
+# the whole manifest and an interrupted sync loses nothing that was already
+# recorded.  A Manifest can be shared by several download threads.
+#
+# Files downloaded before there was a manifest, or recorded with version
+# tokens built another way (see VERSION_SCHEME), are "adopted" once: while
+# 'adopting' is set, downloaders record complete files already on disk as
+# the current version of their source instead of fetching them again.  Call
+# 'finish_adopting' once a sync has been through every artifact.
+
+MANIFEST_FILE_NAME = 'manifest.sqlite'
+
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+# Compute the MD5 checksum of a file.
+def file_checksum(file_name):
+    md5 = hashlib.md5()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+# The fields of a section data set record that identify the data behind its
+# files: where its images are stored, whether it failed QC (and why), when it
+# passed QC and the reference space it was registered to.  A change to any of
+# them causes a re-download; changes to other fields (e.g. the gene or
+# probe records included with it) do not.
+VERSION_FIELDS = ['storage_directory', 'failed', 'failed_facet', 'qc_date', 'reference_space_id']
+
+# Increased whenever the way version tokens are built changes.
+VERSION_SCHEME = 2
+
+# Build a version token from the identifying fields of an API record.
+def record_version(record, fields=VERSION_FIELDS):
+    return hashlib.md5(json.dumps([ record.get(field) for field in fields ])).hexdigest()
+
+class Manifest(object):
+
+    def __init__(self, file_name=MANIFEST_FILE_NAME, verify_checksums=False):
+        self.verify_checksums = verify_checksums
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files ("
+                                "file_name TEXT PRIMARY KEY, "
+                                "artifact TEXT NOT NULL, "
+                                "source_id INTEGER, "
+                                "version TEXT, "
+                                "size INTEGER NOT NULL, "
+                                "checksum TEXT NOT NULL, "
+                                "fetched_at REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_artifact ON files (artifact)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS properties (name TEXT PRIMARY KEY, value TEXT)")
+        self.connection.commit()
+
+        row = self.connection.execute("SELECT value FROM properties WHERE name = 'version_scheme'").fetchone()
+        self.adopting = row is None or row[0] != str(VERSION_SCHEME)
+
+    # Is every file of an artifact on disk, complete and from the given version
+    # of its source?
+    def is_current(self, file_names, version=None):
+        for file_name in file_names:
+            with self.lock:
+                row = self.connection.execute("SELECT version, size, checksum FROM files WHERE file_name = ?",
+                                              (file_name,)).fetchone()
+
+            if row is None:
+                return False
+
+            recorded_version, size, checksum = row
+
+            if version is not None and recorded_version != version:
+                return False
+
+            if not os.path.exists(file_name) or os.path.getsize(file_name) != size:
+                return False
+
+            if self.verify_checksums and file_checksum(file_name) != checksum:
+                return False
+
+        return True
+
+    # Record the files of an artifact that were just downloaded.
+    def record(self, artifact, source_id, file_names, version=None):
+        rows = [ (file_name, artifact, source_id, version, os.path.getsize(file_name), file_checksum(file_name), time.time())
+                 for file_name in file_names ]
+
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.commit()
+
+    # Record that listed files were replaced by others holding the same data
+    # (e.g. a volume converted to another storage form): the new files take
+    # the artifact, source and version of the old ones.  Returns whether the
+    # old files were listed.
+    def replace(self, old_file_names, new_file_names):
+        with self.lock:
+            row = self.connection.execute("SELECT artifact, source_id, version FROM files WHERE file_name = ?",
+                                          (old_file_names[0],)).fetchone()
+        if row is None:
+            return False
+
+        artifact, source_id, version = row
+        self.record(artifact, source_id, new_file_names, version)
+
+        with self.lock:
+            self.connection.executemany("DELETE FROM files WHERE file_name = ?",
+                                        [ (file_name,) for file_name in old_file_names if file_name not in new_file_names ])
+            self.connection.commit()
+        return True
+
+    # Record files that are already on disk, and that the caller has checked
+    # are complete, as the given version of their source.  Only done while
+    # adopting; returns whether the files were recorded.
+    def adopt(self, artifact, source_id, file_names, version=None):
+        if not self.adopting or not all(os.path.exists(file_name) for file_name in file_names):
+            return False
+
+        self.record(artifact, source_id, file_names, version)
+        return True
+
+    # Stop adopting files.  Later syncs trust only the recorded versions.
+    def finish_adopting(self):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO properties VALUES ('version_scheme', ?)", (str(VERSION_SCHEME),))
+            self.connection.commit()
+            self.adopting = False
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,245 @@
+import csv
+import os
+import re
+import sys
+import numpy as np
+import chunked_volume
+
+# This module reads MetaImage volumes: a text header (.mhd) describing the
+# dimensions, voxel spacing, element type and byte order of the volume, and
+# a raw file holding the voxels.  The raw file is memory-mapped lazily, so
+# nothing is read until voxels are accessed, and then only the pages that
+# hold them.
+#
+# Volumes are exposed as 3D numpy arrays indexed [z, y, x], since MetaImage
+# stores x as the fastest-changing dimension.
+#
+# The data file may also be a chunked, compressed .cvol file (see
+# chunked_volume.py).  Block and slice reads then decompress only the chunks
+# they touch, while 'data' and 'flat' decompress the whole volume once.
+#
+#    image = MetaImage('energy/100083323_energy.mhd')
+#    print image.shape, image.spacing, image.dtype
+#    block = image.read_block(slice(10, 20), slice(0, 40), slice(5, 15))
+#
+# Run this file as a script from within the directory where you downloaded
+# the data set to check that every energy volume has the same grid as its
+# annotation volume.
+
+DATA_SETS_CSV = 'meta/data_sets.csv'
+ENERGY_DIRECTORY = 'energy/'
+ANNOTATION_DIRECTORY = 'annotation/'
+
+# MetaImage element types and the corresponding numpy data types.
+ELEMENT_TYPES = {
+    'MET_CHAR': np.int8,
+    'MET_UCHAR': np.uint8,
+    'MET_SHORT': np.int16,
+    'MET_USHORT': np.uint16,
+    'MET_INT': np.int32,
+    'MET_UINT': np.uint32,
+    'MET_LONG': np.int32,
+    'MET_ULONG': np.uint32,
+    'MET_LONG_LONG': np.int64,
+    'MET_ULONG_LONG': np.uint64,
+    'MET_FLOAT': np.float32,
+    'MET_DOUBLE': np.float64
+}
+
+# The element type written for each numpy type kind and size.
+WRITE_ELEMENT_TYPES = {
+    'i1': 'MET_CHAR',
+    'u1': 'MET_UCHAR',
+    'i2': 'MET_SHORT',
+    'u2': 'MET_USHORT',
+    'i4': 'MET_INT',
+    'u4': 'MET_UINT',
+    'i8': 'MET_LONG_LONG',
+    'u8': 'MET_ULONG_LONG',
+    'f4': 'MET_FLOAT',
+    'f8': 'MET_DOUBLE'
+}
+
+# Write a 3D array (indexed [z, y, x]) as a MetaImage header and raw file.
+# 'spacing' is given x first, as in the header.
+def write_metaimage(mhd_file_name, data, spacing=(1.0, 1.0, 1.0)):
+    data = np.asarray(data)
+    element_type = WRITE_ELEMENT_TYPES.get('%s%d' % (data.dtype.kind, data.dtype.itemsize))
+    assert element_type, "no MetaImage element type for %s" % data.dtype
+
+    raw_file_name = os.path.splitext(mhd_file_name)[0] + '.raw'
+    np.ascontiguousarray(data, dtype=data.dtype.newbyteorder('<')).tofile(raw_file_name)
+
+    with open(mhd_file_name, 'w') as f:
+        f.write("ObjectType = Image\n")
+        f.write("NDims = %d\n" % data.ndim)
+        f.write("BinaryData = True\n")
+        f.write("BinaryDataByteOrderMSB = False\n")
+        f.write("DimSize = %s\n" % ' '.join(str(d) for d in reversed(data.shape)))
+        f.write("ElementSpacing = %s\n" % ' '.join(repr(float(s)) for s in spacing))
+        f.write("ElementType = %s\n" % element_type)
+        f.write("ElementDataFile = %s\n" % os.path.basename(raw_file_name))
+
+# Read the key/value pairs out of a MetaImage header.
+def read_header(file_name):
+    with open(file_name, 'r') as f:
+        return parse_header(f.read())
+
+# Parse the key/value pairs of a MetaImage header's text.
+def parse_header(text):
+    header = {}
+    for line in text.splitlines():
+        match = re.match(r'\s*(\w+)\s*=\s*(.*?)\s*$', line)
+        if match:
+            header[match.group(1)] = match.group(2)
+    return header
+
+class MetaImage(object):
+
+    def __init__(self, mhd_file_name):
+        self.mhd_file_name = mhd_file_name
+        self.header = header = read_header(mhd_file_name)
+
+        if header.get('CompressedData', 'False') == 'True':
+            raise ValueError("%s: compressed MetaImage data is not supported" % mhd_file_name)
+
+        # Dimensions and spacing are listed x first.
+        self.dimensions = [ int(d) for d in header['DimSize'].split() ]
+        spacing = header.get('ElementSpacing', header.get('ElementSize'))
+        self.spacing = [ float(s) for s in spacing.split() ] if spacing else [1.0] * len(self.dimensions)
+
+        self.shape = tuple(reversed(self.dimensions))
+        channels = int(header.get('ElementNumberOfChannels', 1))
+        if channels > 1:
+            self.shape += (channels,)
+
+        element_type = header['ElementType']
+        if element_type not in ELEMENT_TYPES:
+            raise ValueError("%s: unsupported element type %s" % (mhd_file_name, element_type))
+
+        byte_order = header.get('ElementByteOrderMSB', header.get('BinaryDataByteOrderMSB', 'False'))
+        self.dtype = np.dtype(ELEMENT_TYPES[element_type]).newbyteorder('>' if byte_order == 'True' else '<')
+
+        data_file = header['ElementDataFile']
+        if data_file == 'LOCAL':
+            self.raw_file_name = mhd_file_name
+        else:
+            self.raw_file_name = os.path.join(os.path.dirname(mhd_file_name), data_file)
+
+        self.num_voxels = int(np.prod(self.shape))
+        self.nbytes = self.num_voxels * self.dtype.itemsize
+
+        self.chunked = data_file.endswith(chunked_volume.CHUNKED_SUFFIX)
+        self._chunks = None
+
+        # HeaderSize is the number of bytes to skip in the raw file.  -1 means
+        # the data is at the end of the file.
+        header_size = int(header.get('HeaderSize', 0)) if not self.chunked else 0
+        if header_size == -1:
+            header_size = os.path.getsize(self.raw_file_name) - self.nbytes
+        self.offset = header_size
+
+        self._data = None
+
+    def __len__(self):
+        return self.num_voxels
+
+    # The volume as a read-only, memory-mapped array indexed [z, y, x].  A
+    # chunked volume is decompressed into memory instead, and its file closed.
+    @property
+    def data(self):
+        if self._data is None:
+            if self.chunked:
+                self._data = self.chunks.read_all().reshape(self.shape)
+                self._data.flags.writeable = False
+                self.close_chunks()
+            else:
+                self._data = np.memmap(self.raw_file_name, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape)
+        return self._data
+
+    # The reader of a chunked volume.
+    @property
+    def chunks(self):
+        if self._chunks is None:
+            self._chunks = chunked_volume.ChunkedVolume(self.raw_file_name)
+            if self._chunks.shape != self.shape[:3]:
+                raise ValueError("%s: %s holds a volume of shape %s" % (self.mhd_file_name, self.raw_file_name, self._chunks.shape))
+        return self._chunks
+
+    def close_chunks(self):
+        if self._chunks is not None:
+            self._chunks.close()
+            self._chunks = None
+
+    # Close the volume's data file.  Arrays already read from it stay valid,
+    # and reading again reopens it.
+    def close(self):
+        self.close_chunks()
+        self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # The volume as a flat, memory-mapped array in file order.
+    @property
+    def flat(self):
+        return self.data.reshape(-1)
+
+    # Read a sub-block of the volume into memory.  Arguments are slices (or
+    # indices) along z, y and x.
+    def read_block(self, z=slice(None), y=slice(None), x=slice(None)):
+        if self.chunked and self._data is None:
+            return self.chunks.read_block(z, y, x)
+        return np.array(self.data[z, y, x])
+
+    # Read a single plane of the volume.  'axis' is 'x', 'y' or 'z'.
+    def read_slice(self, axis, index):
+        if axis == 'z':
+            return self.read_block(z=index)
+        elif axis == 'y':
+            return self.read_block(y=index)
+        elif axis == 'x':
+            return self.read_block(x=index)
+        raise ValueError("unknown axis %s" % axis)
+
+    def same_grid(self, other):
+        return self.dimensions == other.dimensions and np.allclose(self.spacing, other.spacing)
+
+# Raise a ValueError if an energy volume and an annotation volume do not
+# describe the same grid.
+def check_same_grid(energy, annotation):
+    if not energy.same_grid(annotation):
+        raise ValueError("%s (%s, spacing %s) does not match %s (%s, spacing %s)" %
+                         (energy.mhd_file_name, 'x'.join(str(d) for d in energy.dimensions), energy.spacing,
+                          annotation.mhd_file_name, 'x'.join(str(d) for d in annotation.dimensions), annotation.spacing))
+
+# Check every energy volume listed in data_sets.csv against its annotation
+# volume.  Returns a list of error messages.
+def validate_volumes(data_sets_csv=DATA_SETS_CSV, energy_directory=ENERGY_DIRECTORY, annotation_directory=ANNOTATION_DIRECTORY):
+    with open(data_sets_csv, 'rb') as f:
+        data_sets = list(csv.DictReader(f))
+
+    annotations = {}
+    errors = []
+
+    for data_set in data_sets:
+        try:
+            annotation_file_name = data_set['annotation_file_name']
+            if annotation_file_name not in annotations:
+                annotations[annotation_file_name] = MetaImage(annotation_directory + annotation_file_name)
+
+            check_same_grid(MetaImage(energy_directory + data_set['energy_file_name']), annotations[annotation_file_name])
+        except (IOError, KeyError, ValueError) as e:
+            errors.append("%s: %s" % (data_set['section_data_set_database_id'], e))
+
+    return errors
+
+if __name__ == "__main__":
+    errors = validate_volumes()
+    for error in errors:
+        print error
+
+    sys.exit(1 if errors else 0)
@@ -1,5 +1,12 @@
+import array
 import csv
 import copy
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
 
 # This file has the Structure and Ontology classes, which are meant to demonstrate
 # how to read and interpret and ontology.  The 'download_data.py' script will
@@ -9,34 +16,106 @@ import copy
 
 # Structures may have a parent and some number of children.  This class makes
 # it easy to keep track of them and makes the structure more easily printable.
+# Structures are numbered in pre-order by the ontology: a structure's
+# descendants are the structures numbered from its 'index' up to (but not
+# including) its 'subtree_end'.
 class Structure(dict):
 
     def __init__(self, *args, **kw):
         super(Structure, self).__init__(*args, **kw)
         self.parent = None
         self.children = []
+        self.index = -1
+        self.subtree_end = -1
+        self.depth = 0
 
     def __str__(self):
         return str({ 'children': [c['database_id'] for c in self.children], 
                      'parent': self.parent['database_id'] if self.parent else None,
                      'structure': dict(self) })
 
-    # Does one structure_id descend from another?
+    # Does one structure_id descend from another?  Constant time, using the
+    # pre-order numbering.
     def descendent_of(self, parent):
-        structure = self
-        while structure:
-            if structure['database_id'] == parent['database_id']:
-                return True
-            else:
-                structure = structure.parent
+        return parent.index <= self.index < parent.subtree_end
+
+# A compact view of one structure, backed by the ontology's exported tree
+# arrays: it holds only the ontology and the structure's pre-order index, so
+# code that walks many structures can create nodes as it goes instead of
+# keeping a full Structure for each.  The CSV columns of the structure are
+# read with node['column'].
+class StructureNode(object):
+    __slots__ = ('ontology', 'index')
+
+    def __init__(self, ontology, index):
+        self.ontology = ontology
+        self.index = index
+
+    def __getitem__(self, key):
+        return self.ontology.ordered_structures[self.index][key]
+
+    def __eq__(self, other):
+        return isinstance(other, StructureNode) and self.ontology is other.ontology and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def __repr__(self):
+        return 'StructureNode(%d)' % self.database_id
+
+    @property
+    def database_id(self):
+        return self.ontology.ids[self.index]
 
-        return False        
+    @property
+    def subtree_end(self):
+        return self.ontology.subtree_ends[self.index]
+
+    @property
+    def depth(self):
+        return self.ontology.depths[self.index]
+
+    @property
+    def parent(self):
+        parent_index = self.ontology.parent_indices[self.index]
+        return StructureNode(self.ontology, parent_index) if parent_index >= 0 else None
+
+    # The children come right after their parent in pre-order, each one
+    # after the subtree of the one before it.
+    @property
+    def children(self):
+        children = []
+        child_index = self.index + 1
+        while child_index < self.subtree_end:
+            children.append(StructureNode(self.ontology, child_index))
+            child_index = self.ontology.subtree_ends[child_index]
+        return children
+
+    # Does this structure descend from another?  'parent' can be a node or a
+    # Structure.
+    def descendent_of(self, parent):
+        return parent.index <= self.index < parent.subtree_end
 
         
 # A simple class for managing ontology structures.  It supports
 # a couple simple queries like:
 #    - does structure A descend from structure B?
 #    - what are the children of structure A?
+#
+# Structures can be read as Structure dictionaries or, where many are
+# visited, as compact StructureNode views of the tree arrays below.
+#
+# Structures are indexed by name and acronym, and numbered in pre-order
+# (children sorted by 'order'), so that the descendants of a structure form
+# a contiguous range of 'ordered_structures'.  The ontology also exports
+# the tree as parallel arrays in that order, for vectorized computations:
+#    - ids: the database ID of each structure
+#    - parent_indices: the index of each structure's parent (-1 for roots)
+#    - subtree_ends: one past the index of each structure's last descendant
+#    - depths: the number of ancestors of each structure
 class Ontology(object):
     
     # A good place to keep track of the what the root structure ID is for the 
@@ -44,6 +123,7 @@ class Ontology(object):
     DEVELOPING_MOUSE_ROOT_STRUCTURE_ID = 6070
 
     def __init__(self, rows, headers, root_database_id):
+        self.headers = headers
         self.structures = { int(row['database_id']): Structure(row) for row in rows }
         self.root = self.structures[root_database_id]
 
@@ -72,6 +152,76 @@ class Ontology(object):
             except IndexError:
                 pass
 
+        self.build_index()
+
+    # Build an ontology from typed structures that are already in pre-order,
+    # along with the exported tree arrays, as stored in a snapshot.  This
+    # skips type conversion, path parsing and numbering.
+    @classmethod
+    def from_ordered_structures(cls, ordered_structures, headers, root_database_id, ids, parent_indices, subtree_ends, depths):
+        o = cls.__new__(cls)
+        o.headers = headers
+        o.ordered_structures = ordered_structures
+        o.ids = ids
+        o.parent_indices = parent_indices
+        o.subtree_ends = subtree_ends
+        o.depths = depths
+
+        for i, structure in enumerate(ordered_structures):
+            structure.index = i
+            structure.subtree_end = subtree_ends[i]
+            structure.depth = depths[i]
+
+            parent_index = parent_indices[i]
+            if parent_index >= 0:
+                structure.parent = ordered_structures[parent_index]
+                structure.parent.children.append(structure)
+
+        o.structures = { s['database_id']: s for s in ordered_structures }
+        o.root = o.structures[root_database_id]
+        o.build_lookup_tables()
+        return o
+
+    # Number the structures in pre-order and build the lookup tables.  The
+    # root comes first, followed by any other parentless structures.
+    def build_index(self):
+        by_order = lambda s: s.get('order')
+
+        for structure in self.structures.itervalues():
+            structure.children.sort(key=by_order)
+
+        roots = sorted((s for s in self.structures.itervalues() if s.parent is None and s is not self.root), key=by_order)
+
+        self.ordered_structures = []
+        stack = [ self.root ] + roots[::-1]
+        while stack:
+            structure = stack.pop()
+            structure.index = len(self.ordered_structures)
+            structure.depth = structure.parent.depth + 1 if structure.parent else 0
+            self.ordered_structures.append(structure)
+            stack.extend(reversed(structure.children))
+
+        # A structure's subtree ends where its last descendant's subtree ends.
+        for structure in reversed(self.ordered_structures):
+            structure.subtree_end = max([structure.index + 1] + [c.subtree_end for c in structure.children])
+
+        self.ids = array.array('i', (s['database_id'] for s in self.ordered_structures))
+        self.parent_indices = array.array('i', (s.parent.index if s.parent else -1 for s in self.ordered_structures))
+        self.subtree_ends = array.array('i', (s.subtree_end for s in self.ordered_structures))
+        self.depths = array.array('i', (s.depth for s in self.ordered_structures))
+
+        self.build_lookup_tables()
+
+    def build_lookup_tables(self):
+        self.indices = { structure_id: i for i, structure_id in enumerate(self.ids) }
+
+        # The first structure in pre-order wins if names or acronyms repeat.
+        self.structures_by_name = {}
+        self.structures_by_acronym = {}
+        for structure in self.ordered_structures:
+            self.structures_by_name.setdefault(structure['name'], structure)
+            self.structures_by_acronym.setdefault(structure['acronym'], structure)
+
     # Get structure meta data for a structure_id. Dictionary search.
     def get_structure(self, structure_id):
         try:
@@ -79,13 +229,35 @@ class Ontology(object):
         except KeyError:
             return None
 
-    # Get structure meta data for a structure name. Exhaustive search.
+    # Get structure meta data for a structure name. Dictionary search.
     def get_structure_by_name(self, structure_name):
-        return next((s for sid, s in self.structures.iteritems() if s['name'] == structure_name), None)
+        return self.structures_by_name.get(structure_name)
 
-    # Get structure meta data for a structure acronym. Exhaustive search.
+    # Get structure meta data for a structure acronym. Dictionary search.
     def get_structure_by_acronym(self, structure_acronym):
-        return next((s for sid, s in self.structures.iteritems() if s['acronym'] == structure_acronym), None)
+        return self.structures_by_acronym.get(structure_acronym)
+
+    # Get the compact node of the structure at a pre-order index.
+    def node(self, index):
+        return StructureNode(self, index)
+
+    # Get the compact node of a structure_id, or None.
+    def get_node(self, structure_id):
+        index = self.indices.get(structure_id)
+        return StructureNode(self, index) if index is not None else None
+
+    # Get the compact nodes of a structure and all of its descendants, in
+    # pre-order.
+    def get_descendant_nodes(self, structure):
+        return [ StructureNode(self, i) for i in xrange(structure.index, structure.subtree_end) ]
+
+    # Get a structure and all of its descendants, in pre-order.
+    def get_descendants(self, structure):
+        return self.ordered_structures[structure.index:structure.subtree_end]
+
+    # Get the database IDs of a structure and all of its descendants.
+    def get_descendant_ids(self, structure):
+        return self.ids[structure.index:structure.subtree_end]
 
 # Read an ontology from a CSV file, as written by download_data.py
 def read_from_csv(file_name, root_id):
@@ -93,10 +265,201 @@ def read_from_csv(file_name, root_id):
         reader = csv.DictReader(f)
         return Ontology([ row for row in reader ], reader.fieldnames, root_id)
 
+# An ontology snapshot is a compiled, binary copy of structures.csv that loads
+# without any CSV parsing or type sniffing.  The file is laid out as:
+#
+#    - an 8 byte magic string and a 4 byte format version
+#    - a 4 byte length followed by a JSON header describing the source CSV
+#      (size, modification time and SHA-1), the root ID, the CSV field names
+#      and the location and type of each column
+#    - the columns themselves, with structures in pre-order.  Integer
+#      columns and the tree arrays are 32-bit integer arrays.  String columns
+#      are an array of offsets into a block of UTF-8 text.
+#
+# Snapshots are read through a read-only memory map and copied into the
+# ontology's structures and arrays, so loading one costs no CSV parsing, but
+# each process still holds its own copy of the ontology; only the file's
+# pages in the operating system's cache are shared.
+# Use 'load' to read an ontology: it writes a snapshot next to the CSV the
+# first time, and rebuilds it whenever the CSV changes or the format version
+# is bumped.
+
+SNAPSHOT_MAGIC = 'ONTOSNAP'
+SNAPSHOT_VERSION = 1
+
+# The tree arrays stored in every snapshot, in addition to the CSV columns.
+SNAPSHOT_TREE_ARRAYS = ['ids', 'parent_indices', 'subtree_ends', 'depths']
+
+# Describe a CSV file by its size, modification time and checksum.
+def file_signature(file_name):
+    with open(file_name, 'rb') as f:
+        sha1 = hashlib.sha1(f.read()).hexdigest()
+    return { 'size': os.path.getsize(file_name), 'mtime': os.path.getmtime(file_name), 'sha1': sha1 }
+
+# Default file name of the snapshot of a structures CSV.
+def snapshot_file_name_for(csv_file_name):
+    return os.path.splitext(csv_file_name)[0] + '.ontology'
+
+# Write an ontology to a snapshot file.  'source' is the signature of the
+# CSV file the ontology was read from.
+def write_snapshot(o, file_name, source):
+    columns = []
+    blocks = []
+    offset = 0
+
+    def add_block(data):
+        blocks.append(data)
+        return len(data)
+
+    for name in SNAPSHOT_TREE_ARRAYS:
+        length = add_block(getattr(o, name).tostring())
+        columns.append({ 'name': name, 'type': 'tree', 'offset': offset, 'length': length })
+        offset += length
+
+    for name in o.headers:
+        values = [ s[name] for s in o.ordered_structures ]
+
+        # Columns that are entirely integers are stored as integers.  Anything
+        # else is stored as text and converted value by value when loaded,
+        # just as read_from_csv does.
+        if all(isinstance(v, (int, long)) and -2**31 <= v < 2**31 for v in values):
+            length = add_block(array.array('i', values).tostring())
+            columns.append({ 'name': name, 'type': 'int', 'offset': offset, 'length': length })
+        else:
+            is_mixed = any(isinstance(v, (int, long)) for v in values)
+            encoded = [ (v if isinstance(v, unicode) else str(v).decode('utf-8')).encode('utf-8') for v in values ]
+            offsets = array.array('I', [0])
+            for e in encoded:
+                offsets.append(offsets[-1] + len(e))
+
+            length = add_block(offsets.tostring()) + add_block(''.join(encoded))
+            columns.append({ 'name': name, 'type': 'mixed' if is_mixed else 'str', 'offset': offset, 'length': length })
+
+        offset += length
+
+    header = json.dumps({ 'source': source,
+                          'root_id': o.root['database_id'],
+                          'num_structures': len(o.ordered_structures),
+                          'headers': o.headers,
+                          'columns': columns })
+
+    # Column offsets are relative to the end of the header.  The snapshot is
+    # written to a uniquely named temporary file, so processes rebuilding it
+    # at the same time do not write over each other.
+    fd, temp_file_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)),
+                                          prefix='.' + os.path.basename(file_name), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(struct.pack('<II', SNAPSHOT_VERSION, len(header)))
+            f.write(header)
+            for block in blocks:
+                f.write(block)
+
+        if os.name == 'nt' and os.path.exists(file_name):
+            os.remove(file_name)
+        os.rename(temp_file_name, file_name)
+    except:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+        raise
+
+# Read the JSON header of a snapshot.  Returns None if the file is not a
+# snapshot of the current format version.
+def read_snapshot_header(f):
+    prefix = f.read(len(SNAPSHOT_MAGIC) + 8)
+    if len(prefix) < len(SNAPSHOT_MAGIC) + 8 or prefix[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        return None
+
+    version, header_length = struct.unpack('<II', prefix[len(SNAPSHOT_MAGIC):])
+    if version != SNAPSHOT_VERSION:
+        return None
+
+    header = json.loads(f.read(header_length))
+    header['data_offset'] = len(prefix) + header_length
+    return header
+
+# Read an ontology from a snapshot file.
+def read_snapshot(file_name):
+    with open(file_name, 'rb') as f:
+        header = read_snapshot_header(f)
+        assert header, "%s is not a version %d ontology snapshot" % (file_name, SNAPSHOT_VERSION)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        num_structures = header['num_structures']
+        base = header['data_offset']
+        tree = {}
+        rows = [ {} for i in xrange(num_structures) ]
+
+        for column in header['columns']:
+            start = base + column['offset']
+
+            if column['type'] in ('tree', 'int'):
+                values = array.array('i')
+                values.fromstring(data[start:start + column['length']])
+            else:
+                offsets = array.array('I')
+                offsets.fromstring(data[start:start + 4 * (num_structures + 1)])
+                text = data[start + 4 * (num_structures + 1):start + column['length']]
+                values = [ text[offsets[i]:offsets[i+1]] for i in xrange(num_structures) ]
+
+                if column['type'] == 'mixed':
+                    values = [ int_or_str(v) for v in values ]
+
+            if column['type'] == 'tree':
+                tree[column['name']] = values
+            else:
+                name = column['name']
+                for row, value in zip(rows, values):
+                    row[name] = value
+    finally:
+        data.close()
+
+    return Ontology.from_ordered_structures([ Structure(row) for row in rows ], header['headers'], header['root_id'],
+                                            *[ tree[name] for name in SNAPSHOT_TREE_ARRAYS ])
+
+def int_or_str(value):
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+# Read an ontology, using a snapshot of the CSV file if it is up to date and
+# (re)building the snapshot otherwise.  The snapshot is considered up to date
+# if it was built from a CSV file with the same size and modification time,
+# or failing that the same checksum.
+def load(csv_file_name, root_id, snapshot_file_name=None):
+    if snapshot_file_name is None:
+        snapshot_file_name = snapshot_file_name_for(csv_file_name)
+
+    header = None
+    if os.path.exists(snapshot_file_name):
+        with open(snapshot_file_name, 'rb') as f:
+            header = read_snapshot_header(f)
+
+    if header and header['root_id'] == root_id:
+        source = header['source']
+        if source['size'] == os.path.getsize(csv_file_name) and source['mtime'] == os.path.getmtime(csv_file_name):
+            return read_snapshot(snapshot_file_name)
+
+        signature = file_signature(csv_file_name)
+        if source['sha1'] == signature['sha1']:
+            o = read_snapshot(snapshot_file_name)
+
+            # Record the new modification time so the next check is cheap.
+            write_snapshot(o, snapshot_file_name, signature)
+            return o
+
+    signature = file_signature(csv_file_name)
+    o = read_from_csv(csv_file_name, root_id)
+    write_snapshot(o, snapshot_file_name, signature)
+    return o
+
 # Run this script as is to read in the ontology from the default location and 
 # run a couple simple queries.
 if __name__ == "__main__":
-    ontology = read_from_csv('meta/structures.csv', Ontology.DEVELOPING_MOUSE_ROOT_STRUCTURE_ID)
+    ontology = load('meta/structures.csv', Ontology.DEVELOPING_MOUSE_ROOT_STRUCTURE_ID)
 
     root = ontology.root
     print "Root structure name:", root
@@ -0,0 +1,309 @@
+import argparse
+import os
+import re
+import numpy as np
+import metaimage
+import ontology
+import unionize
+
+# Downsampled copies of the downloaded volumes, and compact per-structure
+# masks, so that viewers can draw an overview or a region without reading a
+# full resolution volume.
+#
+# Each volume in atlas/, annotation/ and energy/ is reduced by factors of 2,
+# 4 and 8 along every axis.  Energy and atlas volumes are averaged over each
+# 2x2x2 block (negative, i.e. missing, energies are left out of the average,
+# and a block with no valid energy is -1); annotation volumes take the most
+# common label of each block.  Each level is built from the one before it.
+# Levels are written as MetaImage volumes:
+#
+#    pyramid/<directory>/<volume name>_<factor>x.mhd
+#
+# For every annotation volume, the voxels of each label are run-length
+# encoded in file order and saved with the bounding box of every structure
+# and its descendants, next to the volume as <volume name>_masks.npz.  They
+# are read with StructureMasks.
+#
+# Run this file as a script from within the directory where you downloaded
+# the data set.  Volumes whose pyramids are newer than the volume itself are
+# skipped.
+#
+#    $ python pyramid.py
+#    $ python pyramid.py --levels 2 4 --directories annotation/
+
+PYRAMID_DIRECTORY = 'pyramid/'
+ONTOLOGY_FILE_NAME = 'meta/structures.csv'
+VOLUME_DIRECTORIES = ['atlas/', 'annotation/', 'energy/']
+
+LEVELS = [2, 4, 8]
+
+# Number of output planes computed at a time from a full resolution volume.
+SLAB_PLANES = 16
+
+# Arrange a volume as 2x2x2 blocks: the result is indexed [z, y, x, voxel],
+# with half the size along each axis (rounded up).  Odd dimensions are padded
+# with 'fill', or by repeating the last plane if 'fill' is None.
+def blocks(volume, fill=None):
+    padding = [ (0, n % 2) for n in volume.shape ]
+    if any(after for before, after in padding):
+        if fill is None:
+            volume = np.pad(volume, padding, mode='edge')
+        else:
+            volume = np.pad(volume, padding, mode='constant', constant_values=fill)
+
+    nz, ny, nx = [ n // 2 for n in volume.shape ]
+    return volume.reshape(nz, 2, ny, 2, nx, 2).transpose(0, 2, 4, 1, 3, 5).reshape(nz, ny, nx, 8)
+
+# Average each 2x2x2 block, weighting each voxel by 'weights' (the number of
+# full resolution voxels it stands for).  Returns the averages, with -1
+# where a block has no weight, and the weight of each block.
+def downsample_mean(values, weights):
+    values = blocks(np.asarray(values, dtype=np.float64), 0)
+    weights = blocks(weights, 0)
+
+    total_weights = weights.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = (values * weights).sum(axis=-1) / total_weights
+    means[total_weights == 0] = -1
+
+    return means, total_weights
+
+# Take the most common value of each 2x2x2 block.  Ties go to the value that
+# comes first in the block.
+def downsample_mode(labels):
+    labels = blocks(labels)
+    counts = (labels[..., :, None] == labels[..., None, :]).sum(axis=-1)
+    choice = counts.argmax(axis=-1)
+    return labels.reshape(-1, 8)[np.arange(choice.size), choice.reshape(-1)].reshape(choice.shape)
+
+# File name of one level of a volume's pyramid.
+def level_file_name(mhd_file_name, factor, pyramid_directory=PYRAMID_DIRECTORY):
+    directory = os.path.basename(os.path.dirname(os.path.abspath(mhd_file_name)))
+    base = re.sub(r'\.mhd$', '', os.path.basename(mhd_file_name))
+    return os.path.join(pyramid_directory, directory, '%s_%dx.mhd' % (base, factor))
+
+# Cast downsampled values back to the type of the source volume.
+def as_type(values, dtype):
+    dtype = np.dtype(dtype).newbyteorder('=')
+    if dtype.kind in 'iu':
+        info = np.iinfo(dtype)
+        values = np.clip(np.rint(values), info.min, info.max)
+    return values.astype(dtype)
+
+# Build the pyramid of one volume.  'mode' is 'mean' to average blocks, or
+# 'mean_valid' to also leave out negative values, or 'mode' to take the most
+# common value.  Returns the file names of the levels.
+def build_pyramid(mhd_file_name, mode, levels=LEVELS, pyramid_directory=PYRAMID_DIRECTORY):
+    image = metaimage.MetaImage(mhd_file_name)
+    assert len(image.shape) == 3, "%s: only single channel 3D volumes are supported" % mhd_file_name
+
+    # The first level is computed from slabs of the full resolution volume,
+    # so that the whole volume is never in memory at once.
+    values = []
+    weights = []
+    for z in xrange(0, image.shape[0], 2 * SLAB_PLANES):
+        slab = image.read_block(slice(z, z + 2 * SLAB_PLANES))
+        if mode == 'mode':
+            values.append(downsample_mode(slab))
+        else:
+            slab_weights = (slab >= 0) if mode == 'mean_valid' else np.ones(slab.shape, dtype=bool)
+            slab_values, slab_weights = downsample_mean(slab, slab_weights.astype(np.int64))
+            values.append(slab_values)
+            weights.append(slab_weights)
+
+    values = np.concatenate(values)
+    weights = np.concatenate(weights) if weights else None
+    spacing = list(image.spacing)
+
+    file_names = []
+    factor = 1
+    for level in sorted(levels):
+        while factor < level:
+            if factor > 1:
+                if mode == 'mode':
+                    values = downsample_mode(values)
+                else:
+                    values, weights = downsample_mean(values, weights)
+            factor *= 2
+            spacing = [ s * 2 for s in spacing ]
+
+        file_name = level_file_name(mhd_file_name, factor, pyramid_directory)
+        if not os.path.exists(os.path.dirname(file_name)):
+            os.makedirs(os.path.dirname(file_name))
+
+        if mode == 'mean_valid':
+            metaimage.write_metaimage(file_name, values.astype(np.float32), spacing)
+        else:
+            metaimage.write_metaimage(file_name, as_type(values, image.dtype), spacing)
+        file_names.append(file_name)
+
+    return file_names
+
+# File name of the masks of an annotation volume.
+def masks_file_name(annotation_mhd_file_name):
+    return re.sub(r'\.mhd$', '', annotation_mhd_file_name) + '_masks.npz'
+
+# Run-length encode the voxels of each label, and find the bounding box of
+# every structure and its descendants, from the annotation's label index.
+def build_masks(o, annotation_mhd_file_name):
+    annotation = metaimage.MetaImage(annotation_mhd_file_name)
+    labels, starts, order = unionize.cached_label_index(annotation_mhd_file_name)
+    order = np.asarray(order, dtype=np.int64)
+
+    # The index is a stable sort, so each label's offsets are ascending.  A
+    # run ends where the label changes or the offsets stop being consecutive.
+    breaks = np.ones(len(order), dtype=bool)
+    breaks[1:] = np.diff(order) != 1
+    breaks[starts] = True
+    run_starts = np.flatnonzero(breaks)
+
+    run_offsets = order[run_starts]
+    run_lengths = np.diff(np.append(run_starts, len(order)))
+    label_runs = np.searchsorted(run_starts, np.append(starts, len(order)))
+
+    # Bounding boxes, rolled up the ontology over each structure's
+    # contiguous range of descendants, as in unionize.rollup_arrays.
+    num_structures = len(o.ids)
+    indices = np.array([ o.structures[int(l)].index if int(l) in o.structures else -1 for l in labels ], dtype=np.int64)
+    known = indices >= 0
+
+    subtree_ends = np.frombuffer(o.subtree_ends, dtype=np.int32)
+    ranges = np.empty(2 * num_structures, dtype=np.int64)
+    ranges[0::2] = np.arange(num_structures)
+    ranges[1::2] = subtree_ends
+
+    coordinates = np.unravel_index(order, annotation.shape)
+    lower = np.full((num_structures, 3), -1, dtype=np.int64)
+    upper = np.full((num_structures, 3), -1, dtype=np.int64)
+
+    for axis in xrange(3 if len(order) else 0):
+        axis_min = np.full(num_structures + 1, np.iinfo(np.int64).max)
+        axis_min[indices[known]] = np.minimum.reduceat(coordinates[axis], starts)[known]
+        axis_max = np.full(num_structures + 1, -1, dtype=np.int64)
+        axis_max[indices[known]] = np.maximum.reduceat(coordinates[axis], starts)[known]
+
+        lower[:, axis] = np.minimum.reduceat(axis_min, ranges)[0::2]
+        upper[:, axis] = np.maximum.reduceat(axis_max, ranges)[0::2] + 1
+
+    empty = upper[:, 0] <= 0
+    lower[empty] = -1
+    upper[empty] = -1
+
+    # Offsets are stored as 32-bit integers whenever they fit.
+    if annotation.num_voxels < np.iinfo(np.uint32).max:
+        run_offsets = run_offsets.astype(np.uint32)
+
+    np.savez(masks_file_name(annotation_mhd_file_name),
+             shape=np.array(annotation.shape, dtype=np.int64), labels=labels, label_runs=label_runs,
+             run_offsets=run_offsets, run_lengths=run_lengths,
+             structure_ids=np.frombuffer(o.ids, dtype=np.int32), lower=lower, upper=upper)
+
+# Read access to the masks of an annotation volume.
+class StructureMasks(object):
+
+    def __init__(self, file_name, o):
+        masks = np.load(file_name)
+        assert np.array_equal(masks['structure_ids'], np.frombuffer(o.ids, dtype=np.int32)), \
+            "masks %s were built with a different ontology" % file_name
+
+        self.ontology = o
+        self.shape = tuple(int(n) for n in masks['shape'])
+        self.labels = masks['labels']
+        self.label_runs = masks['label_runs']
+        self.run_offsets = masks['run_offsets']
+        self.run_lengths = masks['run_lengths']
+        self.lower = masks['lower']
+        self.upper = masks['upper']
+
+        # The pre-order index of each label's structure, or -1.
+        self.label_indices = np.array([ o.structures[int(l)].index if int(l) in o.structures else -1
+                                        for l in self.labels ], dtype=np.int64)
+
+    # The bounding box of a structure and its descendants as (start, end)
+    # tuples of [z, y, x] coordinates, the end exclusive, or None if the
+    # structure is not annotated.  With a 'factor', the box is given in the
+    # voxels of that pyramid level.
+    def bbox(self, structure, factor=1):
+        if self.upper[structure.index, 0] < 0:
+            return None
+
+        lower = tuple(int(n) // factor for n in self.lower[structure.index])
+        upper = tuple(-(-int(n) // factor) for n in self.upper[structure.index])
+        return lower, upper
+
+    # The runs of a structure and its descendants, as arrays of volume
+    # offsets and lengths sorted by offset.
+    def runs(self, structure):
+        selected = np.flatnonzero((self.label_indices >= structure.index) & (self.label_indices < structure.subtree_end))
+        if not len(selected):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        runs = np.concatenate([ np.arange(self.label_runs[i], self.label_runs[i+1]) for i in selected ])
+        offsets = self.run_offsets[runs].astype(np.int64)
+        lengths = self.run_lengths[runs].astype(np.int64)
+
+        order = np.argsort(offsets, kind='mergesort')
+        return offsets[order], lengths[order]
+
+    # The volume offsets of every voxel in a structure and its descendants,
+    # in file order.
+    def voxel_offsets(self, structure):
+        offsets, lengths = self.runs(structure)
+        if not len(offsets):
+            return offsets
+
+        # Each voxel's offset is its run's offset plus its position in the
+        # run.
+        run_starts = np.cumsum(lengths) - lengths
+        return np.repeat(offsets - run_starts, lengths) + np.arange(int(lengths.sum()))
+
+    # A boolean mask of a structure and its descendants, cropped to its
+    # bounding box (or over the whole volume if 'crop' is False).  Returns
+    # the mask and the [z, y, x] coordinates of its first voxel.
+    def mask(self, structure, crop=True):
+        box = self.bbox(structure) if crop else ((0, 0, 0), self.shape)
+        if box is None:
+            return None, None
+
+        lower, upper = box
+        mask = np.zeros(self.shape, dtype=bool)
+        mask.flat[self.voxel_offsets(structure)] = True
+        return mask[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]], lower
+
+# The reduction used for the volumes in each download directory.
+def pyramid_mode(directory):
+    name = os.path.basename(os.path.normpath(directory))
+    return { 'annotation': 'mode', 'energy': 'mean_valid' }.get(name, 'mean')
+
+# True if every output file is newer than the volume.
+def is_current(mhd_file_name, output_file_names):
+    source_time = max(os.path.getmtime(mhd_file_name), os.path.getmtime(metaimage.MetaImage(mhd_file_name).raw_file_name))
+    return all(os.path.exists(f) and os.path.getmtime(f) >= source_time for f in output_file_names)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build downsampled pyramids of the downloaded volumes and per-structure masks.")
+    parser.add_argument('--levels', type=int, nargs='+', default=LEVELS, help="downsampling factors to write (powers of 2)")
+    parser.add_argument('--directories', nargs='+', default=VOLUME_DIRECTORIES, help="volume directories to process")
+    args = parser.parse_args()
+
+    assert all(level > 1 and level & (level - 1) == 0 for level in args.levels), "levels must be powers of 2"
+
+    o = ontology.load(ONTOLOGY_FILE_NAME, ontology.Ontology.DEVELOPING_MOUSE_ROOT_STRUCTURE_ID)
+
+    for directory in args.directories:
+        if not os.path.exists(directory):
+            continue
+
+        mode = pyramid_mode(directory)
+        for file_name in sorted(os.listdir(directory)):
+            if not file_name.endswith('.mhd'):
+                continue
+
+            mhd_file_name = os.path.join(directory, file_name)
+            if not is_current(mhd_file_name, [ level_file_name(mhd_file_name, level) for level in args.levels ]):
+                build_pyramid(mhd_file_name, mode, args.levels)
+                print "built pyramid of %s" % mhd_file_name
+
+            if mode == 'mode' and not is_current(mhd_file_name, [ masks_file_name(mhd_file_name) ]):
+                build_masks(o, mhd_file_name)
+                print "built masks of %s" % mhd_file_name
@@ -0,0 +1,346 @@
+import argparse
+import collections
+import csv
+import json
+import os
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import numpy as np
+import batch_unionize
+import expression_cube
+import metaimage
+import ontology
+import trajectories
+import unionize
+
+# A local HTTP service answering region-of-interest questions about the
+# downloaded data set, e.g. "what is the mean energy of Shh in the isthmus
+# and all of its descendants at P14?".  Run it from within the directory
+# where you downloaded the data set:
+#
+#    $ python roi_server.py --port 8013
+#
+# and ask it for JSON:
+#
+#    /roi?structure=is&gene=Shh&stage=P14
+#        unionize statistics of a structure and its descendants, for every
+#        probe of a gene (or one probe, with data_set_id=...)
+#    /top_genes?structure=is&stage=P14&n=20
+#        the probes with the highest mean energy in a structure
+#    /rank_structures?gene=Shh&stage=P14&n=20&min_volume=10
+#        the structures with the highest mean energy of a probe
+#
+# Structures may be given by acronym or database ID.  Statistics are rolled
+# up the ontology once per probe (see unionize.rollup_arrays), after which
+# every structure's statistics are a lookup, so the rollups are what is
+# kept hot: the label index of each annotation volume, each probe's rollup
+# and each stage's expression cube are held in LRU caches, bounded by bytes
+# where their entries are large.  Entries are keyed on the sizes and
+# modification times of the files they were computed from, so files that
+# change on disk are read again.  top_genes reads
+# the stage's expression cube when one has been built (see
+# expression_cube.py), and otherwise rolls up every probe of the stage.
+
+DATA_SETS_CSV = 'meta/data_sets.csv'
+ONTOLOGY_FILE_NAME = 'meta/structures.csv'
+
+DEFAULT_PORT = 8013
+
+# Number of entries kept in each cache, and the number of bytes of rollups.
+LABEL_INDEX_CACHE_SIZE = 8
+ROLLUP_CACHE_SIZE = 4096
+ROLLUP_CACHE_BYTES = 256 * 1024 * 1024
+CUBE_CACHE_SIZE = 6
+
+DEFAULT_RESULTS = 20
+
+# A thread-safe cache that discards the least recently used entries when it
+# holds more than 'max_entries' entries or, if 'size_of' is given, more than
+# 'max_bytes' bytes as measured by size_of(value).  Values are computed
+# outside the lock, so two threads asking for the same missing key at once
+# may both compute it.
+class LRUCache(object):
+
+    def __init__(self, max_entries, max_bytes=None, size_of=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        value = compute()
+        size = self.size_of(value) if self.size_of else 0
+
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+                self.bytes -= self.sizes.pop(key)
+
+            self.entries[key] = value
+            self.sizes[key] = size
+            self.bytes += size
+
+            # The newest entry is kept even if it is larger than the limit.
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries or
+                                             (self.max_bytes is not None and self.bytes > self.max_bytes)):
+                old_key, old_value = self.entries.popitem(last=False)
+                self.bytes -= self.sizes.pop(old_key)
+
+        return value
+
+    def stats(self):
+        with self.lock:
+            return { 'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses }
+
+# The number of bytes held by a dictionary of arrays.
+def arrays_size(arrays):
+    return sum(a.nbytes for a in arrays.itervalues())
+
+# Raised for queries that cannot be answered.  'status' is the HTTP status
+# to respond with.
+class QueryError(Exception):
+
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.status = status
+
+# Convert a numpy value to something JSON can hold.  Undefined values (e.g.
+# the mean of an empty structure) become None.
+def json_value(value):
+    value = value.item() if hasattr(value, 'item') else value
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+class RegionQueries(object):
+
+    def __init__(self, o, data_sets_csv=DATA_SETS_CSV,
+                 energy_directory=batch_unionize.ENERGY_DIRECTORY, annotation_directory=batch_unionize.ANNOTATION_DIRECTORY,
+                 cube_directory=expression_cube.CUBE_DIRECTORY):
+        self.ontology = o
+        self.energy_directory = energy_directory
+        self.annotation_directory = annotation_directory
+        self.cube_directory = cube_directory
+
+        with open(data_sets_csv, 'rb') as f:
+            self.data_sets = list(csv.DictReader(f))
+
+        self.data_sets_by_id = {}
+        self.data_sets_by_gene = {}
+        for data_set in self.data_sets:
+            data_set['stage'] = trajectories.stage_of(data_set['reference_space_name'])
+            self.data_sets_by_id[int(data_set['section_data_set_database_id'])] = data_set
+            self.data_sets_by_gene.setdefault(data_set['gene_acronym'], []).append(data_set)
+
+        self.ids = np.frombuffer(o.ids, dtype=np.int32)
+
+        self.label_indexes = LRUCache(LABEL_INDEX_CACHE_SIZE)
+        self.rollups = LRUCache(ROLLUP_CACHE_SIZE, ROLLUP_CACHE_BYTES, arrays_size)
+        self.cubes = LRUCache(CUBE_CACHE_SIZE)
+
+    def structure(self, value):
+        if value is None:
+            raise QueryError("a structure is required")
+
+        structure = self.ontology.get_structure(int(value)) if value.isdigit() else self.ontology.get_structure_by_acronym(value)
+        if structure is None:
+            raise QueryError("unknown structure %s" % value, 404)
+        return structure
+
+    # Find the data sets named by a query's 'data_set_id', or 'gene' and
+    # optional 'stage' parameters.
+    def find_data_sets(self, params):
+        if 'data_set_id' in params:
+            data_set = self.data_sets_by_id.get(int(params['data_set_id']))
+            if data_set is None:
+                raise QueryError("unknown data set %s" % params['data_set_id'], 404)
+            return [ data_set ]
+
+        if 'gene' not in params:
+            raise QueryError("a gene or data_set_id is required")
+
+        data_sets = self.data_sets_by_gene.get(params['gene'], [])
+        if 'stage' in params:
+            data_sets = [ d for d in data_sets if self.in_stage(d, params['stage']) ]
+        if not data_sets:
+            raise QueryError("no data sets for gene %s" % params['gene'], 404)
+        return data_sets
+
+    def in_stage(self, data_set, stage):
+        return data_set['stage'] == stage or data_set['reference_space_database_id'] == stage
+
+    def stage_data_sets(self, stage):
+        if stage is None:
+            raise QueryError("a stage is required")
+
+        data_sets = [ d for d in self.data_sets if self.in_stage(d, stage) ]
+        if not data_sets:
+            raise QueryError("no data sets for stage %s" % stage, 404)
+        return data_sets
+
+    def label_index(self, annotation_file_name):
+        with metaimage.MetaImage(annotation_file_name) as annotation:
+            key = (annotation_file_name, trajectories.file_signature([annotation_file_name, annotation.raw_file_name]))
+        return self.label_indexes.get(key, lambda: unionize.cached_label_index(annotation_file_name))
+
+    # The statistics of every structure for a data set, rolled up the
+    # ontology and parallel to its pre-order numbering.  The volumes are
+    # closed once the statistics are computed, so the server does not keep a
+    # file open for every volume it has visited.
+    def rollup(self, data_set):
+        annotation_file_name = self.annotation_directory + data_set['annotation_file_name']
+        energy_file_name = self.energy_directory + data_set['energy_file_name']
+
+        with metaimage.MetaImage(energy_file_name) as energy, metaimage.MetaImage(annotation_file_name) as annotation:
+            def compute():
+                metaimage.check_same_grid(energy, annotation)
+
+                labels, starts, order = self.label_index(annotation_file_name)
+                return unionize.rollup_arrays(self.ontology, labels, unionize.label_statistics(energy.flat, labels, starts, order))
+
+            key = (int(data_set['section_data_set_database_id']),
+                   trajectories.file_signature([energy_file_name, energy.raw_file_name, annotation_file_name, annotation.raw_file_name]))
+            return self.rollups.get(key, compute)
+
+    # The expression cube of a stage, or None if it has not been built.
+    def cube(self, data_sets):
+        prefix = '%s%s' % (self.cube_directory, data_sets[0]['reference_space_database_id'])
+        if not os.path.exists(prefix + '.json'):
+            return None
+        key = (prefix, trajectories.file_signature([ prefix + '.json', prefix + '.cube', prefix + '_voxels.npz' ]))
+        return self.cubes.get(key, lambda: expression_cube.ExpressionCube(prefix, self.ontology))
+
+    def describe(self, data_set):
+        return { 'data_set_id': int(data_set['section_data_set_database_id']),
+                 'gene': data_set['gene_acronym'],
+                 'stage': data_set['stage'] }
+
+    def roi(self, params):
+        structure = self.structure(params.get('structure'))
+
+        results = []
+        for data_set in self.find_data_sets(params):
+            totals = self.rollup(data_set)
+            result = self.describe(data_set)
+            result.update((field, json_value(totals[field][structure.index])) for field in unionize.UNIONIZE_FIELDS)
+            results.append(result)
+
+        return { 'structure_id': structure['database_id'], 'acronym': structure['acronym'], 'results': results }
+
+    def top_genes(self, params):
+        structure = self.structure(params.get('structure'))
+        data_sets = self.stage_data_sets(params.get('stage'))
+        n = int(params.get('n', DEFAULT_RESULTS))
+
+        cube = self.cube(data_sets)
+        if cube is not None:
+            means = cube.region_means(structure)
+            scored = [ (self.data_sets_by_id[d], m) for d, m in zip(cube.data_set_ids, means) if d in self.data_sets_by_id ]
+        else:
+            scored = [ (d, self.rollup(d)['mean'][structure.index]) for d in data_sets ]
+
+        scored = [ (d, m) for d, m in scored if np.isfinite(m) ]
+        scored.sort(key=lambda s: -s[1])
+
+        results = []
+        for data_set, mean in scored[:n]:
+            result = self.describe(data_set)
+            result['mean'] = json_value(mean)
+            results.append(result)
+
+        return { 'structure_id': structure['database_id'], 'acronym': structure['acronym'], 'results': results }
+
+    def rank_structures(self, params):
+        n = int(params.get('n', DEFAULT_RESULTS))
+        min_volume = int(params.get('min_volume', 1))
+
+        results = []
+        for data_set in self.find_data_sets(params):
+            totals = self.rollup(data_set)
+            candidates = np.flatnonzero(totals['volume'] >= max(min_volume, 1))
+            ranked = candidates[np.argsort(-totals['mean'][candidates], kind='mergesort')][:n]
+
+            result = self.describe(data_set)
+            result['structures'] = [ { 'structure_id': int(self.ids[i]),
+                                       'acronym': self.ontology.ordered_structures[i]['acronym'],
+                                       'mean': json_value(totals['mean'][i]),
+                                       'volume': json_value(totals['volume'][i]) } for i in ranked ]
+            results.append(result)
+
+        return { 'results': results }
+
+    def cache_stats(self, params):
+        return { 'label_indexes': self.label_indexes.stats(),
+                 'rollups': self.rollups.stats(),
+                 'cubes': self.cubes.stats() }
+
+class RegionQueryHandler(BaseHTTPRequestHandler):
+
+    ENDPOINTS = {
+        '/roi': RegionQueries.roi,
+        '/top_genes': RegionQueries.top_genes,
+        '/rank_structures': RegionQueries.rank_structures,
+        '/cache': RegionQueries.cache_stats
+    }
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict((k, v[-1]) for k, v in urlparse.parse_qs(url.query).iteritems())
+
+        endpoint = self.ENDPOINTS.get(url.path)
+        try:
+            if endpoint is None:
+                raise QueryError("unknown endpoint %s" % url.path, 404)
+            status, response = 200, endpoint(self.server.queries, params)
+        except QueryError as e:
+            status, response = e.status, { 'error': str(e) }
+        except ValueError as e:
+            status, response = 400, { 'error': str(e) }
+        except Exception as e:
+            # e.g. a missing or corrupt volume.
+            self.log_error("%s failed: %r", self.path, e)
+            status, response = 500, { 'error': "%s: %s" % (type(e).__name__, e) }
+
+        body = json.dumps(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class RegionQueryServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, queries):
+        HTTPServer.__init__(self, address, RegionQueryHandler)
+        self.queries = queries
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve region-of-interest expression queries over HTTP.")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="port to listen on")
+    args = parser.parse_args()
+
+    o = ontology.load(ONTOLOGY_FILE_NAME, ontology.Ontology.DEVELOPING_MOUSE_ROOT_STRUCTURE_ID)
+    server = RegionQueryServer((args.host, args.port), RegionQueries(o))
+
+    print "serving on http://%s:%d/" % (args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
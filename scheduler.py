@@ -0,0 +1,288 @@
+import Queue
+import random
+import sys
+import threading
+import time
+import zipfile
+
+# A small thread pool for running many downloads concurrently.  Downloads are
+# submitted as tasks (a function plus its arguments) tagged with the host they
+# talk to.  Workers can limit the rate at which tasks start per host, retry
+# transient failures with exponential backoff, and a reporter thread
+# periodically prints the number of finished tasks, throughput and estimated
+# time remaining to stderr.
+#
+# The scheduler only sees tasks, not the HTTP requests they make (a query
+# task fetches several pages at once), so to cap the load on a server limit
+# its requests with api.configure_rate_limit instead.
+#
+#    scheduler = DownloadScheduler(num_workers=8)
+#    for data_set_id in data_set_ids:
+#        scheduler.submit(api.download_grid_file, (data_set_id, 'energy/'))
+#    for task in scheduler.run():
+#        print task.result
+#
+# Tasks can depend on other tasks: a task submitted with 'after' is only
+# started once those tasks have finished, and fails without running if any
+# of them failed, unless it was submitted with allow_failed=True (for tasks
+# that look at the outcome of the tasks they wait for).  Tasks may also
+# submit new tasks while the scheduler is running, so work that is only
+# known once an earlier task finishes (e.g. a download per row of a query)
+# can be added as it is discovered.  run() returns once every task,
+# including those added while running, is done.
+
+# Errors that are worth retrying.  urllib reports network failures and HTTP
+# errors as IOErrors, and a truncated transfer shows up as a bad zip file.
+TRANSIENT_ERRORS = (IOError, zipfile.BadZipfile)
+
+# A unit of work for the scheduler.  After the scheduler runs, 'result' holds
+# the return value of the function, or 'error' holds the last exception if
+# every attempt failed.
+class DownloadTask(object):
+
+    def __init__(self, func, args, host, size_of, after=(), allow_failed=False):
+        self.func = func
+        self.args = args
+        self.host = host
+        self.size_of = size_of
+        self.after = list(after)
+        self.allow_failed = allow_failed
+        self.result = None
+        self.error = None
+        self.attempts = 0
+        self.finished = False
+
+    # A short description for messages, e.g. 'download_grid_file(103)'.
+    # Only the first argument is shown, and only if it is a number, a short
+    # string or a collection, which is shown by its size.
+    def __str__(self):
+        description = ''
+        if self.args:
+            arg = self.args[0]
+            if isinstance(arg, (int, long, float)) or (isinstance(arg, basestring) and len(arg) <= 40):
+                description = str(arg)
+            elif isinstance(arg, (list, tuple, set, frozenset, dict)):
+                description = "%d items" % len(arg)
+        return "%s(%s)" % (self.func.__name__, description)
+
+# The error of a task that did not run because a task it depends on failed.
+class DependencyError(Exception):
+    pass
+
+# Enforce a minimum interval between the starts of requests (or tasks) to
+# each host.
+class HostRateLimiter(object):
+
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self.next_start = {}
+        self.lock = threading.Lock()
+
+    # Block until a request to the host is allowed to start.
+    def wait(self, host):
+        if self.interval <= 0:
+            return
+
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_start.get(host, now))
+            self.next_start[host] = start + self.interval
+
+        if start > now:
+            time.sleep(start - now)
+
+# Keep track of finished tasks and bytes transferred, and print the overall
+# throughput and estimated time remaining.
+class ProgressReport(object):
+
+    def __init__(self, total_tasks, stream=sys.stderr):
+        self.total_tasks = total_tasks
+        self.finished_tasks = 0
+        self.failed_tasks = 0
+        self.total_bytes = 0
+        self.start_time = time.time()
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def task_added(self):
+        with self.lock:
+            self.total_tasks += 1
+
+    def task_finished(self, num_bytes, failed=False):
+        with self.lock:
+            self.finished_tasks += 1
+            self.total_bytes += num_bytes
+            if failed:
+                self.failed_tasks += 1
+
+    def report(self):
+        with self.lock:
+            elapsed = max(time.time() - self.start_time, 1e-6)
+            remaining = self.total_tasks - self.finished_tasks
+
+            if self.finished_tasks > 0:
+                eta = "%ds" % (elapsed / self.finished_tasks * remaining)
+            else:
+                eta = "unknown"
+
+            self.stream.write("[%d/%d done, %d failed] %.1f MB at %.2f MB/s, %.1f tasks/s, ETA %s\n" %
+                              (self.finished_tasks, self.total_tasks, self.failed_tasks,
+                               self.total_bytes / 1e6, self.total_bytes / 1e6 / elapsed,
+                               self.finished_tasks / elapsed, eta))
+            self.stream.flush()
+
+class DownloadScheduler(object):
+
+    # num_workers: number of concurrent downloads.
+    # requests_per_second: maximum rate at which tasks start per host (None for no limit).
+    #     This does not count the HTTP requests within a task; see api.configure_rate_limit.
+    # max_attempts: how many times a task is tried before giving up.
+    # backoff_seconds: delay before the first retry; doubled on every retry.
+    # report_interval: seconds between progress reports (None to disable).
+    def __init__(self, num_workers=8, requests_per_second=None, max_attempts=5,
+                 backoff_seconds=1.0, report_interval=10.0):
+        self.num_workers = num_workers
+        self.rate_limiter = HostRateLimiter(requests_per_second)
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.report_interval = report_interval
+        self.tasks = []
+
+        # State of the current run: the queue of runnable tasks, the tasks
+        # waiting for others to finish, and the number of unfinished tasks.
+        self.lock = threading.Lock()
+        self.queue = None
+        self.waiting = []
+        self.unfinished = 0
+        self.progress = None
+
+    # Queue a call to func(*args).  'size_of' is an optional function that
+    # returns the number of bytes a task downloaded given its result, for the
+    # throughput report.  'after' lists tasks that must finish successfully
+    # before this one starts, or just finish, with allow_failed=True.  Tasks
+    # can be submitted while the scheduler runs.
+    def submit(self, func, args=(), host='default', size_of=None, after=(), allow_failed=False):
+        task = DownloadTask(func, args, host, size_of, after, allow_failed)
+        with self.lock:
+            self.tasks.append(task)
+            if self.queue is not None:
+                self.unfinished += 1
+                self.progress.task_added()
+                self.waiting.append(task)
+                self.release_waiting()
+        return task
+
+    # Queue the waiting tasks whose dependencies have finished, and fail
+    # those with a failed dependency.  Called with the lock held.
+    def release_waiting(self):
+        released = True
+        while released:
+            released = False
+            for task in list(self.waiting):
+                if not all(t.finished for t in task.after):
+                    continue
+
+                self.waiting.remove(task)
+                released = True
+
+                failed = [ t for t in task.after if t.error is not None and not task.allow_failed ]
+                if failed:
+                    task.error = DependencyError("%s depends on failed %s" % (task, ', '.join(str(t) for t in failed)))
+                    self.finish(task, 0)
+                else:
+                    self.queue.put(task)
+
+    # Record that a task is done.  Once every task is done, the workers are
+    # told to stop.  Called with the lock held.
+    def finish(self, task, num_bytes):
+        task.finished = True
+        self.unfinished -= 1
+        self.progress.task_finished(num_bytes, failed=task.error is not None)
+
+        if self.unfinished == 0:
+            for i in xrange(self.num_workers):
+                self.queue.put(None)
+
+    # Run one task, retrying transient failures with exponential backoff.
+    def run_task(self, task):
+        while True:
+            task.attempts += 1
+            self.rate_limiter.wait(task.host)
+
+            try:
+                task.result = task.func(*task.args)
+                task.error = None
+                return
+            except TRANSIENT_ERRORS as e:
+                task.error = e
+                if task.attempts >= self.max_attempts:
+                    print >> sys.stderr, "giving up on %s after %d attempts: %s" % (task, task.attempts, e)
+                    return
+
+                delay = self.backoff_seconds * (2 ** (task.attempts - 1))
+                delay *= random.uniform(0.5, 1.5)
+                print >> sys.stderr, "retrying %s in %.1fs: %s" % (task, delay, e)
+                time.sleep(delay)
+            except Exception as e:
+                task.error = e
+                print >> sys.stderr, "failed %s: %s" % (task, e)
+                return
+
+    def worker(self, queue):
+        while True:
+            task = queue.get()
+            if task is None:
+                return
+
+            self.run_task(task)
+
+            num_bytes = 0
+            if task.error is None and task.size_of is not None:
+                try:
+                    num_bytes = task.size_of(task.result)
+                except (IOError, OSError):
+                    pass
+
+            with self.lock:
+                self.finish(task, num_bytes)
+                self.release_waiting()
+
+    # Run every submitted task, and any tasks they submit, and wait for them
+    # all to finish.  Returns the tasks in submission order.  Tasks that
+    # failed have their 'error' set.
+    def run(self):
+        with self.lock:
+            tasks = self.tasks
+            self.queue = queue = Queue.Queue()
+            self.progress = progress = ProgressReport(len(tasks))
+            self.waiting = list(tasks)
+            self.unfinished = len(tasks)
+
+            self.release_waiting()
+
+        workers = [ threading.Thread(target=self.worker, args=(queue,))
+                    for i in xrange(self.num_workers if tasks else 0) ]
+
+        for w in workers:
+            w.daemon = True
+            w.start()
+
+        # Wait for the workers, reporting progress periodically.  Joining with
+        # a timeout keeps the main thread responsive to KeyboardInterrupt.
+        last_report = time.time()
+        for w in workers:
+            while w.is_alive():
+                w.join(1.0)
+                if self.report_interval and time.time() - last_report >= self.report_interval:
+                    progress.report()
+                    last_report = time.time()
+
+        with self.lock:
+            tasks = self.tasks
+            self.tasks = []
+            self.queue = None
+
+        if self.report_interval and tasks:
+            progress.report()
+
+        return tasks
@@ -0,0 +1,255 @@
+import argparse
+import json
+import os
+from multiprocessing import Pool, cpu_count
+import numpy as np
+import batch_unionize
+import expression_cube
+import ontology
+import sparse_energy
+import unionize
+
+# Find genes with similar spatial expression.  Similarities are computed
+# between the columns of an expression cube (see expression_cube.py), i.e.
+# between probes, over the annotated voxels of a stage (or of one
+# structure).  Voxels without data for a probe (negative energies, see
+# expression_cube.py) are left out, so every pair of probes is compared
+# over the voxels where both have data.  Every similarity is derived from
+# probes x probes matrices of products, sums, sums of squares and voxel
+# counts over those shared voxels, which are accumulated block by block over
+# the cube's rows with matrix products.  Row ranges are split across worker
+# processes.
+#
+# Two metrics are supported:
+#
+#    - 'cosine': the cosine of the angle between two probes' expression
+#    - 'correlation': the Pearson correlation of two probes' expression
+#
+# The same accumulation can be done from sparse energy volumes (see
+# sparse_energy.py), visiting only the voxels where some probe is nonzero.
+#
+# The top-k most similar probes of every probe can be saved as an index for
+# fast nearest neighbour queries.  Run this file as a script from within the
+# directory where you downloaded the data set, after building the cube (or
+# with --sparse, from the sparse volumes):
+#
+#    $ python similarity.py P14 --metric correlation --top 25
+#    $ python similarity.py P14 --metric correlation --query Shh
+
+METRICS = ['cosine', 'correlation']
+
+# Number of cube rows multiplied at a time.
+BLOCK_ROWS = 8192
+
+# The statistics a block of rows (voxels x probes, with negative values
+# missing) adds, as probes x probes matrices: the Gram matrix; sums[i, j],
+# the sum of probe i over the voxels where probe j has data; squares[i, j],
+# the same for the squares of probe i; and counts[i, j], the number of
+# voxels where both have data.  Missing values are zeroed, so they add
+# nothing to the products.
+def block_statistics(block):
+    valid = (block >= 0).astype(np.float64)
+    block = np.where(valid > 0, block, 0)
+    return np.dot(block.T, block), np.dot(block.T, valid), np.dot((block * block).T, valid), np.dot(valid.T, valid)
+
+def zero_statistics(num_probes):
+    return [ np.zeros((num_probes, num_probes), dtype=np.float64) for i in xrange(4) ]
+
+def add_statistics(totals, statistics):
+    for total, statistic in zip(totals, statistics):
+        total += statistic
+
+# Accumulate the statistics of a range of cube rows, with values
+# dequantized.  This runs in a worker process, so it opens the cube itself.
+def gram_block(args):
+    cube_file_name, precision, shape, row_start, row_end, scales, missing_code = args
+    matrix = np.memmap(cube_file_name, dtype=np.dtype(precision), mode='r', shape=tuple(shape))
+
+    totals = zero_statistics(shape[1])
+    for start in xrange(row_start, row_end, BLOCK_ROWS):
+        block = expression_cube.dequantize_values(matrix[start:min(start + BLOCK_ROWS, row_end)], scales, missing_code, np.float64)
+        add_statistics(totals, block_statistics(block))
+
+    return totals
+
+# Compute the Gram matrix, sums, sums of squares and voxel counts (see
+# block_statistics) over a range of cube rows (all rows by default) with
+# 'num_workers' processes.  Values are dequantized.
+def gram_matrix(cube, rows=None, num_workers=None):
+    if rows is None:
+        rows = slice(0, cube.matrix.shape[0])
+
+    num_workers = num_workers or 1
+    bounds = np.linspace(rows.start, rows.stop, num_workers + 1).astype(np.int64)
+    tasks = [ (cube.matrix.filename, cube.meta['precision'], cube.matrix.shape, int(bounds[i]), int(bounds[i+1]), cube.scales, cube.missing_code)
+              for i in xrange(num_workers) if bounds[i] < bounds[i+1] ]
+
+    if num_workers > 1 and len(tasks) > 1:
+        pool = Pool(num_workers)
+        try:
+            results = pool.map(gram_block, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [ gram_block(task) for task in tasks ]
+
+    totals = zero_statistics(cube.matrix.shape[1])
+    for statistics in results:
+        add_statistics(totals, statistics)
+
+    return totals
+
+# Turn the statistics of block_statistics into a similarity matrix.  Each
+# pair of probes is compared over the voxels where both have data.  Pairs
+# with no variation over those voxels (or none in common) have a similarity
+# of 0.
+def similarity_from_gram(gram, sums, squares, counts, metric='correlation'):
+    assert metric in METRICS, "metric must be one of %s" % ', '.join(METRICS)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if metric == 'correlation':
+            gram = gram - sums * sums.T / counts
+            squares = squares - sums * sums / counts
+
+        similarity = gram / np.sqrt(np.maximum(squares, 0) * np.maximum(squares.T, 0))
+    similarity[~np.isfinite(similarity)] = 0
+
+    return similarity.astype(np.float32)
+
+# Compute all-pairs similarity between the probes of a cube, optionally
+# restricted to the voxels of one structure and its descendants.
+def similarity_matrix(cube, metric='correlation', structure=None, num_workers=None):
+    rows = cube.structure_rows(structure) if structure is not None else None
+    return similarity_from_gram(*gram_matrix(cube, rows, num_workers), metric=metric)
+
+# Compute the statistics of block_statistics for sparse probes over
+# 'num_rows' voxels.  'entries' holds the (volume offsets, values) of each
+# probe's nonzero voxels.  The voxels where any probe is nonzero are
+# gathered into dense blocks of rows; all other voxels are zero for every
+# probe, so they only add to the voxel counts.
+def sparse_gram_matrix(entries, num_rows):
+    num_probes = len(entries)
+    orders = [ np.argsort(offsets, kind='mergesort') for offsets, values in entries ]
+    entries = [ (offsets[order], values[order]) for order, (offsets, values) in zip(orders, entries) ]
+    voxels = np.unique(np.concatenate([ offsets for offsets, values in entries ] + [ np.zeros(0, dtype=np.int64) ]))
+    rows = [ np.searchsorted(voxels, offsets) for offsets, values in entries ]
+
+    totals = zero_statistics(num_probes)
+    for start in xrange(0, len(voxels), BLOCK_ROWS):
+        end = min(start + BLOCK_ROWS, len(voxels))
+        block = np.zeros((end - start, num_probes), dtype=np.float64)
+
+        for j, (probe_rows, (offsets, values)) in enumerate(zip(rows, entries)):
+            first, last = np.searchsorted(probe_rows, [start, end])
+            block[probe_rows[first:last] - start, j] = values[first:last]
+
+        add_statistics(totals, block_statistics(block))
+
+    totals[3] += num_rows - len(voxels)
+    return totals
+
+# Compute all-pairs similarity between data sets from their sparse energy
+# volumes, over the annotated voxels of the ontology or of one structure
+# and its descendants.  The data sets must share an annotation volume.
+def sparse_similarity_matrix(data_sets, o, metric='correlation', structure=None,
+                             energy_directory=batch_unionize.ENERGY_DIRECTORY, annotation_directory=batch_unionize.ANNOTATION_DIRECTORY):
+    annotation_file_names = set(d['annotation_file_name'] for d in data_sets)
+    assert len(annotation_file_names) == 1, "data sets do not share an annotation volume"
+    annotation_file_name = annotation_directory + annotation_file_names.pop()
+
+    labels, starts, num_voxels = unionize.cached_label_starts(annotation_file_name)
+
+    entries = []
+    num_rows = 0
+    for data_set in data_sets:
+        sparse = sparse_energy.load_sparse(energy_directory + data_set['energy_file_name'], annotation_file_name)
+        offsets, values, num_rows = sparse_energy.region_entries(sparse, o, labels, starts, num_voxels, structure)
+        entries.append((offsets.astype(np.int64), values))
+
+    return similarity_from_gram(*sparse_gram_matrix(entries, num_rows), metric=metric)
+
+# Find the k most similar probes of every probe (excluding itself).
+# Returns the column indices and similarities of the neighbours, most
+# similar first.
+def top_k(similarity, k):
+    similarity = similarity.copy()
+    np.fill_diagonal(similarity, -np.inf)
+
+    k = min(k, similarity.shape[1] - 1)
+    if k <= 0:
+        return np.zeros((similarity.shape[0], 0), dtype=np.int32), np.zeros((similarity.shape[0], 0), dtype=np.float32)
+
+    rows = np.arange(similarity.shape[0])[:, None]
+    neighbours = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+    scores = similarity[rows, neighbours]
+
+    order = np.argsort(-scores, axis=1)
+    neighbours = neighbours[rows, order]
+    scores = scores[rows, order]
+
+    return neighbours.astype(np.int32), scores.astype(np.float32)
+
+def index_file_name(prefix, metric):
+    return '%s_similar_%s.npz' % (prefix, metric)
+
+# Save the nearest neighbour index of a similarity matrix between the given
+# data sets.
+def save_index(similarity, data_set_ids, prefix, metric='correlation', k=25):
+    neighbours, scores = top_k(similarity, k)
+    np.savez(index_file_name(prefix, metric), data_set_ids=np.array(data_set_ids, dtype=np.int64),
+             neighbours=neighbours, scores=scores)
+
+# Compute and save the nearest neighbour index of a cube.
+def build_index(cube, prefix, metric='correlation', k=25, num_workers=None):
+    save_index(similarity_matrix(cube, metric, num_workers=num_workers), cube.data_set_ids, prefix, metric, k)
+
+# A saved nearest neighbour index.
+class SimilarityIndex(object):
+
+    def __init__(self, file_name):
+        index = np.load(file_name)
+        self.data_set_ids = index['data_set_ids']
+        self.neighbours = index['neighbours']
+        self.scores = index['scores']
+        self.columns = { int(d): i for i, d in enumerate(self.data_set_ids) }
+
+    # The k most similar data sets to a data set, as (data set id, score)
+    # pairs, most similar first.
+    def nearest(self, data_set_id, k=10):
+        i = self.columns[data_set_id]
+        return [ (int(self.data_set_ids[j]), float(s)) for j, s in zip(self.neighbours[i, :k], self.scores[i, :k]) ]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find probes with similar expression in a developmental stage.")
+    parser.add_argument('stage', help="reference space database ID or age name (e.g. P14)")
+    parser.add_argument('--metric', choices=METRICS, default='correlation')
+    parser.add_argument('--top', type=int, default=25, help="number of neighbours to keep per probe")
+    parser.add_argument('--workers', type=int, default=cpu_count(), help="number of worker processes (default: one per core)")
+    parser.add_argument('--query', help="print the nearest neighbours of this gene acronym instead of building the index")
+    parser.add_argument('--sparse', action='store_true', help="build the index from sparse energy volumes instead of the cube")
+    args = parser.parse_args()
+
+    data_sets = batch_unionize.read_stage_data_sets(batch_unionize.DATA_SETS_CSV, args.stage)
+    assert data_sets, "no data sets found for stage %s" % args.stage
+    prefix = '%s%s' % (expression_cube.CUBE_DIRECTORY, data_sets[0]['reference_space_database_id'])
+
+    o = ontology.load(batch_unionize.ONTOLOGY_FILE_NAME, ontology.Ontology.DEVELOPING_MOUSE_ROOT_STRUCTURE_ID)
+
+    if args.query:
+        index = SimilarityIndex(index_file_name(prefix, args.metric))
+        genes = dict((int(d['section_data_set_database_id']), d['gene_acronym']) for d in data_sets)
+        for data_set_id in [ int(d) for d in index.data_set_ids ]:
+            if genes.get(data_set_id) == args.query:
+                print json.dumps({ 'data_set_id': data_set_id, 'gene': args.query,
+                                   'nearest': [ { 'data_set_id': d, 'gene': genes[d], 'score': s }
+                                                for d, s in index.nearest(data_set_id, args.top) ] })
+    elif args.sparse:
+        if not os.path.exists(expression_cube.CUBE_DIRECTORY):
+            os.makedirs(expression_cube.CUBE_DIRECTORY)
+        save_index(sparse_similarity_matrix(data_sets, o, args.metric), [ int(d['section_data_set_database_id']) for d in data_sets ],
+                   prefix, args.metric, args.top)
+        print "wrote %s" % index_file_name(prefix, args.metric)
+    else:
+        build_index(expression_cube.ExpressionCube(prefix, o), prefix, args.metric, args.top, args.workers)
+        print "wrote %s" % index_file_name(prefix, args.metric)
@@ -0,0 +1,222 @@
+import argparse
+import csv
+import os
+import re
+import tempfile
+import numpy as np
+import api
+import metaimage
+import unionize
+
+# A sparse copy of an energy volume: only the voxels that have a nonzero
+# energy and are annotated (annotation ID other than 0), with each voxel's
+# annotation label stored alongside.  Most of an energy volume is zero or
+# outside the brain, so this is a small fraction of the dense volume, and
+# unionizing or comparing probes from it costs time and memory in
+# proportion to the expressing voxels rather than the whole grid.
+#
+# A sparse volume is saved next to its energy volume as
+# <volume name>_sparse.npz, holding:
+#
+#    - offsets: the voxels' offsets in the volume, grouped by label and in
+#      file order within each label
+#    - values: the voxels' energies
+#    - labels: the voxels' annotation labels (ascending)
+#    - signature: the sizes and modification times of the energy and
+#      annotation data files it was built from
+#
+# The number of voxels of each label, which the zeros contribute to, comes
+# from the labels and label starts of the annotation's label index (see
+# unionize.cached_label_starts); its per-voxel permutation is never loaded.
+#
+# Run this file as a script from within the directory where you downloaded
+# the data set to build the sparse volumes of every probe (or one stage):
+#
+#    $ python sparse_energy.py
+#    $ python sparse_energy.py P14
+
+DATA_SETS_CSV = 'meta/data_sets.csv'
+ENERGY_DIRECTORY = 'energy/'
+ANNOTATION_DIRECTORY = 'annotation/'
+
+# Number of planes scanned at a time while building a sparse volume.
+SLAB_PLANES = 16
+
+def sparse_file_name(energy_mhd_file_name):
+    return re.sub(r'\.mhd$', '', energy_mhd_file_name) + '_sparse.npz'
+
+# Describe the data files a sparse volume is built from.
+def signature(energy, annotation):
+    return np.array([ os.path.getsize(energy.raw_file_name), os.path.getmtime(energy.raw_file_name),
+                      os.path.getsize(annotation.raw_file_name), os.path.getmtime(annotation.raw_file_name) ])
+
+# Build and save the sparse volume of an energy volume.  The dense volume is
+# scanned a slab at a time.
+def build_sparse(energy_mhd_file_name, annotation_mhd_file_name):
+    energy = metaimage.MetaImage(energy_mhd_file_name)
+    annotation = metaimage.MetaImage(annotation_mhd_file_name)
+    metaimage.check_same_grid(energy, annotation)
+
+    plane_voxels = int(np.prod(energy.shape[1:]))
+    offsets = []
+    values = []
+    labels = []
+
+    for z in xrange(0, energy.shape[0], SLAB_PLANES):
+        slab_values = energy.read_block(slice(z, z + SLAB_PLANES)).reshape(-1)
+        slab_labels = annotation.read_block(slice(z, z + SLAB_PLANES)).reshape(-1)
+
+        keep = np.flatnonzero((slab_values != 0) & (slab_labels != 0))
+        offsets.append(keep + z * plane_voxels)
+        values.append(slab_values[keep])
+        labels.append(slab_labels[keep])
+
+    offsets = np.concatenate(offsets)
+    values = np.concatenate(values)
+    labels = np.concatenate(labels)
+
+    # Group by label.  The sort is stable, so offsets stay in file order
+    # within each label.
+    order = np.argsort(labels, kind='mergesort')
+
+    if energy.num_voxels < np.iinfo(np.uint32).max:
+        offsets = offsets.astype(np.uint32)
+
+    # Write to a uniquely named temporary file and rename it over the old
+    # volume, so that readers always find a complete file and processes
+    # building the same volume do not write over each other.
+    file_name = sparse_file_name(energy_mhd_file_name)
+    fd, temp_file_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)),
+                                          prefix='.' + os.path.basename(file_name), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, offsets=offsets[order], values=values[order].astype(energy.dtype.newbyteorder('=')),
+                     labels=labels[order].astype(annotation.dtype.newbyteorder('=')), shape=np.array(energy.shape, dtype=np.int64),
+                     signature=signature(energy, annotation))
+        api.rename_into_place(temp_file_name, file_name)
+    except:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+        raise
+
+    return len(offsets), energy.num_voxels
+
+class SparseEnergy(object):
+
+    def __init__(self, file_name):
+        sparse = np.load(file_name)
+        self.file_name = file_name
+        self.offsets = sparse['offsets']
+        self.values = sparse['values']
+        self.labels = sparse['labels']
+        self.shape = tuple(int(n) for n in sparse['shape'])
+        self.signature = sparse['signature']
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # The range of entries belonging to each of the given (sorted) labels.
+    def label_ranges(self, labels):
+        return np.searchsorted(self.labels, labels, 'left'), np.searchsorted(self.labels, labels, 'right')
+
+    # Expand into a dense, flat array.  Unannotated voxels are 0.
+    def dense(self):
+        flat = np.zeros(int(np.prod(self.shape)), dtype=self.values.dtype)
+        flat[self.offsets] = self.values
+        return flat
+
+# Load the sparse volume of an energy volume, building it first if it is
+# missing or was built from different files.
+def load_sparse(energy_mhd_file_name, annotation_mhd_file_name):
+    file_name = sparse_file_name(energy_mhd_file_name)
+
+    if os.path.exists(file_name):
+        sparse = SparseEnergy(file_name)
+        current = signature(metaimage.MetaImage(energy_mhd_file_name), metaimage.MetaImage(annotation_mhd_file_name))
+        if np.array_equal(sparse.signature, current):
+            return sparse
+
+    build_sparse(energy_mhd_file_name, annotation_mhd_file_name)
+    return SparseEnergy(file_name)
+
+# Compute the statistics of each annotation label from a sparse volume, as
+# unionize.label_statistics does from a dense one.  'labels' and 'starts'
+# are the annotation's label index and 'num_voxels' the size of the volume.
+# Only the label index and the sparse entries are read.  Unannotated voxels
+# (label 0) are not kept, so their statistics are those of zeros.
+def label_statistics(sparse, labels, starts, num_voxels):
+    counts = np.diff(np.append(starts, num_voxels))
+    first, last = sparse.label_ranges(labels)
+
+    values = np.asarray(sparse.values, dtype=np.float64)
+    expressing = values > 0
+
+    def range_sums(x):
+        prefix = np.concatenate(([0], np.cumsum(x)))
+        return prefix[last] - prefix[first]
+
+    # Entries are grouped by label, so the ranges of the labels that have
+    # entries are consecutive and reduceat covers each of them exactly.
+    nonempty = last > first
+    minimum = np.zeros(len(labels))
+    maximum = np.zeros(len(labels))
+    if len(values):
+        minimum[nonempty] = np.minimum.reduceat(values, first[nonempty])
+        maximum[nonempty] = np.maximum.reduceat(values, first[nonempty])
+
+    # Labels with fewer entries than voxels also have zeros.
+    has_zeros = (last - first) < counts
+    minimum[has_zeros] = np.minimum(minimum[has_zeros], 0)
+    maximum[has_zeros] = np.maximum(maximum[has_zeros], 0)
+
+    return {
+        'sum': range_sums(values),
+        'volume': counts,
+        'min': minimum,
+        'max': maximum,
+        'expressing_sum': range_sums(np.where(expressing, values, 0)),
+        'expressing_volume': range_sums(expressing.astype(np.int64))
+    }
+
+# Unionize an energy volume from its sparse form.  Returns the same
+# dictionary as unionize.unionize_files.
+def unionize_sparse(energy_mhd_file_name, annotation_mhd_file_name, o):
+    sparse = load_sparse(energy_mhd_file_name, annotation_mhd_file_name)
+    labels, starts, num_voxels = unionize.cached_label_starts(annotation_mhd_file_name)
+    return unionize.rollup(o, labels, label_statistics(sparse, labels, starts, num_voxels))
+
+# The entries of a sparse volume within a structure and its descendants (or
+# within any structure of the ontology), and the number of voxels there.
+def region_entries(sparse, o, labels, starts, num_voxels, structure=None):
+    counts = np.diff(np.append(starts, num_voxels))
+    indices = np.array([ o.structures[int(l)].index if int(l) in o.structures else -1 for l in labels ], dtype=np.int64)
+
+    if structure is None:
+        selected = indices >= 0
+    else:
+        selected = (indices >= structure.index) & (indices < structure.subtree_end)
+
+    first, last = sparse.label_ranges(labels[selected])
+    entries = np.concatenate([ np.arange(f, l) for f, l in zip(first, last) ] + [ np.zeros(0, dtype=np.int64) ])
+
+    return sparse.offsets[entries], sparse.values[entries], int(counts[selected].sum())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build sparse copies of the energy volumes.")
+    parser.add_argument('stage', nargs='?', help="reference space database ID or age name (default: every stage)")
+    args = parser.parse_args()
+
+    with open(DATA_SETS_CSV, 'rb') as f:
+        data_sets = list(csv.DictReader(f))
+
+    if args.stage:
+        data_sets = [ d for d in data_sets if args.stage in d['reference_space_name'].split() or
+                      args.stage in (d['reference_space_name'], d['reference_space_database_id']) ]
+
+    for data_set in data_sets:
+        energy_file_name = ENERGY_DIRECTORY + data_set['energy_file_name']
+        annotation_file_name = ANNOTATION_DIRECTORY + data_set['annotation_file_name']
+
+        sparse = load_sparse(energy_file_name, annotation_file_name)
+        print "%s: %d of %d voxels (%.1f%%)" % (energy_file_name, len(sparse), np.prod(sparse.shape),
+                                                100.0 * len(sparse) / max(np.prod(sparse.shape), 1))
@@ -0,0 +1,49 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ontology
+
+HEADERS = ['database_id', 'name', 'acronym', 'order', 'structure_database_id_path']
+
+# root
+#    a
+#       c
+#    b
+ROWS = [ ('1', 'root', 'R', '0', '/1/'),
+         ('2', 'alpha', 'A', '1', '/1/2/'),
+         ('3', 'beta', 'B', '3', '/1/3/'),
+         ('4', 'gamma', 'C', '2', '/1/2/4/') ]
+
+# Run with:
+#
+#    $ python -m unittest discover tests
+
+class StructureNodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.o = ontology.Ontology([ dict(zip(HEADERS, row)) for row in ROWS ], HEADERS, 1)
+
+    def test_nodes_match_structures(self):
+        for structure in self.o.ordered_structures:
+            node = self.o.get_node(structure['database_id'])
+            self.assertEqual(node.index, structure.index)
+            self.assertEqual(node.subtree_end, structure.subtree_end)
+            self.assertEqual(node.depth, structure.depth)
+            self.assertEqual(node['acronym'], structure['acronym'])
+            self.assertEqual([ c.database_id for c in node.children ], [ c['database_id'] for c in structure.children ])
+            self.assertEqual(node.parent.database_id if node.parent else None,
+                             structure.parent['database_id'] if structure.parent else None)
+
+    def test_descendants(self):
+        a = self.o.get_node(2)
+        self.assertEqual([ n.database_id for n in self.o.get_descendant_nodes(a) ], [2, 4])
+        self.assertTrue(self.o.get_node(4).descendent_of(a))
+        self.assertFalse(self.o.get_node(3).descendent_of(a))
+        self.assertTrue(a.descendent_of(self.o.get_structure(1)))
+        self.assertIsNone(self.o.get_node(5))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import similarity
+
+# Run with:
+#
+#    $ python -m unittest discover tests
+
+# Probes with nonzero expression in some voxels and no data (-1) in others.
+def random_probes(num_voxels=400, num_probes=6, seed=0):
+    random = np.random.RandomState(seed)
+    values = random.rand(num_voxels, num_probes) * (random.rand(num_voxels, num_probes) < 0.5)
+    values[random.rand(num_voxels, num_probes) < 0.4] = -1
+    values[:num_voxels // 2, 0] = -1
+    values[:num_voxels // 2, 1] = -1
+    return values
+
+class SimilarityTest(unittest.TestCase):
+
+    def expected(self, values, metric):
+        num_probes = values.shape[1]
+        expected = np.zeros((num_probes, num_probes))
+        for i in xrange(num_probes):
+            for j in xrange(num_probes):
+                shared = (values[:, i] >= 0) & (values[:, j] >= 0)
+                x, y = values[shared, i], values[shared, j]
+                if metric == 'correlation':
+                    expected[i, j] = np.corrcoef(x, y)[0, 1]
+                else:
+                    expected[i, j] = x.dot(y) / np.sqrt(x.dot(x) * y.dot(y))
+        return expected
+
+    def test_correlation_over_shared_voxels(self):
+        values = random_probes()
+        actual = similarity.similarity_from_gram(*similarity.block_statistics(values), metric='correlation')
+        np.testing.assert_allclose(actual, self.expected(values, 'correlation'), atol=1e-5)
+
+    def test_cosine_over_shared_voxels(self):
+        values = random_probes()
+        actual = similarity.similarity_from_gram(*similarity.block_statistics(values), metric='cosine')
+        np.testing.assert_allclose(actual, self.expected(values, 'cosine'), atol=1e-5)
+
+    def test_shared_missing_voxels_do_not_correlate(self):
+        # Independent probes that are both missing on the same half of the
+        # voxels.
+        values = random_probes(num_voxels=4000, seed=1)
+        actual = similarity.similarity_from_gram(*similarity.block_statistics(values), metric='correlation')
+        self.assertLess(abs(actual[0, 1]), 0.1)
+
+    def test_sparse_matches_dense(self):
+        values = random_probes()
+        entries = [ (np.flatnonzero(values[:, j]), values[values[:, j] != 0, j]) for j in xrange(values.shape[1]) ]
+        for metric in similarity.METRICS:
+            dense = similarity.similarity_from_gram(*similarity.block_statistics(values), metric=metric)
+            sparse = similarity.similarity_from_gram(*similarity.sparse_gram_matrix(entries, len(values)), metric=metric)
+            np.testing.assert_allclose(sparse, dense, atol=1e-5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import unionize_store
+
+HEADER = 'section_data_set_id,structure_id,expression_energy,sum_expressing_pixel_intensity,sum_pixels\n'
+
+# Run with:
+#
+#    $ python -m unittest discover tests
+
+class ReadUnionizeCsvTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, contents):
+        file_name = os.path.join(self.directory, '5.csv')
+        with open(file_name, 'wb') as f:
+            f.write(contents)
+        return unionize_store.read_unionize_csv(file_name)
+
+    def test_malformed_rows_are_skipped(self):
+        columns, malformed = self.read(HEADER + '5,6072,1.0,2,3\n5,6070,abc,1,2\n5,6071,0.5,,2\n5,60')
+        self.assertEqual(list(columns['structure_id']), [6072, 6071])
+        self.assertEqual([ row for row, problem in malformed ], [2, 4])
+
+    def test_missing_headers(self):
+        columns, malformed = self.read('a,b\n1,2\n')
+        self.assertEqual(len(columns['structure_id']), 0)
+        self.assertEqual([ row for row, problem in malformed ], [0])
+
+    def test_consolidate_skips_malformed_rows(self):
+        self.read(HEADER + '5,6072,1.0,2,3\n5,60')
+        store_file_name = os.path.join(self.directory, 'test.store')
+        self.assertEqual(unionize_store.consolidate(self.directory, store_file_name), 1)
+        store = unionize_store.UnionizeStore(store_file_name)
+        self.assertEqual(list(store.rows_for_data_set(5)['structure_id']), [6072])
+
+if __name__ == '__main__':
+    unittest.main()
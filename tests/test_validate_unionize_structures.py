@@ -0,0 +1,47 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import validate_unionize_structures as validate
+
+HEADER = 'section_data_set_id,structure_id,expression_energy,sum_expressing_pixel_intensity,sum_pixels\n'
+
+# Run with:
+#
+#    $ python -m unittest discover tests
+
+class CheckFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        validate.init_worker(frozenset([6070, 6072]), {})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check(self, rows):
+        file_name = os.path.join(self.directory, '5.csv')
+        with open(file_name, 'wb') as f:
+            f.write(HEADER + rows)
+        return validate.check_file(file_name)
+
+    def test_valid_file(self):
+        data_set_id, num_rows, errors = self.check('5,6072,1.0,2,3\n5,6070,0.5,1,2\n')
+        self.assertEqual((data_set_id, num_rows, errors), (5, 2, []))
+
+    def test_truncated_row(self):
+        data_set_id, num_rows, errors = self.check('5,6072,1.0,2,3\n5,6072,1.0\n5,6070,0.5,1,2\n')
+        self.assertEqual(num_rows, 3)
+        self.assertEqual([ (e['check'], e['row']) for e in errors ], [ ('malformed', 2) ])
+
+    def test_non_numeric_value(self):
+        data_set_id, num_rows, errors = self.check('5,6072,abc,2,3\n5,6070,0.5,1,-2\n')
+        self.assertEqual(num_rows, 2)
+        self.assertEqual([ (e['check'], e['row']) for e in errors ], [ ('malformed', 1), ('non_negative', 2) ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+import numpy as np
+import metaimage
+import ontology
+import unionize
+
+# Developmental trajectories: how the expression of a gene in a structure
+# changes across the stages of the data set.  For every probe, the mean
+# expression energy of every structure (computed from the energy and
+# annotation volumes, see unionize.py) and the API's expression energy
+# (from structure_unionizes/) are stored in one SQLite table indexed by
+# probe and structure, along with each probe's gene and stage.  A gene's
+# trajectory in a structure is then a single indexed query.
+#
+# Updates are incremental: a probe is only recomputed if its energy volume,
+# annotation volume or unionize file changed since the last run, and probes
+# that are no longer listed in meta/data_sets.csv are dropped.  Probes whose
+# energy volume, annotation volume or unionize file is missing or unreadable
+# (e.g. after a partial sync) are skipped and reported, and keep whatever
+# the table already holds for them.
+#
+# Run this file as a script from within the directory where you downloaded
+# the data set to update the table, or to print a trajectory:
+#
+#    $ python trajectories.py
+#    $ python trajectories.py --gene Shh --structure is
+
+DATA_SETS_CSV = 'meta/data_sets.csv'
+ONTOLOGY_FILE_NAME = 'meta/structures.csv'
+ENERGY_DIRECTORY = 'energy/'
+ANNOTATION_DIRECTORY = 'annotation/'
+UNIONIZE_DIRECTORY = 'structure_unionizes/'
+TRAJECTORIES_FILE_NAME = 'trajectories.sqlite'
+
+# Stages of the data set in developmental order, as in download_data.py.
+STAGES = ['E13.5', 'E15.5', 'E18.5', 'P4', 'P14', 'P28']
+
+# Find the stage named in a reference space name.
+def stage_of(reference_space_name):
+    words = reference_space_name.split()
+    return next((stage for stage in STAGES if stage in words or stage == reference_space_name), reference_space_name)
+
+# Describe the files a probe's results depend on by their sizes and
+# modification times.  Missing files are described as such.
+def file_signature(file_names):
+    parts = []
+    for file_name in file_names:
+        if os.path.exists(file_name):
+            parts.append('%s:%d:%r' % (os.path.basename(file_name), os.path.getsize(file_name), os.path.getmtime(file_name)))
+        else:
+            parts.append('%s:missing' % os.path.basename(file_name))
+    return '|'.join(parts)
+
+# Read the API's expression energy per structure from a unionize CSV.
+def read_expression_energies(file_name):
+    energies = {}
+    if os.path.exists(file_name):
+        with open(file_name, 'rb') as f:
+            for row in csv.DictReader(f):
+                if row['expression_energy'] != '':
+                    energies[int(row['structure_id'])] = float(row['expression_energy'])
+    return energies
+
+class TrajectoryTable(object):
+
+    def __init__(self, file_name=TRAJECTORIES_FILE_NAME):
+        self.connection = sqlite3.connect(file_name)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS probes (
+                data_set_id INTEGER PRIMARY KEY,
+                gene_id INTEGER NOT NULL,
+                gene_acronym TEXT NOT NULL,
+                reference_space_id INTEGER NOT NULL,
+                stage TEXT NOT NULL,
+                stage_order INTEGER NOT NULL,
+                signature TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS probes_gene_id ON probes (gene_id);
+            CREATE INDEX IF NOT EXISTS probes_gene_acronym ON probes (gene_acronym);
+            CREATE TABLE IF NOT EXISTS expression (
+                data_set_id INTEGER NOT NULL,
+                structure_id INTEGER NOT NULL,
+                mean_energy REAL,
+                volume INTEGER,
+                expression_energy REAL,
+                PRIMARY KEY (data_set_id, structure_id));
+            CREATE INDEX IF NOT EXISTS expression_structure_id ON expression (structure_id);
+        """)
+        self.connection.commit()
+
+    # Bring the table up to date with the data sets in data_sets.csv.
+    # 'ontology_file_name' is the file 'o' was read from; a change to it
+    # recomputes every probe.  Returns the number of probes recomputed and
+    # removed, and the (data set ID, problem) of every probe skipped because
+    # its files are incomplete.
+    def update(self, o, data_sets_csv=DATA_SETS_CSV, energy_directory=ENERGY_DIRECTORY,
+               annotation_directory=ANNOTATION_DIRECTORY, unionize_directory=UNIONIZE_DIRECTORY,
+               ontology_file_name=ONTOLOGY_FILE_NAME):
+        with open(data_sets_csv, 'rb') as f:
+            data_sets = list(csv.DictReader(f))
+
+        signatures = dict(self.connection.execute("SELECT data_set_id, signature FROM probes"))
+        current_ids = set(int(d['section_data_set_database_id']) for d in data_sets)
+
+        removed_ids = [ (data_set_id,) for data_set_id in signatures if data_set_id not in current_ids ]
+        self.connection.executemany("DELETE FROM expression WHERE data_set_id = ?", removed_ids)
+        self.connection.executemany("DELETE FROM probes WHERE data_set_id = ?", removed_ids)
+        self.connection.commit()
+
+        ids = np.frombuffer(o.ids, dtype=np.int32)
+        label_indexes = {}
+        num_updated = 0
+        skipped = []
+
+        for data_set in data_sets:
+            data_set_id = int(data_set['section_data_set_database_id'])
+            energy_file_name = energy_directory + data_set['energy_file_name']
+            annotation_file_name = annotation_directory + data_set['annotation_file_name']
+            unionize_file_name = '%s%d.csv' % (unionize_directory, data_set_id)
+
+            missing = [ f for f in [ energy_file_name, annotation_file_name, unionize_file_name ] if not os.path.exists(f) ]
+            if missing:
+                skipped.append((data_set_id, "missing %s" % ', '.join(missing)))
+                continue
+
+            try:
+                with metaimage.MetaImage(energy_file_name) as energy, metaimage.MetaImage(annotation_file_name) as annotation:
+                    signature = file_signature([energy_file_name, energy.raw_file_name, annotation.raw_file_name, unionize_file_name,
+                                                ontology_file_name])
+
+                    if signatures.get(data_set_id) == signature:
+                        continue
+
+                    metaimage.check_same_grid(energy, annotation)
+
+                    if annotation_file_name not in label_indexes:
+                        label_indexes[annotation_file_name] = unionize.cached_label_index(annotation_file_name)
+                    labels, starts, order = label_indexes[annotation_file_name]
+
+                    totals = unionize.rollup_arrays(o, labels, unionize.label_statistics(energy.flat, labels, starts, order))
+                expression_energies = read_expression_energies(unionize_file_name)
+            except (IOError, OSError, ValueError, KeyError) as e:
+                skipped.append((data_set_id, str(e)))
+                continue
+
+            present = totals['volume'] > 0
+            rows = [ (data_set_id, int(sid), float(mean), int(volume), expression_energies.get(int(sid)))
+                     for sid, mean, volume in zip(ids[present], totals['mean'][present], totals['volume'][present]) ]
+
+            # Structures the API reports but the annotation volume does not label.
+            annotated = set(int(sid) for sid in ids[present])
+            rows += [ (data_set_id, sid, None, 0, expression_energy)
+                      for sid, expression_energy in expression_energies.iteritems() if sid not in annotated ]
+
+            stage = stage_of(data_set['reference_space_name'])
+            stage_order = STAGES.index(stage) if stage in STAGES else len(STAGES)
+
+            self.connection.execute("DELETE FROM expression WHERE data_set_id = ?", (data_set_id,))
+            self.connection.executemany("INSERT INTO expression VALUES (?, ?, ?, ?, ?)", rows)
+            self.connection.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (data_set_id, int(data_set['gene_database id']), data_set['gene_acronym'],
+                                     int(data_set['reference_space_database_id']), stage, stage_order, signature))
+            self.connection.commit()
+            num_updated += 1
+
+        return num_updated, len(removed_ids), skipped
+
+    # The expression of a gene in a structure at every stage, in
+    # developmental order.  The gene can be given by database ID or acronym.
+    # Values from several probes of the same gene and stage are averaged.
+    # Returns a list of dictionaries.
+    def trajectory(self, gene, structure_id):
+        gene_column = 'gene_id' if isinstance(gene, (int, long)) else 'gene_acronym'
+        cursor = self.connection.execute(
+            "SELECT p.stage, AVG(e.mean_energy), AVG(e.expression_energy), COUNT(*) "
+            "FROM probes p JOIN expression e ON e.data_set_id = p.data_set_id "
+            "WHERE p.%s = ? AND e.structure_id = ? "
+            "GROUP BY p.stage_order, p.stage ORDER BY p.stage_order" % gene_column, (gene, structure_id))
+
+        return [ { 'stage': stage, 'mean_energy': mean_energy, 'expression_energy': expression_energy, 'num_probes': num_probes }
+                 for stage, mean_energy, expression_energy, num_probes in cursor ]
+
+    # The trajectories of every gene in a structure, as a dictionary mapping
+    # gene acronyms to {stage: mean energy} dictionaries.
+    def structure_trajectories(self, structure_id):
+        cursor = self.connection.execute(
+            "SELECT p.gene_acronym, p.stage, AVG(e.mean_energy) "
+            "FROM expression e JOIN probes p ON e.data_set_id = p.data_set_id "
+            "WHERE e.structure_id = ? GROUP BY p.gene_acronym, p.stage", (structure_id,))
+
+        trajectories = {}
+        for gene_acronym, stage, mean_energy in cursor:
+            trajectories.setdefault(gene_acronym, {})[stage] = mean_energy
+        return trajectories
+
+    def close(self):
+        self.connection.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the developmental trajectory table.")
+    parser.add_argument('--gene', help="gene acronym to print the trajectory of")
+    parser.add_argument('--structure', help="structure acronym to print the trajectory in")
+    args = parser.parse_args()
+
+    o = ontology.load(ONTOLOGY_FILE_NAME, ontology.Ontology.DEVELOPING_MOUSE_ROOT_STRUCTURE_ID)
+    table = TrajectoryTable()
+
+    if args.gene and args.structure:
+        structure = o.get_structure_by_acronym(args.structure)
+        assert structure, "unknown structure %s" % args.structure
+
+        for point in table.trajectory(args.gene, structure['database_id']):
+            print point
+    else:
+        num_updated, num_removed, skipped = table.update(o)
+        for data_set_id, problem in skipped:
+            print >> sys.stderr, "skipped data set %d: %s" % (data_set_id, problem)
+        print "updated %d probes, removed %d, skipped %d" % (num_updated, num_removed, len(skipped))
+
+    table.close()
@@ -1,69 +1,224 @@
-import array
+import os
+import re
+import tempfile
+import numpy as np
+import metaimage
 import ontology
 
-# This script demonstrates a simple calculation that you can do using an 
-# expression energy volume and its corresponding annotation volume.  It
-# reads in both volumes, then computes the average expression of the
-# probe per structure.
+# This module computes per-structure expression statistics ("unionizes") from
+# an expression energy volume and its corresponding annotation volume.  Both
+# volumes are memory-mapped through their .mhd headers (see metaimage.py),
+# voxels are grouped by annotation ID with vectorized reductions, and the
+# leaf totals are then rolled up the ontology so that every structure also
+# counts the voxels of its descendants.  Run this file as a script to print the average
+# expression of a probe per structure.
 
-ENERGY_FILE_NAME = 'energy/100083323_energy.raw'
-ANNOTATION_FILE_NAME = 'annotation/2_annotation.raw'
+ENERGY_FILE_NAME = 'energy/100083323_energy.mhd'
+ANNOTATION_FILE_NAME = 'annotation/2_annotation.mhd'
 ONTOLOGY_FILE_NAME = 'meta/structures.csv'
 
-# Read in an energy volume as a block of floats.
-def read_energy_file(file_name):
-    with open(file_name, 'rb') as f:
-        raw = f.read()
-        return array.array('f', raw)
-
-    return None
-
-# Read in an annotation volume as a block of unsigned shorts.
-def read_annotation_file(file_name):
-    with open(file_name, 'rb') as f:
-        raw = f.read()
-        return array.array('H', raw)
-
-    return None
-
-# Read in the volumes.
-energy = read_energy_file(ENERGY_FILE_NAME)
-annotation = read_annotation_file(ANNOTATION_FILE_NAME)
-
-# Make sure they're the same length.
-num_voxels = len(energy)
-assert num_voxels == len(annotation), "annotation and energy files have different dimensions"
-
-# Read in the ontology.
-o = ontology.read_from_csv(ONTOLOGY_FILE_NAME, ontology.Ontology.DEVELOPING_MOUSE_ROOT_STRUCTURE_ID)
-
-# Initialize the list of energy values for all of the structures in the list.
-for structure_id, structure in o.structures.iteritems():
-    structure.energy_values = []
-
-# Build a list of energy values for all structures in the annotation volume.
-# This only contains leaf nodes, so also append the energy values to parent
-# structures recursively.
-for i in xrange(num_voxels):
-    structure = o.get_structure(annotation[i])
-    value = energy[i]
-
-    while structure:
-        structure.energy_values.append(value)
-        structure = structure.parent
-
-# Sum the list of values in each structure, print out values normalized by volume.
-for structure_id, structure in o.structures.iteritems():
-    if len(structure.energy_values) > 0:
-        structure.sum = reduce(lambda x, y: x+y, structure.energy_values)
-        structure.volume = len(structure.energy_values)
-
-        print { "name": structure['name'], 
-                "sum": structure.sum,
-                "volume": structure.volume,
-                "mean": structure.sum/structure.volume }
-
-    else:
-        structure.sum = 0
-        structure.volume = 0
-
+# The statistics computed for each structure.  'expressing_*' statistics only
+# consider voxels with a positive energy value.
+UNIONIZE_FIELDS = ['sum', 'volume', 'mean', 'min', 'max', 'expressing_sum', 'expressing_volume']
+
+# Group voxels by annotation ID.  Returns the sorted list of labels present in
+# the volume, the offset of each label's first voxel in the permutation, and
+# the permutation that sorts the voxels by label.
+def label_index(annotation):
+    order = np.argsort(annotation, kind='mergesort')
+    sorted_labels = annotation[order]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_labels[1:] != sorted_labels[:-1])))
+    return sorted_labels[starts], starts, order
+
+# File name of the cached label index for an annotation volume.
+def label_index_file_name(annotation_mhd_file_name):
+    return re.sub(r'\.mhd$', '', annotation_mhd_file_name) + '_index.npz'
+
+# Describe the annotation data file a label index is built from.
+def label_index_signature(annotation):
+    return np.array([os.path.getsize(annotation.raw_file_name), os.path.getmtime(annotation.raw_file_name)])
+
+# Open the cached label index of an annotation volume, or return None if it
+# is missing or was built from a different annotation file.  The arrays of
+# the returned .npz file are read on access.
+def current_label_index(annotation):
+    index_file_name = label_index_file_name(annotation.mhd_file_name)
+    if not os.path.exists(index_file_name):
+        return None
+
+    index = np.load(index_file_name)
+    if not np.array_equal(index['signature'], label_index_signature(annotation)):
+        return None
+    return index
+
+# Load the label index of an annotation volume from disk, building and saving
+# it first if it is missing or older than the annotation volume.  The index
+# is shared by every probe in the annotation's reference space.
+def cached_label_index(annotation_mhd_file_name):
+    annotation = metaimage.MetaImage(annotation_mhd_file_name)
+    index = current_label_index(annotation)
+    if index is not None:
+        return index['labels'], index['starts'], index['order']
+
+    index_file_name = label_index_file_name(annotation_mhd_file_name)
+    signature = label_index_signature(annotation)
+    labels, starts, order = label_index(annotation.flat)
+
+    # Voxel offsets are stored as 32-bit integers whenever they fit.
+    if len(order) < np.iinfo(np.uint32).max:
+        order = order.astype(np.uint32)
+
+    # Write to a uniquely named temporary file first so that a concurrent
+    # reader never sees a partially written index, and processes building
+    # the same index at once do not overwrite each other's files.
+    fd, temp_file_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_file_name)),
+                                          prefix='.' + os.path.basename(index_file_name), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, labels=labels, starts=starts, order=order, signature=signature)
+        if os.name == 'nt' and os.path.exists(index_file_name):
+            os.remove(index_file_name)
+        os.rename(temp_file_name, index_file_name)
+    except:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+        raise
+
+    return labels, starts, order
+
+# Load the labels and label starts of an annotation volume's cached label
+# index, and the number of voxels in the volume, without the permutation
+# (4 bytes per voxel), for callers that only need each label's voxel count.
+# The arrays of an .npz file are read on access, so the permutation is only
+# read if the index has to be built first.
+def cached_label_starts(annotation_mhd_file_name):
+    annotation = metaimage.MetaImage(annotation_mhd_file_name)
+    index = current_label_index(annotation)
+    if index is not None:
+        return index['labels'], index['starts'], annotation.num_voxels
+
+    labels, starts, order = cached_label_index(annotation_mhd_file_name)
+    return labels, starts, len(order)
+
+# Number of planes scanned at a time by annotation_labels.
+LABEL_SLAB_PLANES = 16
+
+# The sorted labels present in an annotation volume.  They are read from the
+# cached label index if it is current; otherwise the volume is scanned a
+# slab at a time, and no index is written.
+def annotation_labels(annotation_mhd_file_name):
+    annotation = metaimage.MetaImage(annotation_mhd_file_name)
+    index = current_label_index(annotation)
+    if index is not None:
+        return index['labels']
+
+    labels = [ np.unique(annotation.read_block(slice(z, z + LABEL_SLAB_PLANES)))
+               for z in xrange(0, annotation.shape[0], LABEL_SLAB_PLANES) ]
+    return np.unique(np.concatenate(labels + [ np.zeros(0, dtype=annotation.dtype) ]))
+
+# Compute statistics for the voxels of each annotation label.  The result is
+# a dictionary of arrays parallel to 'labels'.
+def label_statistics(energy, labels, starts, order):
+    values = np.asarray(energy, dtype=np.float64)[order]
+    counts = np.diff(np.append(starts, len(values)))
+
+    expressing = values > 0
+
+    return {
+        'sum': np.add.reduceat(values, starts),
+        'volume': counts,
+        'min': np.minimum.reduceat(values, starts),
+        'max': np.maximum.reduceat(values, starts),
+        'expressing_sum': np.add.reduceat(np.where(expressing, values, 0), starts),
+        'expressing_volume': np.add.reduceat(expressing.astype(np.int64), starts)
+    }
+
+# Roll per-label statistics up the ontology so that every structure accounts
+# for the voxels of all of its descendants.  Returns a dictionary of arrays
+# parallel to the ontology's pre-order numbering (see Ontology.ids).  Since
+# each structure's descendants form a contiguous range in that order, the
+# sums are differences of prefix sums and the extrema are reductions over
+# each range, so the cost is independent of the depth of the ontology.
+# Labels that are not in the ontology are ignored.
+def rollup_arrays(o, labels, stats):
+    num_structures = len(o.ids)
+
+    indices = np.array([ o.structures[int(l)].index if int(l) in o.structures else -1 for l in labels ], dtype=np.int64)
+    known = indices >= 0
+    indices = indices[known]
+
+    subtree_starts = np.arange(num_structures)
+    subtree_ends = np.frombuffer(o.subtree_ends, dtype=np.int32)
+
+    totals = {}
+
+    for field in ['sum', 'volume', 'expressing_sum', 'expressing_volume']:
+        values = np.zeros(num_structures, dtype=stats[field].dtype)
+        values[indices] = stats[field][known]
+
+        prefix = np.concatenate(([0], np.cumsum(values)))
+        totals[field] = prefix[subtree_ends] - prefix[subtree_starts]
+
+    # Each reduceat range runs from a structure to the end of its subtree.  A
+    # sentinel value is appended so that the range of the last structure
+    # has a valid end.
+    ranges = np.empty(2 * num_structures, dtype=np.int64)
+    ranges[0::2] = subtree_starts
+    ranges[1::2] = subtree_ends
+
+    for field, reduce_func, empty in [('min', np.minimum, np.inf), ('max', np.maximum, -np.inf)]:
+        values = np.full(num_structures + 1, empty)
+        values[indices] = stats[field][known]
+        totals[field] = reduce_func.reduceat(values, ranges)[0::2]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        totals['mean'] = totals['sum'] / totals['volume']
+
+    return totals
+
+# Roll per-label statistics up the ontology.  Returns a dictionary mapping
+# structure IDs to dictionaries of statistics, for all structures that
+# contain at least one voxel.
+def rollup(o, labels, stats):
+    totals = rollup_arrays(o, labels, stats)
+    result = {}
+
+    for i in np.flatnonzero(totals['volume'] > 0):
+        result[o.ids[i]] = { 'sum': float(totals['sum'][i]),
+                             'volume': int(totals['volume'][i]),
+                             'mean': float(totals['mean'][i]),
+                             'min': float(totals['min'][i]),
+                             'max': float(totals['max'][i]),
+                             'expressing_sum': float(totals['expressing_sum'][i]),
+                             'expressing_volume': int(totals['expressing_volume'][i]) }
+
+    return result
+
+# Compute statistics for every structure in an ontology from an energy volume
+# and an annotation volume of the same dimensions.
+def unionize(energy, annotation, o):
+    assert len(energy) == len(annotation), "annotation and energy files have different dimensions"
+
+    labels, starts, order = label_index(annotation)
+    return rollup(o, labels, label_statistics(energy, labels, starts, order))
+
+# Compute structure statistics from a pair of .mhd files.
+def unionize_files(energy_mhd_file_name, annotation_mhd_file_name, o):
+    energy = metaimage.MetaImage(energy_mhd_file_name)
+    annotation = metaimage.MetaImage(annotation_mhd_file_name)
+    metaimage.check_same_grid(energy, annotation)
+
+    return unionize(energy.flat, annotation.flat, o)
+
+# Run this script as is to print the mean expression per structure for a
+# single probe.
+if __name__ == "__main__":
+    o = ontology.load(ONTOLOGY_FILE_NAME, ontology.Ontology.DEVELOPING_MOUSE_ROOT_STRUCTURE_ID)
+
+    totals = unionize_files(ENERGY_FILE_NAME, ANNOTATION_FILE_NAME, o)
+
+    for structure_id, total in totals.iteritems():
+        print { "name": o.get_structure(structure_id)['name'],
+                "sum": total['sum'],
+                "volume": total['volume'],
+                "mean": total['mean'] }
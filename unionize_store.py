@@ -0,0 +1,233 @@
+import csv
+import json
+import os
+import struct
+import sys
+import tempfile
+import numpy as np
+import api
+
+# This module packs the per-probe CSVs in 'structure_unionizes/' into a
+# single columnar file, and reads it back.  Rows are sorted by data set and
+# then by structure, so all of the unionizes of one probe are a contiguous
+# slice of each column.  The file also stores the row numbers sorted by
+# structure, so all of the unionizes of one structure are found by slicing
+# that permutation rather than scanning every file.
+#
+# The file is laid out as an 8 byte magic string, a 4 byte header length, a
+# JSON header giving the dtype, length and offset of every array, and then
+# the arrays themselves, each aligned to 64 bytes so they can be
+# memory-mapped.
+#
+# Run this file as a script from within the directory where you downloaded
+# the data set to (re)build the store:
+#
+#    $ python unionize_store.py
+
+UNIONIZE_DIRECTORY = 'structure_unionizes/'
+STORE_FILE_NAME = 'structure_unionizes.store'
+
+STORE_MAGIC = 'UNIONIZE'
+STORE_ALIGNMENT = 64
+
+# The columns of the store and their types, in the order of the CSV files.
+COLUMNS = [('section_data_set_id', np.int32),
+           ('structure_id', np.int32),
+           ('expression_energy', np.float64),
+           ('sum_expressing_pixel_intensity', np.float64),
+           ('sum_pixels', np.float64)]
+
+# Parse a numeric CSV value.  Missing values become NaN.
+def parse_float(value):
+    return float(value) if value != '' else np.nan
+
+# Read one unionize CSV into a dictionary of column arrays.  Rows that are
+# truncated or hold values that are not numbers are left out.  Returns the
+# columns and a list of (row number, problem) for the rows left out.  A
+# file without the expected headers is left out entirely, reported as row
+# 0.
+def read_unionize_csv(file_name):
+    columns = { name: [] for name, dtype in COLUMNS }
+    malformed = []
+
+    with open(file_name, 'rb') as f:
+        reader = csv.reader(f)
+        headers = next(reader, [])
+
+        missing = [ name for name, dtype in COLUMNS if name not in headers ]
+        if missing:
+            malformed.append((0, "missing columns %s" % ', '.join(missing)))
+            reader = []
+        else:
+            positions = [ headers.index(name) for name, dtype in COLUMNS ]
+
+        for row_number, row in enumerate(reader, 1):
+            # A truncated or corrupt file can end in a short row.
+            if len(row) < len(headers):
+                malformed.append((row_number, "row has %d of %d columns" % (len(row), len(headers))))
+                continue
+
+            try:
+                values = [ int(row[position]) if np.issubdtype(dtype, np.integer) else parse_float(row[position])
+                           for (name, dtype), position in zip(COLUMNS, positions) ]
+            except ValueError as e:
+                malformed.append((row_number, str(e)))
+                continue
+
+            for (name, dtype), value in zip(COLUMNS, values):
+                columns[name].append(value)
+
+    columns = { name: np.array(columns[name], dtype=dtype) for name, dtype in COLUMNS }
+    return columns, malformed
+
+# Build the store from every CSV in a directory.  Malformed rows are left
+# out and reported on stderr.
+def consolidate(directory=UNIONIZE_DIRECTORY, file_name=STORE_FILE_NAME):
+    parts = { name: [] for name, dtype in COLUMNS }
+
+    for csv_file_name in sorted(os.listdir(directory)):
+        if not csv_file_name.endswith('.csv'):
+            continue
+
+        columns, malformed = read_unionize_csv(os.path.join(directory, csv_file_name))
+        for row_number, problem in malformed:
+            print >> sys.stderr, "%s: skipped %s: %s" % (os.path.join(directory, csv_file_name),
+                                                         "row %d" % row_number if row_number else "file", problem)
+
+        for name, dtype in COLUMNS:
+            parts[name].append(columns[name])
+
+    columns = { name: np.concatenate(parts[name]) if parts[name] else np.zeros(0, dtype)
+                for name, dtype in COLUMNS }
+
+    # Sort rows by data set, then structure.
+    order = np.lexsort((columns['structure_id'], columns['section_data_set_id']))
+    for name in columns:
+        columns[name] = columns[name][order]
+
+    arrays = dict(columns)
+
+    data_set_ids, data_set_starts = group_starts(columns['section_data_set_id'])
+    arrays['data_set_ids'] = data_set_ids
+    arrays['data_set_starts'] = data_set_starts
+
+    # Row numbers sorted by structure (and then by data set, since the rows
+    # already are).
+    by_structure = np.argsort(columns['structure_id'], kind='mergesort').astype(np.uint32)
+    structure_ids, structure_starts = group_starts(columns['structure_id'][by_structure])
+    arrays['rows_by_structure'] = by_structure
+    arrays['structure_ids'] = structure_ids
+    arrays['structure_starts'] = structure_starts
+
+    write_arrays(file_name, arrays)
+
+    return len(order)
+
+# Find the distinct values of a sorted array and where each one starts.  The
+# starts array has one extra element, the length of the array.
+def group_starts(values):
+    if len(values) == 0:
+        return values[:0], np.zeros(1, dtype=np.int64)
+
+    starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+    return values[starts], np.append(starts, len(values)).astype(np.int64)
+
+def aligned(offset):
+    return (offset + STORE_ALIGNMENT - 1) // STORE_ALIGNMENT * STORE_ALIGNMENT
+
+# Write a dictionary of arrays to a store file.
+def write_arrays(file_name, arrays):
+    entries = {}
+    offset = 0
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        entries[name] = { 'dtype': array.dtype.str, 'length': len(array), 'offset': offset }
+        offset = aligned(offset + array.nbytes)
+
+    header = json.dumps({ 'arrays': entries })
+    data_start = aligned(len(STORE_MAGIC) + 4 + len(header))
+
+    # Write to a uniquely named temporary file and rename it over the old
+    # store, so that readers always find a complete store and concurrent
+    # builds do not write over each other.
+    fd, temp_file_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)),
+                                          prefix='.' + os.path.basename(file_name), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(STORE_MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+
+            for name in sorted(arrays):
+                f.seek(data_start + entries[name]['offset'])
+                f.write(np.ascontiguousarray(arrays[name]).tostring())
+
+        api.rename_into_place(temp_file_name, file_name)
+    except:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+        raise
+
+# Read access to a unionize store.  Arrays are memory-mapped, so only the
+# rows that are asked for are read from disk.
+class UnionizeStore(object):
+
+    def __init__(self, file_name=STORE_FILE_NAME):
+        with open(file_name, 'rb') as f:
+            assert f.read(len(STORE_MAGIC)) == STORE_MAGIC, "%s is not a unionize store" % file_name
+            header_length, = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(header_length))
+
+        data_start = aligned(len(STORE_MAGIC) + 4 + header_length)
+
+        self.arrays = {}
+        for name, entry in header['arrays'].iteritems():
+            if entry['length'] > 0:
+                self.arrays[name] = np.memmap(file_name, dtype=np.dtype(str(entry['dtype'])), mode='r',
+                                              offset=data_start + entry['offset'], shape=(entry['length'],))
+            else:
+                self.arrays[name] = np.zeros(0, dtype=np.dtype(str(entry['dtype'])))
+
+        self.columns = { name: self.arrays[name] for name, dtype in COLUMNS }
+        self.num_rows = len(self.columns['section_data_set_id'])
+
+    # All data set IDs in the store, sorted.
+    def data_set_ids(self):
+        return self.arrays['data_set_ids']
+
+    # All structure IDs in the store, sorted.
+    def structure_ids(self):
+        return self.arrays['structure_ids']
+
+    # The range of rows belonging to one key in a sorted index, or None.
+    def find(self, ids_name, starts_name, key):
+        ids = self.arrays[ids_name]
+        i = np.searchsorted(ids, key)
+        if i >= len(ids) or ids[i] != key:
+            return None
+
+        starts = self.arrays[starts_name]
+        return int(starts[i]), int(starts[i+1])
+
+    # Get the unionizes of one data set as a dictionary of column arrays,
+    # sorted by structure.  Each column is a slice of the store.
+    def rows_for_data_set(self, data_set_id):
+        bounds = self.find('data_set_ids', 'data_set_starts', data_set_id)
+        if bounds is None:
+            return { name: column[:0] for name, column in self.columns.iteritems() }
+
+        return { name: column[bounds[0]:bounds[1]] for name, column in self.columns.iteritems() }
+
+    # Get the unionizes of one structure as a dictionary of column arrays,
+    # sorted by data set.
+    def rows_for_structure(self, structure_id):
+        bounds = self.find('structure_ids', 'structure_starts', structure_id)
+        if bounds is None:
+            return { name: column[:0] for name, column in self.columns.iteritems() }
+
+        rows = self.arrays['rows_by_structure'][bounds[0]:bounds[1]]
+        return { name: column[rows] for name, column in self.columns.iteritems() }
+
+if __name__ == "__main__":
+    num_rows = consolidate()
+    print "wrote %d unionizes to %s" % (num_rows, STORE_FILE_NAME)
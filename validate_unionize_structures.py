@@ -1,38 +1,213 @@
+import argparse
 import csv
+import json
 import os
+import sys
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import api
+import ontology
+import unionize
 
-# Check to make sure that all of the structures listed in the
-# structure_unionizes folder are in the master structure list.
-# Run this script from within the directory where you downloaded
-# the data set.  
-
-# read in the list of structures 
-with open('meta/structures.csv','rb') as f:
-    r = csv.DictReader(f)
-    structures = list(r)
-
-    # strip out the structure database ids
-    all_structure_ids = [ int(s['database_id']) for s in structures ]
-
-    # read in each structure unionize file, pull out the structure ids
-    # for each listed unionize, and shove them all into a hash
-    print "reading unionizes"
-    unionize_structures = {}
-    for dirname, dirnames, filenames in os.walk('structure_unionizes'):
-        for filename in filenames:
-            with open(dirname + '/' + filename, 'rb') as uf:
-                ur = csv.DictReader(uf)
-                unionizes = list(ur)
-
-                structure_ids = [ int(u['structure_id']) for u in unionizes ]
-
-                for sid in structure_ids:
-                    unionize_structures[sid] = 1
-
-    # make sure that all of the structures listed in the unionize files exist
-    print "checking master list"
-    for sid in unionize_structures.keys():
-        if sid not in all_structure_ids:
-            print "%s missing" % (sid)
-
-    
+# Check the structure unionize files for consistency.  Run this script from
+# within the directory where you downloaded the data set.  For each file in
+# structure_unionizes/ it checks that:
+#
+#    - every structure is in the master structure list (meta/structures.csv)
+#    - every structure, or one of its descendants, is labeled in the
+#      annotation volume of the probe's developmental stage
+#    - expression energies and sums are not negative
+#    - every row belongs to the data set named by the file
+#    - every row is complete and its values are numbers
+#    - (with --check-api) the number of rows matches the API
+#
+# Files are streamed and checked in parallel.  The result is a JSON report
+# listing every problem found; the script exits with a non-zero status if
+# there were any.
+
+STRUCTURES_CSV = 'meta/structures.csv'
+DATA_SETS_CSV = 'meta/data_sets.csv'
+ANNOTATION_DIRECTORY = 'annotation/'
+UNIONIZE_DIRECTORY = 'structure_unionizes/'
+
+DEVELOPING_MOUSE_GRAPH_ID = 17
+
+NON_NEGATIVE_FIELDS = ['expression_energy', 'sum_expressing_pixel_intensity', 'sum_pixels']
+
+# Find the IDs of all structures that are labeled in an annotation volume,
+# either directly or through one of their descendants.  Validating does not
+# write a label index for the volume.
+def annotated_structure_ids(o, annotation_mhd_file_name):
+    labels = unionize.annotation_labels(annotation_mhd_file_name)
+
+    # Count labeled structures in each subtree with prefix sums over the
+    # ontology's pre-order numbering.
+    labeled = np.zeros(len(o.ids) + 1, dtype=np.int64)
+    for label in labels:
+        structure = o.get_structure(int(label))
+        if structure is not None:
+            labeled[structure.index + 1] = 1
+
+    prefix = np.cumsum(labeled)
+    subtree_ends = np.frombuffer(o.subtree_ends, dtype=np.int32)
+    present = prefix[subtree_ends] - prefix[:-1] > 0
+
+    ids = np.frombuffer(o.ids, dtype=np.int32)
+    return frozenset(int(sid) for sid in ids[present])
+
+# State shared by the worker processes, set up by init_worker.
+worker_structure_ids = None
+worker_annotated_ids = None
+
+def init_worker(structure_ids, annotated_ids):
+    global worker_structure_ids, worker_annotated_ids
+    worker_structure_ids = structure_ids
+    worker_annotated_ids = annotated_ids
+
+# Check one unionize file.  Returns the data set ID, the number of rows and
+# a list of problems.
+def check_file(file_name):
+    errors = []
+    num_rows = 0
+
+    try:
+        data_set_id = int(os.path.splitext(os.path.basename(file_name))[0])
+    except ValueError:
+        data_set_id = None
+
+    annotated_ids = worker_annotated_ids.get(data_set_id)
+
+    def error(check, row, detail):
+        errors.append({ 'file': file_name, 'check': check, 'row': row, 'detail': detail })
+
+    with open(file_name, 'rb') as f:
+        reader = csv.reader(f)
+        headers = next(reader, [])
+
+        try:
+            data_set_column = headers.index('section_data_set_id')
+            structure_column = headers.index('structure_id')
+            value_columns = [ (field, headers.index(field)) for field in NON_NEGATIVE_FIELDS ]
+        except ValueError as e:
+            error('headers', 0, str(e))
+            return data_set_id, num_rows, errors
+
+        for row_number, row in enumerate(reader, 1):
+            num_rows += 1
+
+            # A truncated or corrupt file can end in a short row.
+            if len(row) < len(headers):
+                error('malformed', row_number, "row has %d of %d columns" % (len(row), len(headers)))
+                continue
+
+            try:
+                sid = int(row[structure_column])
+            except ValueError:
+                error('structure_id', row_number, "unparseable structure id")
+                continue
+
+            if sid not in worker_structure_ids:
+                error('structure_id', row_number, "structure %d missing from master list" % sid)
+            elif annotated_ids is not None and sid not in annotated_ids:
+                error('annotation', row_number, "structure %d is not in the annotation volume" % sid)
+
+            if data_set_id is not None and row[data_set_column] != str(data_set_id):
+                error('data_set_id', row_number, "row belongs to data set %s" % row[data_set_column])
+
+            for field, column in value_columns:
+                value = row[column]
+                if value == '':
+                    continue
+
+                try:
+                    number = float(value)
+                except ValueError:
+                    error('malformed', row_number, "%s is not a number: %r" % (field, value))
+                    continue
+
+                if number < 0:
+                    error('non_negative', row_number, "%s is %s" % (field, value))
+
+    return data_set_id, num_rows, errors
+
+# Ask the API how many unionizes a data set has.
+def api_row_count(data_set_id):
+    return data_set_id, api.count_unionizes(data_set_id, DEVELOPING_MOUSE_GRAPH_ID)
+
+def validate(num_processes=None, check_api=False, api_threads=8):
+    o = ontology.load(STRUCTURES_CSV, ontology.Ontology.DEVELOPING_MOUSE_ROOT_STRUCTURE_ID)
+    structure_ids = frozenset(o.structures)
+
+    # Work out which structures are annotated in each stage, once per
+    # annotation volume.
+    annotated_ids = {}
+    if os.path.exists(DATA_SETS_CSV):
+        with open(DATA_SETS_CSV, 'rb') as f:
+            data_sets = list(csv.DictReader(f))
+
+        by_annotation = {}
+        for annotation_file_name in set(d['annotation_file_name'] for d in data_sets):
+            mhd_file_name = ANNOTATION_DIRECTORY + annotation_file_name
+            if os.path.exists(mhd_file_name):
+                by_annotation[annotation_file_name] = annotated_structure_ids(o, mhd_file_name)
+
+        for d in data_sets:
+            if d['annotation_file_name'] in by_annotation:
+                annotated_ids[int(d['section_data_set_database_id'])] = by_annotation[d['annotation_file_name']]
+
+    file_names = [ os.path.join(dirname, filename)
+                   for dirname, dirnames, filenames in os.walk(UNIONIZE_DIRECTORY)
+                   for filename in filenames if filename.endswith('.csv') ]
+
+    report = { 'files_checked': 0, 'rows_checked': 0, 'errors': [] }
+    row_counts = {}
+
+    pool = Pool(num_processes, init_worker, (structure_ids, annotated_ids))
+    try:
+        for data_set_id, num_rows, errors in pool.imap_unordered(check_file, file_names, chunksize=16):
+            report['files_checked'] += 1
+            report['rows_checked'] += num_rows
+            report['errors'] += errors
+            if data_set_id is not None:
+                row_counts[data_set_id] = num_rows
+    finally:
+        pool.close()
+        pool.join()
+
+    if check_api:
+        threads = ThreadPool(api_threads)
+        try:
+            for data_set_id, api_rows in threads.imap_unordered(api_row_count, sorted(row_counts)):
+                if api_rows != row_counts[data_set_id]:
+                    report['errors'].append({ 'file': "%s%d.csv" % (UNIONIZE_DIRECTORY, data_set_id),
+                                              'check': 'row_count', 'row': None,
+                                              'detail': "%d rows on disk, %d from the API" % (row_counts[data_set_id], api_rows) })
+        finally:
+            threads.close()
+
+    summary = {}
+    for e in report['errors']:
+        summary[e['check']] = summary.get(e['check'], 0) + 1
+
+    report['error_counts'] = summary
+    report['ok'] = not report['errors']
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate the structure unionize files.")
+    parser.add_argument('--processes', type=int, default=None, help="number of worker processes (default: one per core)")
+    parser.add_argument('--check-api', action='store_true', help="compare row counts with the API")
+    parser.add_argument('--report', help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = validate(args.processes, args.check_api)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print
+
+    sys.exit(0 if report['ok'] else 1)